@@ -0,0 +1,149 @@
+"""
+Rolling-origin hindcast: refit the waves at every cutoff day (weekly by
+default) over the history and record how the fitted wave parameters and
+the next-peak prediction from plotFit evolved. Cutoffs are split into
+contiguous runs, one per worker process, and within a run each fit is
+warm-started from the previous cutoff's vertex.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+import math
+import os
+import sys
+
+from peak_fitter import findStarts, minimizePeaks, lstBackends
+from peaks_objective import PeaksObjective
+from peak_finder import IncrementalPeakFinder, PeakFinder
+from plot_fit import predictNextPeak
+from time_series import loadSeries
+
+def warmStarts(lstPrevious, lstPeaks, nFittedPeaks):
+    """Starting vertex from the previous cutoff's vertex, extended with
+    peak finder guesses for any waves that have appeared since"""
+    if (len(lstPrevious)-1)//3 > nFittedPeaks: # lost a wave, start over
+        return None
+    lstStarts, lstScales = findStarts(lstPeaks, nFittedPeaks, False)
+    lstStarts[0:len(lstPrevious)] = lstPrevious
+    return lstStarts, lstScales
+
+def fitCutoff(strFilename, nCutoff, strBackend, lstPrevious=None, fPreviousError=math.inf, pFinder=None):
+    """Fit the data up to nCutoff, warm-starting from lstPrevious if the
+    waves are compatible. pFinder is a peak finder that has been given the
+    days up to nCutoff, otherwise the data is scanned for peaks. A cold start from the peak finder guesses is also
+    tried if a wave has appeared or the warm fit is much worse than the
+    previous one, as the old waves can be pulled out of shape by a wave
+    that has started but not yet been found. Returns the best fitted
+    vertex and RMS error."""
+    if pFinder is None:
+        pFinder = PeakFinder(strFilename, nCutoff).pFinder
+    lstPeaks, bExtrapolated = pFinder.peaks()
+    nFittedPeaks = len(lstPeaks)
+    if bExtrapolated:
+        nFittedPeaks -= 1 # do not fit extrapolated last peak (fits badly)
+    pObjective = PeaksObjective(strFilename, nCutoff)
+
+    lstVertex = None
+    fError = math.inf
+    bCold = True
+    if lstPrevious is not None:
+        pStarts = warmStarts(lstPrevious, lstPeaks, nFittedPeaks)
+        if pStarts is not None:
+            nCount, pResult, nReason, fSeconds = minimizePeaks(pObjective, pStarts[0], pStarts[1], strBackend)
+            lstVertex, fError = pResult.getVertex(), pResult.getValue()
+            bCold = len(lstVertex) != len(lstPrevious) or fError > 1.5*fPreviousError
+
+    if bCold:
+        lstStarts, lstScales = findStarts(lstPeaks, nFittedPeaks, False)
+        nCount, pResult, nReason, fSeconds = minimizePeaks(pObjective, lstStarts, lstScales, strBackend)
+        if pResult.getValue() < fError:
+            return pResult.getVertex(), pResult.getValue()
+    return lstVertex, fError
+
+def fitCutoffs(strFilename, lstCutoffs, strBackend):
+    """Fit a contiguous run of cutoffs in order, each warm-started from the
+    last, feeding the days between cutoffs to one incremental peak finder.
+    Returns (cutoff, vertex, rms) tuples."""
+    lstResults = []
+    lstPrevious = None
+    fPreviousError = math.inf
+    pSeries = loadSeries(strFilename)
+    pFinder = IncrementalPeakFinder.fromSeries(pSeries.truncate(lstCutoffs[0]).aValues) # gaps as addDays leaves them
+    nDay = lstCutoffs[0]+1
+    for nCutoff in lstCutoffs:
+        pFinder.addDays(pSeries.aValues[nDay:nCutoff+1])
+        nDay = nCutoff+1
+        lstVertex, fError = fitCutoff(strFilename, nCutoff, strBackend, lstPrevious, fPreviousError, pFinder)
+        lstResults.append((nCutoff, lstVertex, fError))
+        lstPrevious = lstVertex
+        fPreviousError = fError
+    return lstResults
+
+def backtest(strFilename, nFirstDay=400, nStep=7, nLastDay=-1, nWorkers=None, strBackend="lm"):
+    """Fit at every nStep-th day from nFirstDay to nLastDay (default the end
+    of the data), writing _backtest.csv with the next-peak prediction at
+    each cutoff and _backtest_waves.csv with every fitted wave"""
+    pObjective = PeaksObjective(strFilename, -1)
+    pStartDate = datetime.strptime(pObjective.strStartDate, "%Y-%m-%d")
+    if nLastDay < 0:
+        nLastDay = len(pObjective.lstData)-1
+    lstCutoffs = list(range(nFirstDay, nLastDay+1, nStep))
+    if not lstCutoffs:
+        print("No cutoffs between days", nFirstDay, "and", nLastDay)
+        return []
+
+    # contiguous runs so warm starts are chained as far as possible
+    nRuns = min(len(lstCutoffs), nWorkers or os.cpu_count())
+    nSize = math.ceil(len(lstCutoffs)/nRuns)
+    lstRuns = [lstCutoffs[nI:nI+nSize] for nI in range(0, len(lstCutoffs), nSize)]
+    print("Backtesting", len(lstCutoffs), "cutoffs in", len(lstRuns), "runs")
+    lstResults = []
+    with ProcessPoolExecutor(max_workers=nWorkers) as pPool:
+        for lstRun in pPool.map(fitCutoffs, [strFilename]*len(lstRuns), lstRuns, [strBackend]*len(lstRuns)):
+            lstResults.extend(lstRun)
+
+    strBacktestFile = strFilename.replace(".csv", "_backtest.csv")
+    strWavesFile = strFilename.replace(".csv", "_backtest_waves.csv")
+    print("Writing backtest to:", strBacktestFile, strWavesFile)
+    with open(strBacktestFile, "w") as outFile, open(strWavesFile, "w") as wavesFile:
+        outFile.write("# "+pObjective.strStartDate+"\n")
+        outFile.write("# Cutoff Date Waves RMS NextDate NextDay NextDaySDev NextSDev NextSDevSDev NextArea NextAreaSDev\n")
+        wavesFile.write("# "+pObjective.strStartDate+"\n")
+        wavesFile.write("# Cutoff Peak Date Day SDev Area\n")
+        for nCutoff, lstVertex, fError in lstResults:
+            pCutoffDate = (pStartDate+timedelta(days=nCutoff)).date()
+            lstPositions = lstVertex[2::3]
+            lstWidths = lstVertex[3::3]
+            lstHeights = lstVertex[1::3]
+            lstRow = [nCutoff, pCutoffDate, len(lstPositions), fError]
+            if len(lstPositions) > 4:
+                mapPrediction = predictNextPeak(lstPositions, lstWidths, lstHeights)
+                pNextDate = (pStartDate+timedelta(days=mapPrediction["position"])).date()
+                lstRow.extend([pNextDate, mapPrediction["position"], mapPrediction["spacing_sdev"],
+                    mapPrediction["sdev"], mapPrediction["sdev_sdev"], mapPrediction["area"], mapPrediction["area_sdev"]])
+            else: # not enough waves to predict from
+                lstRow.extend(["nan"]*7)
+            outFile.write(" ".join(map(str, lstRow))+"\n")
+
+            for nPeak in range(len(lstPositions)):
+                fSDev = math.sqrt(lstWidths[nPeak]/2)
+                fArea = lstHeights[nPeak]*math.sqrt(2*math.pi)*fSDev
+                pDate = (pStartDate+timedelta(days=lstPositions[nPeak])).date()
+                wavesFile.write(" ".join(map(str, (nCutoff, nPeak+1, pDate, lstPositions[nPeak], fSDev, fArea)))+"\n")
+    return lstResults
+
+if __name__ == "__main__":
+    pParser = argparse.ArgumentParser(prog="python3 backtest.py", description="Refit waves at a series of cutoff days to see how the fit and prediction evolved")
+    pParser.add_argument("filename", help="File to process (must end in .csv)")
+    pParser.add_argument("--first", "-f", help="First cutoff day (day number 0 is Jan 23, 2020), default is 400", default=400, type=int)
+    pParser.add_argument("--step", "-s", help="Days between cutoffs, default is 7", default=7, type=int)
+    pParser.add_argument("--last", "-l", help="Last cutoff day, default is the end of the data", default=-1, type=int)
+    pParser.add_argument("--workers", "-w", help="Number of worker processes, default is one per core", default=None, type=int)
+    pParser.add_argument("--backend", "-b", help="Fitting backend, default is lm", default="lm", choices=lstBackends)
+    pArgs = pParser.parse_args(sys.argv[1:])
+
+    if not pArgs.filename.endswith(".csv"):
+        print("BAD FILENAME: MUST END IN .csv:", pArgs.filename)
+        sys.exit(-1)
+
+    backtest(pArgs.filename, pArgs.first, pArgs.step, pArgs.last, pArgs.workers, pArgs.backend)
@@ -0,0 +1,8 @@
+"""
+Offline benchmarks for the fitting, alignment and rendering code. Inputs
+are generated by benchmarks.synthetic, so nothing is downloaded, and the
+results are written as JSON that can be compared between commits:
+
+    python3 -m benchmarks --output before.json
+    python3 -m benchmarks --output after.json --compare before.json
+"""
@@ -0,0 +1,78 @@
+import argparse
+from contextlib import redirect_stdout
+from datetime import datetime
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+from benchmarks.macro import runMacro
+from benchmarks.micro import runMicro
+from benchmarks.synthetic import makeWorkspace
+
+def gitCommit():
+    """Current commit of the repository, or None outside a checkout"""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(mapBase, mapReport, fThreshold=0.1):
+    """Print each benchmark's time against a previous report"""
+    print("")
+    print("Compared with", mapBase.get("commit"), "from", mapBase.get("date"))
+    print("%-26s %12s %12s %8s" % ("benchmark", "before (s)", "after (s)", "ratio"))
+    for strName, mapResult in mapReport["results"].items():
+        if strName not in mapBase["results"]:
+            continue
+        fBefore = mapBase["results"][strName]["seconds"]
+        fAfter = mapResult["seconds"]
+        fRatio = fAfter/fBefore if fBefore else float("inf")
+        strFlag = "slower" if fRatio > 1+fThreshold else "faster" if fRatio < 1-fThreshold else ""
+        print("%-26s %12.6g %12.6g %8.3f %s" % (strName, fBefore, fAfter, fRatio, strFlag))
+
+if __name__ == "__main__":
+    pParser = argparse.ArgumentParser(prog="python3 -m benchmarks", description="Run the offline benchmarks on synthetic data")
+    pParser.add_argument("--micro", action="store_true", help="Only run the microbenchmarks")
+    pParser.add_argument("--macro", action="store_true", help="Only run the macrobenchmarks")
+    pParser.add_argument("--slow", action="store_true", help="Include the simplex fit, which takes tens of seconds")
+    pParser.add_argument("--repeat", "-r", help="Repeats of each benchmark, default is 5", default=5, type=int)
+    pParser.add_argument("--days", help="Length of the synthetic series, default is 960", default=960, type=int)
+    pParser.add_argument("--gaps", help="Number of 10-day gaps in the synthetic series, default is 0", default=0, type=int)
+    pParser.add_argument("--output", "-o", help="Write the results as JSON to this file", default="")
+    pParser.add_argument("--compare", "-c", help="Compare with the results in this JSON file", default="")
+    pParser.add_argument("--workspace", "-w", help="Directory for the synthetic files, default is a temporary one", default="")
+    pArgs = pParser.parse_args(sys.argv[1:])
+
+    strDirectory = pArgs.workspace or tempfile.mkdtemp(prefix="benchmarks_")
+    mapFiles = makeWorkspace(strDirectory, pArgs.days, pArgs.gaps)
+    mapResults = {}
+    try:
+        with redirect_stdout(io.StringIO()): # the stages are chatty
+            if not pArgs.macro:
+                mapResults.update(runMicro(mapFiles, pArgs.repeat))
+            if not pArgs.micro:
+                mapResults.update(runMacro(mapFiles, min(pArgs.repeat, 3), pArgs.slow))
+    finally:
+        if not pArgs.workspace:
+            shutil.rmtree(strDirectory, ignore_errors=True)
+
+    mapReport = {"commit": gitCommit(), "date": datetime.now().isoformat(timespec="seconds"),
+                 "python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+                 "cpus": os.cpu_count(), "days": pArgs.days, "gaps": pArgs.gaps, "results": mapResults}
+    print("%-26s %12s %12s" % ("benchmark", "median (s)", "best (s)"))
+    for strName, mapResult in mapResults.items():
+        print("%-26s %12.6g %12.6g" % (strName, mapResult["seconds"], mapResult["best"]))
+    if pArgs.output:
+        with open(pArgs.output, "w") as outFile:
+            json.dump(mapReport, outFile, indent=1)
+    if pArgs.compare:
+        with open(pArgs.compare) as inFile:
+            compare(json.load(inFile), mapReport)
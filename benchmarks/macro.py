@@ -0,0 +1,37 @@
+"""
+Macrobenchmarks: a full peak fit, SEIRS fit, rendering the figures and an
+end-to-end pipeline run (without the download) in the workspace.
+"""
+import os
+
+from benchmarks.micro import measure
+from decompose_can_covid_hosp_data import buildPipeline
+from peak_fitter import fitPeaks
+from pipeline import strStateFile
+from render import renderAll
+from seirs_model_objective import fitSeirsModel
+
+def runMacro(mapFiles, nRepeat=3, bSlow=False):
+    """Run the macrobenchmarks on a workspace from synthetic.makeWorkspace.
+    The simplex fit takes tens of seconds so it only runs with bSlow."""
+    strSeries = mapFiles["series"]
+    mapResults = {}
+
+    mapResults["fit_lm"] = measure(lambda: fitPeaks(strSeries, strBackend="lm", bCache=False), nRepeat)
+    if bSlow:
+        mapResults["fit_simplex"] = measure(lambda: fitPeaks(strSeries, strBackend="simplex", bCache=False), 1)
+    mapResults["fit_seirs"] = measure(lambda: fitSeirsModel(strSeries, strModelFile=mapFiles["model"]), nRepeat)
+    mapResults["render_parallel"] = measure(lambda: renderAll(strSeries), nRepeat)
+    mapResults["render_serial"] = measure(lambda: renderAll(strSeries, nWorkers=1), nRepeat)
+
+    # the pipeline uses names relative to the working directory
+    strCurrent = os.getcwd()
+    os.chdir(os.path.dirname(os.path.abspath(strSeries)))
+    try:
+        if os.path.exists(strStateFile):
+            os.remove(strStateFile)
+        mapResults["pipeline_full"] = measure(lambda: buildPipeline("lm", bDownload=False).run(bForce=True), nRepeat)
+        mapResults["pipeline_up_to_date"] = measure(lambda: buildPipeline("lm", bDownload=False).run(), nRepeat)
+    finally:
+        os.chdir(strCurrent)
+    return mapResults
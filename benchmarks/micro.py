@@ -0,0 +1,56 @@
+"""
+Microbenchmarks: single objective evaluations, batched evaluation, the
+jacobian (also under the Poisson loss), series loading, peak finding, SEIRS simulation and alignment.
+"""
+import statistics
+import time
+
+import numpy as np
+
+from multi_start import perturbStarts
+from peak_finder import IncrementalPeakFinder, PeakFinder
+from losses import PoissonLoss
+from peak_fitter import findStarts
+from peaks_objective import PeaksObjective
+from seirs_model import simulateSeirs
+from seirs_model_objective import SeirsModelObjective, alignSeirsModel
+from time_series import loadSeries
+
+def measure(fnRun, nRepeat=5, nNumber=1):
+    """Time nRepeat runs of nNumber calls, returning the median and best
+    seconds per call"""
+    lstTimes = []
+    for nI in range(nRepeat):
+        fStart = time.perf_counter()
+        for nJ in range(nNumber):
+            fnRun()
+        lstTimes.append((time.perf_counter()-fStart)/nNumber)
+    return {"seconds": statistics.median(lstTimes), "best": min(lstTimes), "repeat": nRepeat, "number": nNumber}
+
+def runMicro(mapFiles, nRepeat=5):
+    """Run the microbenchmarks on a workspace from synthetic.makeWorkspace"""
+    strSeries = mapFiles["series"]
+    mapResults = {}
+
+    pObjective = PeaksObjective(strSeries, -1)
+    lstPeaks, bExtrapolated = PeakFinder(strSeries, -1).findPeaks()
+    lstStarts, lstScales = findStarts(lstPeaks, len(lstPeaks)-bExtrapolated, False)
+    aVertices = perturbStarts(lstStarts, 256, np.random.default_rng(1))
+    mapResults["objective_call"] = measure(lambda: pObjective(lstStarts), nRepeat, 200)
+    mapResults["objective_batch_256"] = measure(lambda: pObjective.batch(aVertices), nRepeat, 5)
+    mapResults["objective_jacobian"] = measure(lambda: pObjective.jacobian(lstStarts), nRepeat, 200)
+    pPoisson = PeaksObjective(strSeries, -1, pLoss=PoissonLoss())
+    mapResults["poisson_call"] = measure(lambda: pPoisson(lstStarts), nRepeat, 200)
+    mapResults["poisson_jacobian"] = measure(lambda: pPoisson.jacobian(lstStarts), nRepeat, 200)
+
+    pSeries = loadSeries(strSeries)
+    aFilled = pSeries.filled()
+    mapResults["load_series"] = measure(lambda: loadSeries(strSeries), nRepeat, 20)
+    mapResults["peak_finder_batch"] = measure(lambda: IncrementalPeakFinder.fromSeries(aFilled), nRepeat, 20)
+    mapResults["peak_finder_incremental"] = measure(lambda: IncrementalPeakFinder().addDays(aFilled), nRepeat, 5)
+
+    pSeirs = SeirsModelObjective(strSeries, mapFiles["model"])
+    mapResults["seirs_align"] = measure(lambda: alignSeirsModel(pSeirs.aData, pSeirs.aSeirsModel), nRepeat, 5)
+    mapResults["seirs_simulate"] = measure(simulateSeirs, nRepeat, 5)
+    mapResults["seirs_objective_call"] = measure(lambda: pSeirs([30.0, 0.3]), nRepeat, 20)
+    return mapResults
@@ -0,0 +1,94 @@
+"""
+Synthetic inputs in the formats the pipeline reads: a hospitalization
+series made of a linear ramp plus Gaussian waves plus noise, optionally
+with gaps, and a SEIRS-like model curve.
+"""
+from datetime import datetime, timedelta
+import os
+
+import numpy as np
+
+from time_series import TimeSeries
+
+pStartDate = datetime(2020, 1, 23)
+
+# height, position and width (2*sdev**2) roughly like the Canadian waves
+lstDefaultWaves = [(1600, 105, 900), (4500, 300, 1500), (2500, 440, 1200), (3500, 590, 1000),
+                   (10000, 730, 700), (6000, 820, 1200), (5800, 915, 1400), (5000, 1010, 1800)]
+
+def makeWaves(nWaves, nDays, pRandom):
+    """nWaves waves spread evenly over the days with random sizes"""
+    aPositions = np.linspace(0.1, 0.95, nWaves)*nDays
+    return [(float(pRandom.uniform(1000, 10000)), float(fPosition), float(2*pRandom.uniform(18, 30)**2)) for fPosition in aPositions]
+
+def makeSeries(nDays=960, lstWaves=None, fSlope=0.5, fNoise=80.0, nGaps=0, nGapLength=10, nZeroDays=69, nSeed=1):
+    """Daily counts: fSlope*day plus the (height, position, width) waves plus
+    Gaussian noise of fNoise, rounded and clipped at zero. The first
+    nZeroDays are zero like the real data, and nGaps runs of nGapLength
+    days are set to NaN."""
+    pRandom = np.random.default_rng(nSeed)
+    if lstWaves is None:
+        lstWaves = lstDefaultWaves
+    aDays = np.arange(nDays, dtype=float)
+    aValues = fSlope*aDays
+    for fHeight, fPosition, fWidth in lstWaves:
+        aValues += fHeight*np.exp(-(aDays-fPosition)**2/fWidth)
+    aValues = np.maximum(0, aValues+pRandom.normal(0, fNoise, nDays)).round()
+    aValues[:nZeroDays] = 0
+    for nStart in pRandom.integers(nZeroDays, max(nZeroDays+1, nDays-nGapLength), size=nGaps):
+        aValues[nStart:nStart+nGapLength] = np.nan
+    return aValues
+
+def makeSeirsCurve(nDays=1002, nPopulation=100000, fBeta=0.35, fIncubation=3.0, fRecovery=7.0, fImmunity=45.0, nStages=16, nInfected=14):
+    """Day, E+I, E, I and S columns of a discrete-time SEIRS epidemic, in
+    the layout of seirs_model.csv. Immunity wanes through nStages
+    recovered compartments, so it lasts about fImmunity days with little
+    spread and the epidemic comes in repeated waves."""
+    fS, fE, fI = float(nPopulation-nInfected), float(nInfected), 0.0
+    aRecovered = np.zeros(nStages)
+    aModel = np.empty((nDays, 5))
+    for nDay in range(nDays):
+        aModel[nDay] = (nDay, round(fE+fI), round(fE), round(fI), round(fS))
+        fInfections = fBeta*fS*fI/nPopulation
+        fOnset = fE/fIncubation
+        fRecovered = fI/fRecovery
+        aFlow = aRecovered*nStages/fImmunity
+        fS += aFlow[-1]-fInfections
+        fE += fInfections-fOnset
+        fI += fOnset-fRecovered
+        aRecovered[0] += fRecovered-aFlow[0]
+        aRecovered[1:] += aFlow[:-1]-aFlow[1:]
+    return aModel
+
+def writeSeries(strFilename, aValues):
+    """Write the series as the extracted day/value text file and its binary copy"""
+    with open(strFilename, "w") as outFile:
+        outFile.write("## "+str(pStartDate.date())+"\n")
+        for nDay, fValue in enumerate(aValues):
+            if np.isfinite(fValue):
+                outFile.write(str(nDay)+" "+str(int(fValue))+"\n")
+    TimeSeries(pStartDate, aValues, ["hospitalized"]).save(strFilename)
+
+def writeSource(strFilename, aValues, nZeroDays=69):
+    """Write the series as a Health Canada style date,numhosp file"""
+    with open(strFilename, "w") as outFile:
+        outFile.write("date,numhosp\n")
+        for nDay in range(nZeroDays, len(aValues)):
+            strCount = str(int(aValues[nDay])) if np.isfinite(aValues[nDay]) else ""
+            outFile.write(str((pStartDate+timedelta(days=nDay)).date())+","+strCount+"\n")
+
+def writeSeirsCurve(strFilename, aModel):
+    np.savetxt(strFilename, aModel, fmt="%d")
+
+def makeWorkspace(strDirectory, nDays=960, nGaps=0, nSeed=1):
+    """Write a source file, extracted series and SEIRS model into
+    strDirectory, returning the map of their filenames"""
+    os.makedirs(strDirectory, exist_ok=True)
+    aValues = makeSeries(nDays, nGaps=nGaps, nSeed=nSeed)
+    mapFiles = {"source": os.path.join(strDirectory, "canada-covid-data.csv"),
+                "series": os.path.join(strDirectory, "can_hosp_patients.csv"),
+                "model": os.path.join(strDirectory, "seirs_model.csv")}
+    writeSource(mapFiles["source"], aValues)
+    writeSeries(mapFiles["series"], aValues)
+    writeSeirsCurve(mapFiles["model"], makeSeirsCurve())
+    return mapFiles
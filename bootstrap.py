@@ -0,0 +1,119 @@
+"""
+Confidence intervals for the fitted wave parameters by moving-block
+residual bootstrap. The residuals of the base fit are resampled in blocks
+of consecutive days, which keeps their day-to-day correlation, added back
+onto the fit, and each replicate is refitted warm-started from the base
+vertex. Replicates are split into chunks, one per worker process, and the
+percentile intervals of each wave's date, SDev and area are written to
+_bootstrap.csv. The replicate vertices are saved to _bootstrap.npy for
+forecast.py.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+from peak_fitter import fitPeaks, minimizePeaks, lstBackends
+from peaks_objective import PeaksObjective
+
+def blockResample(aResiduals, nReplicates, nBlock, pRandom):
+    """nReplicates rows of residuals made by joining randomly placed runs of
+    nBlock consecutive residuals, trimmed to the original length"""
+    nDays = len(aResiduals)
+    nBlock = max(1, min(nBlock, nDays))
+    nBlocks = math.ceil(nDays/nBlock)
+    aStarts = pRandom.integers(0, nDays-nBlock+1, size=(nReplicates, nBlocks))
+    aIndices = (aStarts[:, :, None]+np.arange(nBlock)).reshape(nReplicates, -1)[:, :nDays]
+    return aResiduals[aIndices]
+
+def fitReplicates(strFilename, nMaxDay, lstBase, aReplicates, strBackend):
+    """Refit each row of aReplicates (data on the objective's valid days)
+    from the base vertex, returning one fitted vertex per row. The rows
+    are fitted one after another: a stacked fit of the whole chunk gives
+    the same vertices but is no faster, as the time goes on the exp of
+    every wave on every day, which stacking does not save, and a chunk
+    takes as long as its slowest replicate."""
+    pObjective = PeaksObjective(strFilename, nMaxDay)
+    lstScales = [0.01]+[10, 1000, 10]*((len(lstBase)-1)//3) # as findStarts, for the simplex
+    aVertices = np.empty((len(aReplicates), len(lstBase)))
+    for nI, aData in enumerate(aReplicates):
+        pObjective.aData = aData
+        nCount, pResult, nReason, fSeconds = minimizePeaks(pObjective, list(lstBase), lstScales, strBackend)
+        aVertices[nI] = pResult.getVertex()
+    return aVertices
+
+def waveParameters(aVertices):
+    """Position, SDev and area of every wave for a stack of vertices, each
+    of shape (vertices, waves)"""
+    aPeaks = aVertices[:, 1:].reshape(len(aVertices), -1, 3)
+    aSDev = np.sqrt(aPeaks[:, :, 2]/2)
+    return aPeaks[:, :, 1], aSDev, aPeaks[:, :, 0]*math.sqrt(2*math.pi)*aSDev
+
+def bootstrap(strFilename, nReplicates=200, nBlock=14, fLevel=0.95, nWorkers=None, strBackend="lm", nSeed=None, nMaxDay=-1):
+    """Fit the data, bootstrap nReplicates refits and write _bootstrap.csv
+    with the fLevel percentile interval of each wave's date, SDev and area.
+    Returns the array of replicate vertices."""
+
+    lstBase = fitPeaks(strFilename, nMaxDay, strBackend)
+    pObjective = PeaksObjective(strFilename, nMaxDay)
+    pStartDate = datetime.strptime(pObjective.strStartDate, "%Y-%m-%d")
+    aFit = pObjective.evaluate(pObjective.aDays, lstBase)
+    aResiduals = pObjective.aData-aFit
+
+    pRandom = np.random.default_rng(nSeed)
+    aReplicates = aFit+blockResample(aResiduals, nReplicates, nBlock, pRandom)
+
+    nChunks = min(nReplicates, nWorkers or os.cpu_count())
+    lstChunks = np.array_split(aReplicates, nChunks)
+    print("Bootstrapping", nReplicates, "replicates with blocks of", nBlock, "days in", nChunks, "chunks")
+    fStart = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=nWorkers) as pPool:
+        aVertices = np.concatenate(list(pPool.map(fitReplicates, [strFilename]*nChunks, [nMaxDay]*nChunks,
+                                                  [lstBase]*nChunks, lstChunks, [strBackend]*nChunks)))
+    print("Wall time (s):", time.perf_counter()-fStart)
+
+    # how far the replicate fits are from the base fit on the real data
+    aErrors = pObjective.batch(aVertices)
+    print("Replicate RMS on the data, median and 95th percentile:", np.median(aErrors), np.percentile(aErrors, 95))
+
+    fTail = 50*(1-fLevel)
+    aPosition, aSDev, aArea = waveParameters(aVertices)
+    aBasePosition, aBaseSDev, aBaseArea = (aValue[0] for aValue in waveParameters(np.array([lstBase])))
+    aPositionRange, aSDevRange, aAreaRange = (np.percentile(aValue, [fTail, 100-fTail], axis=0) for aValue in (aPosition, aSDev, aArea))
+
+    strBootstrapFile = strFilename.replace(".csv", "_bootstrap.csv")
+    print("Writing bootstrap intervals to:", strBootstrapFile)
+    with open(strBootstrapFile, "w") as outFile:
+        outFile.write("# "+pObjective.strStartDate+"\n")
+        outFile.write("# replicates: "+str(nReplicates)+" block: "+str(nBlock)+" level: "+str(fLevel)+"\n")
+        outFile.write("# Peak Date DateLow DateHigh Day DayLow DayHigh SDev SDevLow SDevHigh Area AreaLow AreaHigh\n")
+        for nPeak in range(len(aBasePosition)):
+            lstDates = [(pStartDate+timedelta(days=float(fDay))).date() for fDay in (aBasePosition[nPeak], *aPositionRange[:, nPeak])]
+            lstRow = [nPeak+1]+lstDates+[aBasePosition[nPeak], *aPositionRange[:, nPeak],
+                                         aBaseSDev[nPeak], *aSDevRange[:, nPeak], aBaseArea[nPeak], *aAreaRange[:, nPeak]]
+            outFile.write(" ".join(map(str, lstRow))+"\n")
+    np.save(strFilename.replace(".csv", "_bootstrap.npy"), aVertices)
+    return aVertices
+
+if __name__ == "__main__":
+    pParser = argparse.ArgumentParser(prog="python3 bootstrap.py", description="Residual block bootstrap confidence intervals for the fitted wave parameters")
+    pParser.add_argument("filename", help="File to process (must end in .csv)")
+    pParser.add_argument("--replicates", "-r", help="Number of bootstrap replicates, default is 200", default=200, type=int)
+    pParser.add_argument("--block", "-l", help="Length in days of the resampled residual blocks, default is 14", default=14, type=int)
+    pParser.add_argument("--level", help="Confidence level of the intervals, default is 0.95", default=0.95, type=float)
+    pParser.add_argument("--workers", "-w", help="Number of worker processes, default is one per core", default=None, type=int)
+    pParser.add_argument("--backend", "-b", help="Fitting backend, default is lm", default="lm", choices=lstBackends)
+    pParser.add_argument("--seed", "-s", help="Random seed, for repeatable intervals", default=None, type=int)
+    pParser.add_argument("--maxday", "-m", help="Maximum day number to process, default is all", default=-1, type=int)
+    pArgs = pParser.parse_args(sys.argv[1:])
+
+    if not pArgs.filename.endswith(".csv"):
+        print("BAD FILENAME: MUST END IN .csv:", pArgs.filename)
+        sys.exit(-1)
+
+    bootstrap(pArgs.filename, pArgs.replicates, pArgs.block, pArgs.level, pArgs.workers, pArgs.backend, pArgs.seed, pArgs.maxday)
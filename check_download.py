@@ -0,0 +1,107 @@
+"""
+Check of the conditional downloads in download_covid_data.py, run
+against a local file server rather than the live data source.
+"""
+import argparse
+import functools
+import hashlib
+import http.server
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from download_covid_data import download_data, readMetadata
+
+class CheckHandler(http.server.SimpleHTTPRequestHandler):
+    """File server for selfCheck that sends an ETag (and honours
+    If-None-Match) if bETag, and sends no Last-Modified and ignores
+    If-Modified-Since unless bLastModified"""
+    bETag = True
+    bLastModified = True
+    lstRequests = []
+
+    def etag(self):
+        with open(self.translate_path(self.path), "rb") as inFile:
+            return '"'+hashlib.sha256(inFile.read()).hexdigest()[:16]+'"'
+
+    def send_head(self):
+        CheckHandler.lstRequests.append(dict(self.headers))
+        if self.bETag and self.headers.get("If-None-Match") == self.etag():
+            self.send_response(304)
+            self.end_headers()
+            return None
+        if not self.bLastModified:
+            del self.headers["If-Modified-Since"]
+        return super().send_head()
+
+    def send_header(self, strKeyword, strValue):
+        if strKeyword == "Last-Modified" and not self.bLastModified:
+            return
+        super().send_header(strKeyword, strValue)
+
+    def end_headers(self):
+        if self.bETag and self.command == "GET" and os.path.isfile(self.translate_path(self.path)):
+            super().send_header("ETag", self.etag())
+        super().end_headers()
+
+    def log_message(self, strFormat, *args):
+        pass
+
+def selfCheck():
+    """Download from a local http.server with and without ETag and
+    Last-Modified validators, checking the conditional requests, the 304
+    handling and the sha256 fallback. Returns True if every check passes."""
+    lstFailures = []
+    def check(strName, bPassed):
+        print("OK    " if bPassed else "FAILED", strName)
+        if not bPassed:
+            lstFailures.append(strName)
+
+    with tempfile.TemporaryDirectory() as strDirectory:
+        strServed = os.path.join(strDirectory, "served")
+        os.makedirs(strServed)
+        strSource = os.path.join(strServed, "data.csv")
+        pServer = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(CheckHandler, directory=strServed))
+        threading.Thread(target=pServer.serve_forever, daemon=True).start()
+        strURL = "http://127.0.0.1:"+str(pServer.server_address[1])+"/data.csv"
+        try:
+            for bETag, bLastModified in [(True, True), (True, False), (False, True), (False, False)]:
+                CheckHandler.bETag, CheckHandler.bLastModified = bETag, bLastModified
+                strMode = "etag="+str(bETag)+" last-modified="+str(bLastModified)+": "
+                strDataFile = os.path.join(strDirectory, "data_"+str(bETag)+"_"+str(bLastModified)+".csv")
+                with open(strSource, "w") as outFile:
+                    outFile.write("date,numhosp\n2020-04-01,434\n")
+                os.utime(strSource, (time.time()-100, time.time()-100))
+
+                check(strMode+"first download changes the file", download_data(strURL, strDataFile, 0))
+                with open(strDataFile) as inFile:
+                    check(strMode+"downloaded content", inFile.read().endswith("434\n"))
+                mapMetadata = readMetadata(strDataFile)
+                check(strMode+"validators stored", ("etag" in mapMetadata) == bETag and ("last_modified" in mapMetadata) == bLastModified)
+
+                check(strMode+"fresh file is not fetched", not download_data(strURL, strDataFile, 12))
+                nRequests = len(CheckHandler.lstRequests)
+                check(strMode+"unchanged file is unchanged", not download_data(strURL, strDataFile, 0))
+                mapHeaders = CheckHandler.lstRequests[-1]
+                check(strMode+"request was conditional", ("If-None-Match" in mapHeaders) == bETag and ("If-Modified-Since" in mapHeaders) == bLastModified)
+                check(strMode+"one request per check", len(CheckHandler.lstRequests) == nRequests+1)
+
+                with open(strSource, "w") as outFile:
+                    outFile.write("date,numhosp\n2020-04-01,434\n2020-04-02,543\n")
+                check(strMode+"changed file is downloaded", download_data(strURL, strDataFile, 0))
+                with open(strDataFile) as inFile:
+                    check(strMode+"new content", inFile.read().endswith("543\n"))
+            check("no temporary files left", not [strName for strName in os.listdir(strDirectory) if strName.endswith(".tmp")])
+        finally:
+            pServer.shutdown()
+            pServer.server_close()
+    print("All checks passed" if not lstFailures else str(len(lstFailures))+" checks failed")
+    return not lstFailures
+
+if __name__ == "__main__":
+    pParser = argparse.ArgumentParser(prog="python3 check_download.py", description="Check conditional downloads against a local http.server")
+    pParser.parse_args(sys.argv[1:])
+
+    sys.exit(0 if selfCheck() else 1)
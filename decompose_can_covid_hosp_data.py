@@ -1,47 +1,128 @@
 """
 Download data from Our World in Data, extract Canadian hospitalization data
-and fit it with a series of Gaussian waves. The code currently expects 8 waves.
+and fit it with a series of Gaussian waves. The code currently expects 8 waves;
+wave_count.py chooses the number of waves by AIC/BIC instead.
 Data is only downloaded if current data file is at least 12 hours old.
+
+Each step is a pipeline stage (see pipeline.py) that only re-runs when its
+inputs, parameters or source code have changed, so e.g. editing a plot
+label re-renders the figures without refitting. With --joint the ICU and
+ventilator columns are extracted too and all three series are fitted
+together with shared wave positions and widths (see joint_fit.py).
 """
+import argparse
 from datetime import datetime
+import sys
 
-from download_covid_canada import *
-from extract_hospitalized import extractHospitalized
-from peak_fitter import fitPeaks
-from plot_fit import plotFit
-from plot_parameters import plotParameters
-from generate_montage import generateMontage
+from download_covid_data import download_data
+from extract_hospitalized import extractColumns, extractHospitalized, mapOccupancyColumns
+from joint_fit import fitJoint, lstDefaultFiles
+from peak_fitter import fitPeaks, lstBackends
+from pipeline import Pipeline, Stage
+from render import renderAll, lstMontageOrder
+from generate_montage import composeMontage, generateMontage
+from instrumentation import Instrumentation, plotConvergence
 from seirs_model_objective import fitSeirsModel
+from time_series import seriesFile
 
-# download if not done so in the past 12 hours
-strFilename = "canada-covid-data.csv"
+strDataFile = "canada-covid-data.csv"
 strURL = "https://health-infobase.canada.ca/src/data/covidLive/covid19-epiSummary-hospVentICU.csv"
-download_data(strURL, strFilename)
-
-# extract hospitalization data
-strSource = strFilename
 strOutputFile = "can_hosp_patients.csv"
-pLastDate = extractHospitalized(strSource, strOutputFile)
+strModelFile = "seirs_model.csv"
+strMontageFile = "combined.png"
+
+lstFitSources = ["peak_fitter.py", "peaks_objective.py", "peak_finder.py", "levenberg_marquardt.py", "fit_cache.py", "losses.py", "time_series.py"]
+
+def buildPipeline(strBackend="simplex", bDownload=True, pPool=None, bJoint=False):
+    """Stages from download to montage, in run order. The download stage is
+    left out if bDownload is false, and pPool is passed on to renderAll.
+    With bJoint the hospitalized, ICU and ventilated series of
+    joint_fit.lstDefaultFiles are extracted and fitted jointly."""
+
+    strToday = str(datetime.today().date())
+    strSeries = seriesFile(strOutputFile)
+    strParameters = strOutputFile.replace(".csv", "_parameters.csv")
+    strFit = strOutputFile.replace(".csv", "_fit.csv")
+    strModel = strOutputFile.replace(".csv", "_model.csv")
+    mapImages = {"fit": strToday+"_can_hosp_patients.png",
+                 "area": strToday+"_can_hosp_patients_wave_area_cut.png",
+                 "width": strToday+"_can_hosp_patients_wave_width_cut.png",
+                 "spacing": strToday+"_can_hosp_patients_wave_spacing_cut.png"}
+
+    lstSeriesFiles = lstDefaultFiles if bJoint else [strOutputFile]
 
-print("Data written to:", strOutputFile)
-print("Last date with data was:", pLastDate.date(), "which was", (datetime.today()-pLastDate).days, "days ago")
+    def extract(mapResults):
+        if bJoint:
+            pLastDate = extractColumns(strDataFile, list(mapOccupancyColumns), lstSeriesFiles)
+        else:
+            pLastDate = extractHospitalized(strDataFile, strOutputFile)
+        print("Data written to:", " ".join(lstSeriesFiles))
+        print("Last date with data was:", pLastDate.date(), "which was", (datetime.today()-pLastDate).days, "days ago")
+        return pLastDate
 
-# fit the peaks
-fitPeaks(strOutputFile)
+    def montage(mapResults):
+        # compose from the rendered pixels if the render stage ran, else from the files
+        if "render" in mapResults:
+            composeMontage([mapResults["render"][strPlot][1] for strPlot in lstMontageOrder], strMontageFile)
+        else:
+            generateMontage([mapImages[strPlot] for strPlot in lstMontageOrder], strMontageFile)
+        return strMontageFile
 
-# fit to the SEIRS model output
-fitSeirsModel(strOutputFile)
+    pPipeline = Pipeline()
+    # the download checks its own age and validators, so it always runs
+    if bDownload:
+        pPipeline.add(Stage("download", lambda mapResults: download_data(strURL, strDataFile),
+                            lstOutputs=[strDataFile], bAlways=True))
+    pPipeline.add(Stage("extract", extract,
+                        lstInputs=[strDataFile], lstOutputs=lstSeriesFiles+[seriesFile(strFile) for strFile in lstSeriesFiles],
+                        lstSources=["extract_hospitalized.py", "time_series.py"], mapParameters={"joint": True} if bJoint else None))
+    if bJoint:
+        pPipeline.add(Stage("fit", lambda mapResults: fitJoint(lstSeriesFiles, strBackend=strBackend),
+                            lstInputs=[seriesFile(strFile) for strFile in lstSeriesFiles],
+                            lstOutputs=[strFile.replace(".csv", strSuffix) for strFile in lstSeriesFiles for strSuffix in ["_parameters.csv", "_fit.csv", "_diff.csv"]],
+                            lstSources=lstFitSources+["joint_fit.py"], mapParameters={"backend": strBackend, "joint": True}))
+    else:
+        pPipeline.add(Stage("fit", lambda mapResults: fitPeaks(strOutputFile, strBackend=strBackend),
+                            lstInputs=[strSeries], lstOutputs=[strParameters, strFit, strOutputFile.replace(".csv", "_diff.csv")],
+                            lstSources=lstFitSources, mapParameters={"backend": strBackend}))
+    pPipeline.add(Stage("seirs", lambda mapResults: fitSeirsModel(strOutputFile, strModelFile=strModelFile),
+                        lstInputs=[strSeries, strModelFile], lstOutputs=[strModel],
+                        lstSources=["seirs_model_objective.py", "time_series.py"]))
+    # the four figures are rendered concurrently in worker processes
+    pPipeline.add(Stage("render", lambda mapResults: renderAll(strOutputFile, bImage=True, pPool=pPool),
+                        lstInputs=[strSeries, strParameters, strFit, strModel], lstOutputs=list(mapImages.values()),
+                        lstSources=["render.py", "plot_fit.py", "plot_parameters.py", "figures.py", "forecast.py"]))
+    pPipeline.add(Stage("montage", montage,
+                        lstInputs=list(mapImages.values()), lstOutputs=[strMontageFile],
+                        lstSources=["generate_montage.py"]))
+    return pPipeline
 
-# plot the fit and the scaled/shifted model
-plotFit(strOutputFile)
+if __name__ == "__main__":
+    pParser = argparse.ArgumentParser(prog="python3 decompose_can_covid_hosp_data.py", description="Download, fit and plot Canadian hospitalization data, re-running only the stages whose inputs have changed")
+    pParser.add_argument("--backend", "-b", help="Fitting backend: simplex (default) or lm", default="simplex", choices=lstBackends)
+    pParser.add_argument("--joint", "-j", action="store_true", help="Also extract the ICU and ventilator series and fit all three with shared wave positions and widths")
+    pParser.add_argument("--only", "-o", help="Run only these stages (may be repeated)", action="append", default=None)
+    pParser.add_argument("--from", "-f", dest="start", help="Run this stage and every later stage", default=None)
+    pParser.add_argument("--dry-run", "-d", dest="dryrun", action="store_true", help="List the stages that would run without running them")
+    pParser.add_argument("--force", action="store_true", help="Run every stage whether stale or not")
+    pParser.add_argument("--report", "-r", help="Write a JSON run report with stage timings, objective call counts and convergence traces", default="")
+    pParser.add_argument("--convergence", help="With --report, also plot the convergence traces to this file", default="")
+    pParser.add_argument("--profile", action="store_true", help="With --report, run each stage under cProfile")
+    pParser.add_argument("--memory", action="store_true", help="With --report, record each stage's peak memory with tracemalloc")
+    pArgs = pParser.parse_args(sys.argv[1:])
 
-# plot the parameters
-strFilename = strOutputFile.replace(".csv", "_parameters.csv")
-plotParameters(strFilename)
+    pPipeline = buildPipeline(pArgs.backend, bJoint=pArgs.joint)
+    try:
+        pPipeline.select(pArgs.only, pArgs.start)
+    except ValueError as pError:
+        print(pError)
+        sys.exit(-1)
+    if not pArgs.report:
+        pPipeline.run(pArgs.only, pArgs.start, pArgs.dryrun, pArgs.force)
+        sys.exit(0)
 
-# generate montage image
-strToday = str(datetime.today().date())
-lstImages = [strToday+"_can_hosp_patients.png", strToday+"_can_hosp_patients_wave_area_cut.png", 
-strToday+"_can_hosp_patients_wave_spacing_cut.png", strToday+"_can_hosp_patients_wave_width_cut.png"]
-strOutput = "combined.png"
-generateMontage(lstImages, strOutput)
+    with Instrumentation(pArgs.profile, pArgs.memory) as pInstrumentation:
+        pPipeline.run(pArgs.only, pArgs.start, pArgs.dryrun, pArgs.force, pInstrumentation)
+    pInstrumentation.writeReport(pArgs.report)
+    if pArgs.convergence:
+        plotConvergence(pInstrumentation.report(), pArgs.convergence)
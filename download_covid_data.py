@@ -1,25 +1,105 @@
+import argparse
+import hashlib
+import json
 import os
-import requests
+import sys
+import tempfile
 import time
 
-def download_data(strURL, strDataFile):
-    # download the data if required
-    bDownload = True
-    if os.path.exists(strDataFile):
-        pStat = os.stat(strDataFile)
-        nTime = int(time.time())
-    #    print(nTime, pStat.st_mtime)
-        if (nTime-pStat.st_mtime)/3600 < 12:
-            bDownload = False
-    
-    if bDownload:
-        print("****DOWNLOADING****")
-        print(strURL)
-        pResponse = requests.get(strURL)
+import requests
+
+nChunkSize = 1 << 16
+
+def metadataFile(strDataFile):
+    """Name of the sidecar holding the validators for a data file"""
+    return strDataFile+".meta.json"
+
+def readMetadata(strDataFile):
+    try:
+        with open(metadataFile(strDataFile)) as inFile:
+            return json.load(inFile)
+    except (OSError, ValueError):
+        return {}
+
+def writeMetadata(strDataFile, mapMetadata):
+    strDirectory = os.path.dirname(os.path.abspath(strDataFile))
+    nHandle, strTemp = tempfile.mkstemp(dir=strDirectory, suffix=".tmp")
+    with os.fdopen(nHandle, "w") as outFile:
+        json.dump(mapMetadata, outFile, indent=1)
+    os.replace(strTemp, metadataFile(strDataFile))
+
+def download_data(strURL, strDataFile, nMaxAgeHours=12, nTimeout=60):
+    """
+    Download strURL to strDataFile if the last check was more than
+    nMaxAgeHours ago. The request is conditional on the ETag and
+    Last-Modified of the previous download, so an unchanged file costs a
+    single round trip; a server that sends neither is caught by the
+    sha256 of the body. The body is streamed to a temporary file that is
+    renamed over the data file, so a failed download never leaves a
+    truncated file behind. Returns True if the data file changed.
+    """
+    mapMetadata = readMetadata(strDataFile)
+    if not os.path.exists(strDataFile):
+        mapMetadata = {}
+    else:
+        fChecked = mapMetadata.get("checked", os.stat(strDataFile).st_mtime)
+        if (time.time()-fChecked)/3600 < nMaxAgeHours:
+            return False
+
+    mapHeaders = {}
+    if "etag" in mapMetadata:
+        mapHeaders["If-None-Match"] = mapMetadata["etag"]
+    if "last_modified" in mapMetadata:
+        mapHeaders["If-Modified-Since"] = mapMetadata["last_modified"]
+
+    print("****DOWNLOADING****")
+    print(strURL)
+    with requests.get(strURL, headers=mapHeaders, stream=True, timeout=nTimeout) as pResponse:
+        if pResponse.status_code == 304:
+            print("Not modified since last download")
+            mapMetadata["checked"] = time.time()
+            writeMetadata(strDataFile, mapMetadata)
+            return False
         if pResponse.status_code != 200:
             print("Failed to download:", strURL)
             print("Error code:", pResponse.status_code)
             sys.exit(-1)
 
-        with open(strDataFile, "w") as outFile:
-            outFile.write(pResponse.text+"\n")
+        pHash = hashlib.sha256()
+        strDirectory = os.path.dirname(os.path.abspath(strDataFile))
+        nHandle, strTemp = tempfile.mkstemp(dir=strDirectory, suffix=".tmp")
+        try:
+            with os.fdopen(nHandle, "wb") as outFile:
+                for pChunk in pResponse.iter_content(nChunkSize):
+                    pHash.update(pChunk)
+                    outFile.write(pChunk)
+            strHash = pHash.hexdigest()
+            bChanged = strHash != mapMetadata.get("sha256")
+            if bChanged:
+                os.replace(strTemp, strDataFile)
+            else: # server ignored the validators but the content is the same
+                os.remove(strTemp)
+        except BaseException:
+            if os.path.exists(strTemp):
+                os.remove(strTemp)
+            raise
+
+        mapMetadata = {"url": strURL, "checked": time.time(), "sha256": strHash}
+        if "ETag" in pResponse.headers:
+            mapMetadata["etag"] = pResponse.headers["ETag"]
+        if "Last-Modified" in pResponse.headers:
+            mapMetadata["last_modified"] = pResponse.headers["Last-Modified"]
+        writeMetadata(strDataFile, mapMetadata)
+
+    if not bChanged:
+        print("Downloaded data is unchanged")
+    return bChanged
+
+if __name__ == "__main__":
+    pParser = argparse.ArgumentParser(prog="python3 download_covid_data.py", description="Download a data file if it has changed")
+    pParser.add_argument("url", help="URL to download")
+    pParser.add_argument("filename", help="File to download to")
+    pParser.add_argument("--maxage", help="Only check again after this many hours, default is 12", default=12, type=float)
+    pArgs = pParser.parse_args(sys.argv[1:])
+
+    download_data(pArgs.url, pArgs.filename, pArgs.maxage)
@@ -1,28 +1,111 @@
 from datetime import datetime, timedelta
 
+import numpy as np
+
+from time_series import TimeSeries, seriesFile
+
 pStart = datetime(2020, 1, 23) # start of OWID data, which I'm emulating
 
 nOffset = 69 # all zeros before start
 
-def extractHospitalized(strSource, strDest):
-    with open(strDest, "w") as outFile:
-        outFile.write("## 2020-01-23\n")
-        for nI in range(nOffset):
-            outFile.write(str(nI)+" "+"0\n")
+# names the region column goes by in Health Canada files
+lstRegionColumns = ["prname", "Jurisdiction", "jurisdiction", "region", "Region", "province", "Province"]
+
+def findRegionColumn(lstHeader, strRegionColumn=None):
+    """Index of the region column in the header, or -1 if there is none"""
+    lstCandidates = [strRegionColumn] if strRegionColumn else lstRegionColumns
+    for strColumn in lstCandidates:
+        if strColumn in lstHeader:
+            return lstHeader.index(strColumn)
+    return -1
+
+def findRegions(strSource, strRegionColumn=None):
+    """List the regions in the source file in the order they first appear"""
+    lstRegions = []
+    with open(strSource) as inFile:
+        nColumn = findRegionColumn(inFile.readline().strip().split(","), strRegionColumn)
+        if nColumn < 0:
+            return lstRegions
+        for strLine in inFile:
+            lstLine = strLine.strip().split(",")
+            if len(lstLine) > nColumn and lstLine[nColumn] not in lstRegions:
+                lstRegions.append(lstLine[nColumn])
+    return lstRegions
+
+# header names each occupancy series goes by, matched ignoring case
+mapOccupancyColumns = {"hospitalized": ["numhosp", "COVID_HOSP", "hospitalized"],
+                       "icu": ["numicu", "COVID_ICU", "icu"],
+                       "ventilated": ["numvent", "COVID_VENT", "ventilated", "vent"]}
+
+def findColumn(lstHeader, strSeries):
+    """Index of the column for an occupancy series (a mapOccupancyColumns
+    key) or a column name, or -1 if there is none"""
+    lstNames = [strName.lower() for strName in lstHeader]
+    for strColumn in mapOccupancyColumns.get(strSeries, [strSeries]):
+        if strColumn.lower() in lstNames:
+            return lstNames.index(strColumn.lower())
+    return -1
+
+def extractColumns(strSource, lstColumns, lstDests, strRegion=None, strRegionColumn=None):
+    """Write day/count pairs for each of lstColumns (names as for
+    findColumn, None for the last column) of the source to the matching
+    file of lstDests in one pass, restricted to rows for strRegion if
+    given, and return the last date with data in any of them. Each series
+    is also saved in binary form (see time_series.py) with missing days as
+    NaN."""
+    pDate = None
+    lstCounts = [{nI: 0.0 for nI in range(nOffset)} for strDest in lstDests]
+    lstOutFiles = [open(strDest, "w") for strDest in lstDests]
+    try:
+        for outFile in lstOutFiles:
+            outFile.write("## 2020-01-23\n")
+            for nI in range(nOffset):
+                outFile.write(str(nI)+" "+"0\n")
 
         with open(strSource) as inFile:
-            inFile.readline()
+            nColumn = -1
+            lstHeader = inFile.readline().strip().split(",")
+            if strRegion is not None:
+                nColumn = findRegionColumn(lstHeader, strRegionColumn)
+                if nColumn < 0:
+                    raise ValueError("No region column in: "+strSource)
+            lstIndices = []
+            for strColumn in lstColumns:
+                lstIndices.append(-1 if strColumn is None else findColumn(lstHeader, strColumn))
+                if strColumn is not None and lstIndices[-1] < 0:
+                    raise ValueError("No "+strColumn+" column in: "+strSource)
             for strLine in inFile:
                 lstLine = strLine.strip().split(",")
+                if nColumn >= 0 and lstLine[nColumn] != strRegion:
+                    continue
                 strDate = lstLine[0]
-                strCount = lstLine[-1]
+                pRowDate = None
+                for nIndex, outFile, mapCounts in zip(lstIndices, lstOutFiles, lstCounts):
+                    strCount = lstLine[nIndex] if nIndex < len(lstLine) else ""
+
+                    if len(strCount):
+                        pRowDate = pRowDate or datetime.strptime(strDate, "%Y-%m-%d")
+                        pDate = pRowDate
+                        nDays = (pRowDate-pStart).days
+                        outFile.write(str(nDays)+" "+strCount+"\n")
+                        mapCounts[nDays] = float(strCount)
+    finally:
+        for outFile in lstOutFiles:
+            outFile.close()
 
-                if len(strCount):
-                    pDate = datetime.strptime(strDate, "%Y-%m-%d")
-                    nDays = (pDate-pStart).days
-                    outFile.write(str(nDays)+" "+strCount+"\n")
+    for strColumn, strDest, mapCounts in zip(lstColumns, lstDests, lstCounts):
+        aValues = np.full(max(mapCounts)+1, np.nan)
+        aValues[list(mapCounts)] = list(mapCounts.values())
+        TimeSeries(pStart, aValues, [strColumn or "hospitalized"]).save(seriesFile(strDest))
     return pDate
-    
+
+def extractHospitalized(strSource, strDest, strRegion=None, strRegionColumn=None):
+    """Write day/count pairs for the last column of the source, restricted
+    to rows for strRegion if given, and return the last date with data.
+    The same series is saved in binary form (see time_series.py) with
+    missing days as NaN."""
+    return extractColumns(strSource, [None], [strDest], strRegion, strRegionColumn)
+
 if __name__ == "__main__":
     strSource = "canada-covid-data.csv"
     strDest = "can_hosp_patients.csv"
@@ -0,0 +1,25 @@
+"""
+Finishing of matplotlib figures, shared by the plot modules: saving to a
+file and/or grabbing the pixels for the montage.
+"""
+import numpy as np
+
+def finishFigure(pFigure, strFigFile, bSave=True, bImage=False):
+    """Save the figure and/or grab its pixels, then close it. Returns the
+    filename, or with bImage the filename and an RGBA array of the figure
+    as it would be saved, so it can be composed without a PNG round-trip."""
+    import matplotlib.pyplot as plt
+
+    if not bImage:
+        if bSave:
+            pFigure.savefig(strFigFile)
+        plt.close(pFigure)
+        return strFigFile
+
+    pFigure.canvas.draw()
+    aImage = np.asarray(pFigure.canvas.buffer_rgba()).copy()
+    plt.close(pFigure)
+    if bSave: # encode the pixels already drawn rather than drawing again
+        from PIL import Image
+        Image.fromarray(aImage).save(strFigFile)
+    return strFigFile, aImage
@@ -0,0 +1,108 @@
+"""
+Content-addressed cache of fitted vertices. Entries are keyed by a hash
+of the input series and the fit configuration, so an unchanged input can
+reuse its fit directly, and an input that has only had days appended can
+find the fit of its longest cached prefix to warm-start from.
+"""
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+strCacheDir = ".fit_cache" # kept next to the series files, see cacheDirectory
+
+nCacheVersion = 1 # bump when the model or file layout changes
+
+def hashSeries(aData, mapConfig=None):
+    """Hash of the series values and (optionally) the fit configuration"""
+    pHash = hashlib.sha256()
+    if mapConfig is not None:
+        pHash.update(json.dumps(mapConfig, sort_keys=True).encode())
+    pHash.update(np.ascontiguousarray(aData, dtype=np.float64).tobytes())
+    return pHash.hexdigest()
+
+def cacheDirectory(strFilename):
+    """Cache directory for a series file, next to it so the cache does not
+    depend on the working directory"""
+    return os.path.join(os.path.dirname(os.path.abspath(strFilename)), strCacheDir)
+
+class FitCache:
+
+    def __init__(self, strDirectory=strCacheDir, nMaxEntries=200):
+        self.strDirectory = strDirectory
+        self.nMaxEntries = nMaxEntries
+
+    def entryFile(self, strKey):
+        return os.path.join(self.strDirectory, strKey+".json")
+
+    def readEntry(self, strFilename):
+        try:
+            with open(strFilename) as inFile:
+                mapEntry = json.load(inFile)
+        except (OSError, ValueError): # missing or half-written entry
+            return None
+        if mapEntry.get("version") != nCacheVersion:
+            return None
+        return mapEntry
+
+    def lookup(self, aData, mapConfig):
+        """Cached entry for exactly this series and configuration, or None"""
+        return self.readEntry(self.entryFile(hashSeries(aData, mapConfig)))
+
+    def lookupPrefix(self, aData, mapConfig):
+        """Cached entry with the same configuration for the longest strict
+        prefix of the series, or None"""
+        if not os.path.isdir(self.strDirectory):
+            return None
+        pBest = None
+        for strName in os.listdir(self.strDirectory):
+            if not strName.endswith(".json"):
+                continue
+            mapEntry = self.readEntry(os.path.join(self.strDirectory, strName))
+            if mapEntry is None or mapEntry["config"] != mapConfig:
+                continue
+            nDays = mapEntry["days"]
+            if nDays >= len(aData) or (pBest is not None and nDays <= pBest["days"]):
+                continue
+            if hashSeries(aData[:nDays]) == mapEntry["data"]:
+                pBest = mapEntry
+        return pBest
+
+    def store(self, aData, mapConfig, lstVertex, fValue):
+        """Save a fitted vertex, written atomically so concurrent workers
+        never see a partial entry"""
+        os.makedirs(self.strDirectory, exist_ok=True)
+        mapEntry = {"version": nCacheVersion, "config": mapConfig, "days": len(aData),
+                    "data": hashSeries(aData), "vertex": list(map(float, lstVertex)), "value": float(fValue)}
+        nHandle, strTemp = tempfile.mkstemp(dir=self.strDirectory, suffix=".tmp")
+        with os.fdopen(nHandle, "w") as outFile:
+            json.dump(mapEntry, outFile)
+        os.replace(strTemp, self.entryFile(hashSeries(aData, mapConfig)))
+        self.prune()
+
+    def prune(self):
+        """Drop the oldest entries beyond the maximum"""
+        lstEntries = [os.path.join(self.strDirectory, strName) for strName in os.listdir(self.strDirectory) if strName.endswith(".json")]
+        if len(lstEntries) <= self.nMaxEntries:
+            return
+        lstEntries.sort(key=os.path.getmtime)
+        for strFilename in lstEntries[:len(lstEntries)-self.nMaxEntries]:
+            try:
+                os.remove(strFilename)
+            except OSError:
+                pass
+
+def affectedAxes(lstVertex, nFirstNewDay, nParameters, fSigmas=4.0):
+    """Axes to refit when days from nFirstNewDay on have been added to a
+    series fitted by lstVertex: the slope, every cached wave that reaches
+    within fSigmas standard deviations of the new days, and every
+    parameter beyond the cached vertex (newly found waves)"""
+    lstFree = [0]
+    for nPeak in range(1, len(lstVertex), 3):
+        fSDev = abs(lstVertex[nPeak+2]/2)**0.5
+        if lstVertex[nPeak+1]+fSigmas*fSDev >= nFirstNewDay:
+            lstFree.extend([nPeak, nPeak+1, nPeak+2])
+    lstFree.extend(range(len(lstVertex), nParameters))
+    return lstFree
@@ -0,0 +1,156 @@
+"""
+Monte Carlo forecast of the next wave. The spacing, SDev and area of the
+next wave are drawn from the predictive distribution of the last few
+waves (mean plus a Student t spread scaled by their standard deviation),
+either from the fitted vertex alone or from each replicate vertex of
+bootstrap.py, which adds the uncertainty of the fit itself. Every sample
+is added to the fitted ramp and waves, and the percentiles across samples
+give bands for daily hospital occupancy and for the next peak's date and
+height. All samples are evaluated as arrays, so tens of thousands take a
+fraction of a second.
+"""
+import argparse
+from datetime import datetime, timedelta
+import math
+import sys
+import time
+
+import numpy as np
+
+from time_series import loadSeries
+
+lstDefaultPercentiles = [5, 25, 50, 75, 95]
+
+def readFitVertex(strFilename):
+    """The fitted vertex and start date from the header of _fit.csv"""
+    with open(strFilename.replace(".csv", "_fit.csv")) as inFile:
+        lstVertex = [float(strValue) for strValue in inFile.readline()[1:].split()]
+        pStartDate = datetime.strptime(inFile.readline()[1:].strip(), "%Y-%m-%d")
+    return lstVertex, pStartDate
+
+def waveStatistics(aVertices, nLookback=4):
+    """Mean and standard deviation of the spacing, SDev and area of the last
+    nLookback waves of each vertex, each an array of shape (vertices, 3)"""
+    aVertices = np.atleast_2d(np.asarray(aVertices, dtype=float))
+    aPeaks = aVertices[:, 1:].reshape(len(aVertices), -1, 3)
+    aPeaks = np.take_along_axis(aPeaks, np.argsort(aPeaks[:, :, 1], axis=1)[:, :, None], axis=1) # in date order
+    if aPeaks.shape[1] < nLookback+1:
+        raise ValueError("Need at least "+str(nLookback+1)+" waves to forecast from the last "+str(nLookback))
+    aSpacing = np.diff(aPeaks[:, -nLookback-1:, 1], axis=1)
+    aSDev = np.sqrt(aPeaks[:, -nLookback:, 2]/2)
+    aArea = aPeaks[:, -nLookback:, 0]*math.sqrt(2*math.pi)*aSDev
+    aValues = np.stack([aSpacing, aSDev, aArea], axis=2)
+    return aValues.mean(axis=1), aValues.std(axis=1, ddof=1)
+
+def sampleWaves(aVertices, nSamples=20000, nLookback=4, pRandom=None):
+    """nSamples rows of next-wave position, SDev and area. Each sample
+    takes the statistics of a randomly chosen vertex and adds the spread
+    expected of a new observation given nLookback earlier ones."""
+    pRandom = pRandom or np.random.default_rng()
+    aVertices = np.atleast_2d(np.asarray(aVertices, dtype=float))
+    aMean, aSDev = waveStatistics(aVertices, nLookback)
+    aChosen = pRandom.integers(0, len(aVertices), nSamples)
+    aT = pRandom.standard_t(nLookback-1, size=(nSamples, 3))
+    aSamples = aMean[aChosen]+aSDev[aChosen]*math.sqrt(1+1/nLookback)*aT
+    aSamples[:, 0] = np.maximum(aSamples[:, 0], 1.0)+np.max(aVertices[aChosen, 2::3], axis=1) # spacing after the last wave
+    aSamples[:, 1] = np.maximum(aSamples[:, 1], 1.0)
+    aSamples[:, 2] = np.maximum(aSamples[:, 2], 0.0)
+    return aSamples
+
+def rowPercentiles(aValues, lstPercentiles):
+    """Percentiles of each row, as np.percentile(axis=1) with linear
+    interpolation, found by sorting the rows, which is quicker than the
+    partitioning np.percentile does for several percentiles of long rows"""
+    aSorted = np.sort(aValues, axis=1)
+    aPositions = np.asarray(lstPercentiles, dtype=float)/100*(aSorted.shape[1]-1)
+    aLow = np.floor(aPositions).astype(int)
+    aHigh = np.minimum(aLow+1, aSorted.shape[1]-1)
+    aFraction = aPositions-aLow
+    return (aSorted[:, aLow]*(1-aFraction)+aSorted[:, aHigh]*aFraction).T
+
+def baseline(lstVertex, aDays):
+    """The fitted ramp and waves on the given days"""
+    aPeaks = np.asarray(lstVertex[1:], dtype=float).reshape(-1, 3)
+    with np.errstate(over="ignore"):
+        return lstVertex[0]*aDays+(aPeaks[:, 0, None]*np.exp(-(aDays-aPeaks[:, 1, None])**2/aPeaks[:, 2, None])).sum(axis=0)
+
+def forecastNextWave(lstVertex, nFirstDay, aVertices=None, nSamples=20000, nLookback=4, lstPercentiles=None, nMaxDays=365, nSeed=None, nChunk=64):
+    """Forecast from day nFirstDay on, using the bootstrap replicate
+    vertices aVertices if given, else lstVertex alone. Returns a map with
+    the forecast days, the baseline (fit without the new wave), the
+    occupancy percentile bands (one row per percentile), and percentiles
+    of the next peak's day and height."""
+    lstPercentiles = lstPercentiles or lstDefaultPercentiles
+    pRandom = np.random.default_rng(nSeed)
+    aSamples = sampleWaves(lstVertex if aVertices is None else aVertices, nSamples, nLookback, pRandom)
+    aPosition, aSDev, aArea = aSamples.T
+    aHeight = aArea/(math.sqrt(2*math.pi)*aSDev)
+
+    # forecast until nearly every sampled wave has passed
+    nLastDay = int(math.ceil(np.percentile(aPosition+3*aSDev, 97.5)))
+    aDays = np.arange(nFirstDay, max(nFirstDay+1, min(nLastDay, nFirstDay+nMaxDays)), dtype=float)
+    aBaseline = baseline(lstVertex, aDays)
+
+    # occupancy percentiles a block of days at a time to bound memory, with
+    # each day's samples in a contiguous row
+    aBands = np.empty((len(lstPercentiles), len(aDays)))
+    aWidth = 2*aSDev**2
+    for nStart in range(0, len(aDays), nChunk):
+        aBlock = aDays[nStart:nStart+nChunk, None]
+        aWave = aHeight*np.exp(-(aBlock-aPosition)**2/aWidth)
+        aBands[:, nStart:nStart+nChunk] = rowPercentiles(aWave, lstPercentiles)+aBaseline[nStart:nStart+nChunk]
+
+    aPeakHeight = aHeight+baseline(lstVertex, aPosition)
+    return {"days": aDays, "baseline": aBaseline, "percentiles": list(lstPercentiles), "bands": aBands,
+            "peak_day": np.percentile(aPosition, lstPercentiles), "peak_height": np.percentile(aPeakHeight, lstPercentiles),
+            "samples": nSamples, "replicates": 1 if aVertices is None else len(aVertices)}
+
+def forecast(strFilename, nSamples=20000, nLookback=4, bBootstrap=False, lstPercentiles=None, nSeed=None):
+    """Forecast from the fit files of strFilename, starting the day after
+    the data ends, and with bBootstrap from the replicates saved by
+    bootstrap.py. Also returns the start date under "start"."""
+    lstVertex, pStartDate = readFitVertex(strFilename)
+    aVertices = None
+    if bBootstrap:
+        aVertices = np.load(strFilename.replace(".csv", "_bootstrap.npy"))
+    mapForecast = forecastNextWave(lstVertex, len(loadSeries(strFilename)), aVertices, nSamples, nLookback, lstPercentiles, nSeed=nSeed)
+    mapForecast["start"] = pStartDate
+    return mapForecast
+
+def writeForecast(strFilename, mapForecast):
+    """Write the occupancy bands to _forecast.csv, with the peak day and
+    height percentiles in the header"""
+    strForecastFile = strFilename.replace(".csv", "_forecast.csv")
+    pStartDate = mapForecast["start"]
+    lstPercentiles = mapForecast["percentiles"]
+    with open(strForecastFile, "w") as outFile:
+        outFile.write("# "+str(pStartDate.date())+"\n")
+        outFile.write("# samples: "+str(mapForecast["samples"])+" replicates: "+str(mapForecast["replicates"])+"\n")
+        outFile.write("# peak date "+" ".join(str((pStartDate+timedelta(days=float(fDay))).date()) for fDay in mapForecast["peak_day"])+"\n")
+        outFile.write("# peak height "+" ".join(map(str, mapForecast["peak_height"]))+"\n")
+        outFile.write("# Day Baseline "+" ".join("P"+str(nPercentile) for nPercentile in lstPercentiles)+"\n")
+        np.savetxt(outFile, np.column_stack([mapForecast["days"], mapForecast["baseline"], mapForecast["bands"].T]),
+                   fmt=["%d"]+["%.6f"]*(len(lstPercentiles)+1))
+    print("Forecast written to:", strForecastFile)
+    return strForecastFile
+
+if __name__ == "__main__":
+    pParser = argparse.ArgumentParser(prog="python3 forecast.py", description="Monte Carlo forecast bands for the next wave from the fitted waves")
+    pParser.add_argument("filename", help="File to process (must end in .csv)", nargs="?", default="can_hosp_patients.csv")
+    pParser.add_argument("--samples", "-n", help="Number of sampled next waves, default is 20000", default=20000, type=int)
+    pParser.add_argument("--lookback", "-l", help="Waves the statistics are taken from, default is 4", default=4, type=int)
+    pParser.add_argument("--bootstrap", "-b", action="store_true", help="Sample over the replicate fits saved by bootstrap.py")
+    pParser.add_argument("--seed", "-s", help="Random seed, for repeatable bands", default=None, type=int)
+    pArgs = pParser.parse_args(sys.argv[1:])
+
+    if not pArgs.filename.endswith(".csv"):
+        print("BAD FILENAME: MUST END IN .csv:", pArgs.filename)
+        sys.exit(-1)
+
+    fStart = time.perf_counter()
+    mapForecast = forecast(pArgs.filename, pArgs.samples, pArgs.lookback, pArgs.bootstrap, nSeed=pArgs.seed)
+    print("Forecast time (s):", time.perf_counter()-fStart)
+    pStartDate = mapForecast["start"]
+    for strName, fnFormat in [("peak_day", lambda fDay: (pStartDate+timedelta(days=float(fDay))).date()), ("peak_height", lambda fHeight: round(fHeight))]:
+        print(strName, " ".join("P"+str(nPercentile)+": "+str(fnFormat(fValue)) for nPercentile, fValue in zip(mapForecast["percentiles"], mapForecast[strName])))
+    writeForecast(pArgs.filename, mapForecast)
@@ -3,37 +3,42 @@ from datetime import datetime
 import os.path
 import sys
 from time import strftime
+
+import numpy as np
 from PIL import Image
 
 nRowSize = 2
 nMargin = 0
 
-def generateMontage(lstFilenames, strOutput):
-    lstImages = [Image.open(strFilename) for strFilename in lstFilenames]
-
-    nWidth = max(pImage.size[0] + nMargin for pImage in lstImages)*nRowSize#//2
-    nHeight = sum(pImage.size[1] + nMargin for pImage in lstImages)#//2
-    pMontage = Image.new(mode='RGBA', size=(nWidth, nHeight), color=(0,0,0,0))
-
-    nMaxX = 0
-    nMaxY = 0
-    nOffsetX = 0
-    nOffsetY = 0
-    for nI, pImage in enumerate(lstImages):
-#        pImage.thumbnail((pImage.size[0]//2, pImage.size[1]//2), Image.Resampling.LANCZOS)
-        pMontage.paste(pImage, (nOffsetX, nOffsetY))
-
-        nMaxX = max(nMaxX, nOffsetX + pImage.size[0])
-        nMaxY = max(nMaxY, nOffsetY + pImage.size[1])
-
-        if nI % nRowSize == nRowSize-1:
-            nOffsetY = nMaxY + nMargin
-            nOffsetX = 0
-        else:
-            nOffsetX += nMargin + pImage.size[0]
-
-    pMontage = pMontage.crop((0, 0, nMaxX, nMaxY))
+def montageLayout(lstSizes):
+    """Top-left corner of each image, placing nRowSize images per row with
+    each row starting below the tallest image of the row above, and the
+    size of the whole montage"""
+    lstOffsets = []
+    nWidth = 0
+    nHeight = 0
+    for nRow in range(0, len(lstSizes), nRowSize):
+        nOffsetX = 0
+        for nImageWidth, nImageHeight in lstSizes[nRow:nRow+nRowSize]:
+            lstOffsets.append((nOffsetX, nHeight))
+            nOffsetX += nImageWidth + nMargin
+        nWidth = max(nWidth, nOffsetX - nMargin)
+        nHeight += max(nImageHeight for nImageWidth, nImageHeight in lstSizes[nRow:nRow+nRowSize]) + nMargin
+    return lstOffsets, (nWidth, max(nHeight - nMargin, 0))
+
+def composeMontage(lstImages, strOutput):
+    """Paste images (PIL images or RGBA arrays, e.g. from a matplotlib
+    canvas) into a canvas of exactly the final size and encode it once"""
+    lstImages = [pImage if isinstance(pImage, Image.Image) else Image.fromarray(np.asarray(pImage)) for pImage in lstImages]
+    lstOffsets, tSize = montageLayout([pImage.size for pImage in lstImages])
+    pMontage = Image.new(mode='RGBA', size=tSize, color=(0,0,0,0))
+    for pImage, tOffset in zip(lstImages, lstOffsets):
+        pMontage.paste(pImage, tOffset)
     pMontage.save(strOutput)
+    return strOutput
+
+def generateMontage(lstFilenames, strOutput):
+    return composeMontage([Image.open(strFilename) for strFilename in lstFilenames], strOutput)
 
 if __name__ == '__main__':
     strToday = str(datetime.today().date())
@@ -0,0 +1,223 @@
+"""
+Instrumentation for pipeline runs. Each stage run inside stage() records
+its wall and CPU time (including worker processes that have exited), how
+many times the PeaksObjective, JointObjective and SeirsModelObjective
+methods were called, and the value after each iteration of every
+minimization, taken from the minimizer itself: the simplex's history of
+best vertices, or the Levenberg-Marquardt sum of squares as an RMS. Calls made in forked
+worker processes are counted in shared memory and reported separately
+as well as in the totals; their traces stay in the workers. A stage can
+also be run under cProfile or tracemalloc. The results are written as a
+JSON run report and the traces can be plotted as convergence curves.
+"""
+import argparse
+import cProfile
+from contextlib import contextmanager
+from datetime import datetime
+import functools
+import json
+import math
+import multiprocessing
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import simple_minimizer as sm
+
+from joint_fit import JointObjective
+from levenberg_marquardt import LevenbergMarquardt
+from peaks_objective import PeaksObjective
+from seirs_model_objective import SeirsModelObjective
+
+def childrenTime():
+    """CPU time of waited-for child processes, e.g. a finished worker pool"""
+    pTimes = os.times()
+    return pTimes.children_user+pTimes.children_system
+
+# methods that are counted
+lstCounted = [(PeaksObjective, "__call__"), (PeaksObjective, "batch"), (PeaksObjective, "residuals"),
+              (PeaksObjective, "jacobian"), (JointObjective, "__call__"), (JointObjective, "residuals"),
+              (JointObjective, "jacobian"), (SeirsModelObjective, "__call__")]
+
+def levenbergMarquardtTrace(pMinimizer):
+    """RMS after each accepted iteration, as PeaksObjective computes it,
+    from the sums of squares"""
+    return [math.sqrt(fSum/max(pMinimizer.nResiduals-1, 1)) for fSum in pMinimizer.lstTrace]
+
+def simplexTrace(pMinimizer):
+    """Value of each new best vertex"""
+    lstValues = []
+    for pVertex in pMinimizer.getVertices():
+        if not lstValues or pVertex.getValue() != lstValues[-1]:
+            lstValues.append(pVertex.getValue())
+    return lstValues
+
+# minimizers whose convergence is traced, and how to read their traces
+lstTraced = [(LevenbergMarquardt, levenbergMarquardtTrace), (sm.SimpleMinimizer, simplexTrace)]
+
+class Instrumentation:
+
+    def __init__(self, bProfile=False, bMemory=False, strProfilePrefix="profile", nTopFunctions=15):
+        """With bProfile each stage runs under cProfile, its stats are saved
+        to strProfilePrefix_<stage>.prof and the nTopFunctions by
+        cumulative time go in the report. With bMemory the peak traced
+        allocation of each stage is recorded."""
+        self.bProfile = bProfile
+        self.bMemory = bMemory
+        self.strProfilePrefix = strProfilePrefix
+        self.nTopFunctions = nTopFunctions
+        self.lstStages = []
+        self.lstSkipped = []
+        self.mapCurrent = None
+        self.lstPatched = []
+        self.nPid = os.getpid()
+        self.aWorkerCalls = None # counts from forked workers, one per lstCounted method
+        self.strStarted = datetime.now().isoformat(timespec="seconds")
+        self.fStart = time.perf_counter()
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *lstException):
+        self.remove()
+        return False
+
+    def install(self):
+        """Wrap the counted objective methods and the traced minimizers.
+        Worker processes forked after this count into shared memory."""
+        self.aWorkerCalls = multiprocessing.Array("q", len(lstCounted))
+        for nSlot, (pClass, strMethod) in enumerate(lstCounted):
+            fnOriginal = pClass.__dict__[strMethod]
+            setattr(pClass, strMethod, self.wrap(pClass.__name__+"."+strMethod, nSlot, fnOriginal))
+            self.lstPatched.append((pClass, strMethod, fnOriginal))
+        for pClass, fnTrace in lstTraced:
+            fnOriginal = pClass.__dict__["minimize"]
+            setattr(pClass, "minimize", self.wrapMinimize(fnOriginal, fnTrace))
+            self.lstPatched.append((pClass, "minimize", fnOriginal))
+
+    def remove(self):
+        for pClass, strMethod, fnOriginal in reversed(self.lstPatched):
+            setattr(pClass, strMethod, fnOriginal)
+        self.lstPatched = []
+
+    def wrap(self, strKey, nSlot, fnMethod):
+        @functools.wraps(fnMethod)
+        def fnCounted(pObjective, *lstArgs, **mapArgs):
+            if os.getpid() != self.nPid: # a forked worker
+                with self.aWorkerCalls.get_lock():
+                    self.aWorkerCalls[nSlot] += 1
+            elif self.mapCurrent is not None:
+                mapCalls = self.mapCurrent["calls"]
+                mapCalls[strKey] = mapCalls.get(strKey, 0)+1
+            return fnMethod(pObjective, *lstArgs, **mapArgs)
+        return fnCounted
+
+    def wrapMinimize(self, fnMinimize, fnTrace):
+        @functools.wraps(fnMinimize)
+        def fnTraced(pMinimizer, *lstArgs, **mapArgs):
+            tResult = fnMinimize(pMinimizer, *lstArgs, **mapArgs)
+            if os.getpid() == self.nPid and self.mapCurrent is not None:
+                self.mapCurrent["traces"].append({"minimizer": type(pMinimizer).__name__, "objective": type(pMinimizer.pObjective).__name__,
+                                                  "iterations": tResult[0], "values": [float(fValue) for fValue in fnTrace(pMinimizer)]})
+            return tResult
+        return fnTraced
+
+    def workerCalls(self):
+        """Calls counted in worker processes so far, by method"""
+        return {pClass.__name__+"."+strMethod: self.aWorkerCalls[nSlot] for nSlot, (pClass, strMethod) in enumerate(lstCounted)}
+
+    def skipped(self, strName):
+        self.lstSkipped.append(strName)
+
+    @contextmanager
+    def stage(self, strName):
+        """Instrument the code run inside the with block as stage strName"""
+        mapStage = {"name": strName, "calls": {}, "worker_calls": {}, "traces": []}
+        self.mapCurrent = mapStage
+        mapWorkerCalls = self.workerCalls() if self.aWorkerCalls is not None else {}
+        if self.bMemory:
+            tracemalloc.start()
+        pProfile = None
+        if self.bProfile:
+            pProfile = cProfile.Profile()
+            pProfile.enable()
+        fWall, fCpu, fChildren = time.perf_counter(), time.process_time(), childrenTime()
+        try:
+            yield mapStage
+        finally:
+            mapStage["wall"] = time.perf_counter()-fWall
+            mapStage["cpu"] = time.process_time()-fCpu
+            mapStage["children_cpu"] = childrenTime()-fChildren
+            if self.aWorkerCalls is not None:
+                for strKey, nCalls in self.workerCalls().items():
+                    if nCalls > mapWorkerCalls[strKey]:
+                        mapStage["worker_calls"][strKey] = nCalls-mapWorkerCalls[strKey]
+                        mapStage["calls"][strKey] = mapStage["calls"].get(strKey, 0)+nCalls-mapWorkerCalls[strKey]
+            if pProfile is not None:
+                pProfile.disable()
+                strProfile = self.strProfilePrefix+"_"+strName+".prof"
+                pProfile.dump_stats(strProfile)
+                mapStage["profile"] = strProfile
+                mapStage["hot"] = self.hotFunctions(pProfile)
+            if self.bMemory:
+                mapStage["memory_peak"] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            self.mapCurrent = None
+            self.lstStages.append(mapStage)
+
+    def hotFunctions(self, pProfile):
+        """The functions with the most cumulative time"""
+        pStats = pstats.Stats(pProfile)
+        lstRows = []
+        for (strFile, nLine, strFunction), (nPrimitive, nCalls, fTotal, fCumulative, mapCallers) in pStats.stats.items():
+            lstRows.append({"function": os.path.basename(strFile)+":"+str(nLine)+"("+strFunction+")",
+                            "calls": nCalls, "tottime": fTotal, "cumtime": fCumulative})
+        lstRows.sort(key=lambda mapRow: -mapRow["cumtime"])
+        return lstRows[:self.nTopFunctions]
+
+    def report(self):
+        return {"started": self.strStarted, "wall": time.perf_counter()-self.fStart,
+                "stages": self.lstStages, "skipped": self.lstSkipped}
+
+    def writeReport(self, strFilename):
+        with open(strFilename, "w") as outFile:
+            json.dump(self.report(), outFile, indent=1)
+        print("Run report written to:", strFilename)
+
+def plotConvergence(mapReport, strFilename):
+    """Plot the value against iterations for every traced minimization in
+    a run report, returning the image filename"""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    pFigure, pPlot = plt.subplots()
+    pPlot.set_title("Objective Convergence")
+    pPlot.set_xlabel("Iterations")
+    pPlot.set_ylabel("Value")
+    pPlot.set_yscale("log")
+    pPlot.grid(linewidth=0.2)
+    for mapStage in mapReport["stages"]:
+        for mapTrace in mapStage["traces"]:
+            if not mapTrace["values"]:
+                continue
+            pPlot.plot(np.arange(len(mapTrace["values"])), mapTrace["values"], marker=".", markersize=3,
+                       label=mapStage["name"]+" "+mapTrace["objective"]+" ("+mapTrace["minimizer"]+")")
+    pPlot.legend(loc="upper right")
+    pFigure.savefig(strFilename)
+    plt.close(pFigure)
+    print("Convergence plot written to:", strFilename)
+    return strFilename
+
+if __name__ == "__main__":
+    pParser = argparse.ArgumentParser(prog="python3 instrumentation.py", description="Plot the convergence curves from a run report")
+    pParser.add_argument("report", help="Run report written by decompose_can_covid_hosp_data.py --report")
+    pParser.add_argument("--output", "-o", help="Image file, default is the report name with .png", default="")
+    pArgs = pParser.parse_args(sys.argv[1:])
+
+    with open(pArgs.report) as inFile:
+        plotConvergence(json.load(inFile), pArgs.output or os.path.splitext(pArgs.report)[0]+".png")
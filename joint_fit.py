@@ -0,0 +1,222 @@
+"""
+Joint fit of several occupancy series of the same epidemic, e.g.
+hospitalized, ICU and ventilated patients. All series share each wave's
+position and width but have their own wave heights and linear ramp, so
+the vertex is the slope of every series followed, for each wave, by its
+height in every series, its position and its width (with one series,
+the layout of PeaksObjective). The Gaussians are
+computed once for all series and the fits of every series come from one
+matrix product, so a joint fit with the analytic jacobian costs about the
+same as fitting one series. Each series is scaled by its largest value so
+the small ICU and ventilator counts pull on the shared positions as much
+as the hospital counts. Every series gets the usual _parameters.csv,
+_fit.csv and _diff.csv files.
+"""
+import argparse
+from datetime import datetime, timedelta
+import math
+import sys
+import time
+
+import numpy as np
+
+import simple_minimizer as sm
+from extract_hospitalized import extractColumns, mapOccupancyColumns
+from fit_cache import FitCache, cacheDirectory
+from levenberg_marquardt import LevenbergMarquardt, mapConvergenceReasons
+from peak_finder import PeakFinder
+from peak_fitter import lstBackends, writePeakFiles
+from peaks_objective import PeaksObjective, fBadValue
+from run_history import recordPeaks
+from time_series import loadSeries
+
+lstDefaultFiles = ["can_hosp_patients.csv", "can_icu_patients.csv", "can_vent_patients.csv"]
+
+class JointObjective:
+
+    def __init__(self, lstFilenames, nMaxDay=-1, bNormalize=True):
+        """Series from lstFilenames, padded with NaN to the longest. With
+        bNormalize each series' residuals are divided by its largest value."""
+        lstSeries = [loadSeries(strFilename, nMaxDay) for strFilename in lstFilenames]
+        self.strStartDate = lstSeries[0].strStartDate
+        nDays = max(len(pSeries) for pSeries in lstSeries)
+        self.aSeries = np.full((len(lstSeries), nDays), np.nan) # one row per series, NaN for gaps
+        for nSeries, pSeries in enumerate(lstSeries):
+            self.aSeries[nSeries, :len(pSeries)] = pSeries.aValues
+        self.nSeries = len(lstSeries)
+
+        self.aDays = np.arange(nDays, dtype=float)
+        self.aValid = np.isfinite(self.aSeries)
+        self.aData = self.aSeries[self.aValid] # valid days of every series, series by series
+        self.aScales = np.ones(self.nSeries)
+        if bNormalize:
+            self.aScales = 1/np.maximum(np.nanmax(self.aSeries, axis=1), 1.0)
+        self.aRowScales = np.broadcast_to(self.aScales[:, None], self.aSeries.shape)[self.aValid]
+        self.lstValidDays = [np.flatnonzero(aValid) for aValid in self.aValid]
+        self.aBlocks = np.concatenate([[0], np.cumsum(self.aValid.sum(axis=1))]) # first residual of each series
+
+    def split(self, lstX):
+        """Slopes (series), positions and widths (waves) and heights
+        (series, waves) of a vertex"""
+        aX = np.asarray(lstX, dtype=float)
+        aWaves = aX[self.nSeries:].reshape(-1, self.nSeries+2)
+        return aX[:self.nSeries], aWaves[:, self.nSeries], aWaves[:, self.nSeries+1], aWaves[:, :self.nSeries].T
+
+    def evaluate(self, aDays, lstX):
+        """Fit of every series on the given days, one row per series"""
+        aSlopes, aPositions, aWidths, aHeights = self.split(lstX)
+        with np.errstate(over="ignore", divide="ignore", invalid="ignore"):
+            aGaussians = np.exp(-(aDays-aPositions[:, None])**2/aWidths[:, None])
+            return aSlopes[:, None]*aDays+aHeights @ aGaussians
+
+    def residuals(self, lstX):
+        """Scaled fit minus data on the valid days of every series"""
+        return (self.evaluate(self.aDays, lstX)[self.aValid]-self.aData)*self.aRowScales
+
+    def __call__(self, lstX):
+        aResidual = self.residuals(lstX)
+        with np.errstate(over="ignore", invalid="ignore"):
+            fError = math.sqrt(np.dot(aResidual, aResidual)/(len(self.aData)-1))
+        if not math.isfinite(fError): # e.g. zero or negative width
+            return fBadValue
+        return fError
+
+    def jacobian(self, lstX):
+        """Analytic derivatives of the residuals with respect to the
+        slopes and each wave's heights, position and width"""
+        aSlopes, aPositions, aWidths, aHeights = self.split(lstX)
+        nWaves = len(aPositions)
+        aDelta = self.aDays-aPositions[:, None]
+        with np.errstate(over="ignore", divide="ignore", invalid="ignore"):
+            aExp = np.exp(-aDelta**2/aWidths[:, None])
+        aScaled = aHeights[:, :, None]*aExp/aWidths[None, :, None] # (series, waves, days)
+
+        # built transposed, the rows of each series being one contiguous
+        # block of the residuals
+        aTransposed = np.zeros((self.nSeries+nWaves*(self.nSeries+2), len(self.aData)))
+        aWaves = aTransposed[self.nSeries:].reshape(nWaves, self.nSeries+2, len(self.aData))
+        for nSeries, aValidDays in enumerate(self.lstValidDays):
+            pBlock = slice(self.aBlocks[nSeries], self.aBlocks[nSeries+1])
+            fScale = self.aScales[nSeries]
+            aSeriesDelta = aDelta[:, aValidDays]
+            aSeriesScaled = aScaled[nSeries][:, aValidDays]*fScale
+            aTransposed[nSeries, pBlock] = self.aDays[aValidDays]*fScale
+            aWaves[:, nSeries, pBlock] = aExp[:, aValidDays]*fScale
+            aWaves[:, self.nSeries, pBlock] = 2*aSeriesDelta*aSeriesScaled
+            aWaves[:, self.nSeries+1, pBlock] = aSeriesDelta**2*aSeriesScaled/aWidths[:, None]
+        return aTransposed.T
+
+    def seriesVertex(self, lstX, nSeries):
+        """Vertex of one series in the slope, height, position, width
+        layout of PeaksObjective"""
+        aSlopes, aPositions, aWidths, aHeights = self.split(lstX)
+        return [float(aSlopes[nSeries])]+np.column_stack([aHeights[nSeries], aPositions, aWidths]).ravel().tolist()
+
+    def seriesErrors(self, lstX):
+        """RMS error of each series in its own units"""
+        aResidual = np.where(self.aValid, self.evaluate(self.aDays, lstX)-np.nan_to_num(self.aSeries), 0.0)
+        return np.sqrt((aResidual**2).sum(axis=1)/np.maximum(self.aValid.sum(axis=1)-1, 1))
+
+def jointStarts(pObjective, strFilename, nMaxDay=-1):
+    """Starting vertex and simplex scales as in peak_fitter.findStarts,
+    from the waves the peak finder sees in strFilename (the first series).
+    The other series' heights are the first series' height scaled by the
+    ratio of their data to its data at the wave position."""
+    lstPeaks, bExtrapolated = PeakFinder(strFilename, nMaxDay).findPeaks()
+    if bExtrapolated:
+        lstPeaks = lstPeaks[:-1] # do not fit extrapolated last peak (fits badly)
+    aFilled = np.array([np.interp(pObjective.aDays, pObjective.aDays[aValid], aRow[aValid]) for aRow, aValid in zip(pObjective.aSeries, pObjective.aValid)])
+    lstStarts = [0.1]*pObjective.nSeries
+    lstScales = [0.01]*pObjective.nSeries
+    for fPosition, fHeight in lstPeaks:
+        nDay = min(max(int(round(fPosition)), 0), len(pObjective.aDays)-1)
+        aRatios = np.maximum(aFilled[:, nDay], 1.0)/max(aFilled[0, nDay], 1.0)
+        lstStarts.extend((fHeight*aRatios).tolist())
+        lstStarts.extend([fPosition, 1800]) # about 30 days sdev => w = 2*sdev**2 = 1800
+        lstScales.extend([10]*pObjective.nSeries+[1000, 10]) # the scales of findStarts
+    return lstStarts, lstScales
+
+def jointBounds(nSeries, nParameters, nDays):
+    """Bounds as in peak_fitter.peakBounds for the joint vertex"""
+    lstLower = [-math.inf]*nSeries
+    lstUpper = [math.inf]*nSeries
+    for nWave in range(nSeries, nParameters, nSeries+2):
+        lstLower.extend([-math.inf]*nSeries+[-nDays, 2.0]) # sdev of at least one day
+        lstUpper.extend([math.inf]*nSeries+[2*nDays, 2.0*nDays**2])
+    return lstLower, lstUpper
+
+def fitJoint(lstFilenames=None, nMaxDay=-1, strBackend="lm", bCache=True, bNormalize=True, nHorizon=99, fMinimum=10.0):
+    """Fit the series of lstFilenames jointly, write the fit files of each
+    series and return the joint vertex"""
+    lstFilenames = lstFilenames or lstDefaultFiles
+    pObjective = JointObjective(lstFilenames, nMaxDay, bNormalize)
+
+    pCache = FitCache(cacheDirectory(lstFilenames[0])) if bCache else None
+    mapConfig = {"backend": strBackend, "joint": len(lstFilenames), "normalize": bNormalize}
+    mapEntry = pCache.lookup(pObjective.aSeries, mapConfig) if pCache else None
+    if mapEntry:
+        print("Input unchanged, using cached fit from:", pCache.strDirectory)
+        lstVertex = mapEntry["vertex"]
+    else:
+        lstStarts, lstScales = jointStarts(pObjective, lstFilenames[0], nMaxDay)
+        if strBackend == "lm":
+            pMinimizer = LevenbergMarquardt(len(lstStarts))
+            pMinimizer.setBounds(*jointBounds(pObjective.nSeries, len(lstStarts), len(pObjective.aDays)))
+        elif strBackend == "simplex":
+            print("Fitting... this may take several minutes...")
+            pMinimizer = sm.SimpleMinimizer(len(lstStarts))
+            pMinimizer.setScales(lstScales)
+            pMinimizer.setMinimumScale(1E-6)
+        else:
+            raise ValueError("Unknown fitting backend: "+strBackend)
+        pMinimizer.setObjective(pObjective)
+        pMinimizer.setStarts(lstStarts)
+        fStart = time.perf_counter()
+        nCount, pResult, nReason = pMinimizer.minimize()
+        lstVertex = pResult.getVertex()
+        print("Iterations:", nCount)
+        print("Wall time (s):", time.perf_counter()-fStart)
+        print("Reason for termination:", mapConvergenceReasons[nReason])
+        if pCache:
+            pCache.store(pObjective.aSeries, mapConfig, lstVertex, pResult.getValue())
+
+    nYear, nMonth, nDay = map(int, pObjective.strStartDate.split("-"))
+    pStartDate = datetime(nYear, nMonth, nDay)
+    aSlopes, aPositions, aWidths, aHeights = pObjective.split(lstVertex)
+    print("Joint RMS Error (scaled): ", pObjective(lstVertex))
+    print("Wave Date Position SDev Heights")
+    for nWave in range(len(aPositions)):
+        print(nWave+1, (pStartDate+timedelta(days=aPositions[nWave])).date(), aPositions[nWave], math.sqrt(aWidths[nWave]/2), *aHeights[:, nWave])
+    print("")
+
+    for nSeries, (strFilename, fError) in enumerate(zip(lstFilenames, pObjective.seriesErrors(lstVertex))):
+        print("Series:", strFilename, "RMS Error:", fError)
+        lstSeriesVertex = pObjective.seriesVertex(lstVertex, nSeries)
+        writePeakFiles(strFilename, PeaksObjective(strFilename, nMaxDay), lstSeriesVertex, nHorizon, fMinimum)
+        if not mapEntry:
+            recordPeaks(strFilename, lstSeriesVertex, fError, mapConfig, nMaxDay)
+    return lstVertex
+
+if __name__ == "__main__":
+    pParser = argparse.ArgumentParser(prog="python3 joint_fit.py", description="Fit hospitalized, ICU and ventilated series with shared wave positions and widths")
+    pParser.add_argument("filenames", help="Series files to fit, the first one used to find the waves, default is "+" ".join(lstDefaultFiles), nargs="*", default=lstDefaultFiles)
+    pParser.add_argument("--extract", "-e", help="First extract the "+", ".join(mapOccupancyColumns)+" columns of this source file into the series files", default="")
+    pParser.add_argument("--maxday", "-m", help="Maximum day number to process, default is all", default=-1, type=int)
+    pParser.add_argument("--backend", "-b", help="Fitting backend: lm (default) or simplex", default="lm", choices=lstBackends)
+    pParser.add_argument("--nocache", "-n", action="store_true", help="Always refit from scratch, ignoring and not updating the fit cache")
+    pParser.add_argument("--raw", action="store_true", help="Fit the counts as they are rather than scaling each series by its largest value")
+    pArgs = pParser.parse_args(sys.argv[1:])
+
+    for strFilename in pArgs.filenames:
+        if not strFilename.endswith(".csv"):
+            print("BAD FILENAME: MUST END IN .csv:", strFilename)
+            sys.exit(-1)
+
+    if pArgs.extract:
+        if len(pArgs.filenames) > len(mapOccupancyColumns):
+            print("Can only extract", len(mapOccupancyColumns), "series:", ", ".join(mapOccupancyColumns))
+            sys.exit(-1)
+        lstColumns = list(mapOccupancyColumns)[:len(pArgs.filenames)]
+        pLastDate = extractColumns(pArgs.extract, lstColumns, pArgs.filenames)
+        print("Extracted", ", ".join(lstColumns), "to:", " ".join(pArgs.filenames), "last date with data:", pLastDate.date())
+    fitJoint(pArgs.filenames, pArgs.maxday, pArgs.backend, not pArgs.nocache, not pArgs.raw)
@@ -0,0 +1,200 @@
+import math
+
+import numpy as np
+
+from simple_minimizer import SimpleVertex
+
+mapConvergenceReasons = {-1: "Exceeded iteration limit", 1: "Closest points indistinguishable",
+                                                 2: "Met fractional tolerance", 3:"Minimum scale achieved"}
+
+class LevenbergMarquardt:
+    """
+    Levenberg-Marquardt least-squares minimizer with the same calling
+    conventions as simple_minimizer.SimpleMinimizer. The objective must
+    provide residuals(lstX) returning an array of residuals and
+    jacobian(lstX) returning the (residual, parameter) derivative matrix.
+    The damping is scaled by the diagonal of J^T J, so parameters with
+    wildly different scales (slope vs area vs width) are handled without
+    user-supplied scales.
+    """
+
+    def __init__(self, nDimension):
+
+        # The dimension of the space we are working in
+        self.nDimension = nDimension
+
+        # The thing we are minimizing
+        self.pObjective = None
+
+        # The starting point
+        self.lstStarts = [0.0 for nI in range(nDimension)]
+
+        # The axes we are allowed to move along (None means all of them)
+        self.lstFree = None
+
+        # Box constraints, trial points are clipped to these (None means unbounded)
+        self.lstLower = None
+        self.lstUpper = None
+
+        # The damping parameter and the factors used to adjust it
+        self.fLambda = 1E-3
+        self.fLambdaDown = 0.3
+        self.fLambdaUp = 4.0
+        self.fMaxLambda = 1E16
+
+        # Stop when the fractional change in the sum of squares is this small
+        self.fFractionalTolerance = 1E-10
+
+        # Stop when the step is this small relative to the parameters
+        self.fMinimumScale = 1E-10
+
+        # The maximum number of iterations before giving up
+        self.nMaxIterations = 500
+
+        # Sum of squares after each accepted iteration
+        self.lstTrace = []
+
+        # Number of residual evaluations in the last minimization, and the
+        # number of residuals
+        self.nEvaluations = 0
+        self.nResiduals = 0
+
+        # Damping parameter and per-axis damping scales to resume from, and
+        # after minimizing those it ended with (None to start afresh)
+        self.tState = None
+
+    # Objective is what we are minimizing
+    def setObjective(self, pObjective):
+        self.pObjective = pObjective
+
+    # Set the starting position on all axes
+    def setStarts(self, lstStarts):
+        self.lstStarts = list(lstStarts)
+
+    # Restrict minimization to the given axes, all others are held fixed
+    def setFree(self, lstFree):
+        self.lstFree = lstFree
+
+    # Constrain each axis to lie between the lower and upper values
+    def setBounds(self, lstLower, lstUpper):
+        self.lstLower = lstLower
+        self.lstUpper = lstUpper
+
+    # Resume from the damping an earlier minimization ended with (see getState)
+    def setState(self, tState):
+        self.tState = tState
+
+    # The damping the last minimization ended with
+    def getState(self):
+        return self.tState
+
+    # Determines when we are close enough to minimum
+    def setFractionalTolerance(self, fFractionalTolerance):
+        self.fFractionalTolerance = fFractionalTolerance
+
+    # Set the relative step size at which to quit
+    def setMinimumScale(self, fScale):
+        self.fMinimumScale = fScale
+
+    # Set the maximum number of iterations before giving up
+    def setMaxIterations(self, nMaxIterations):
+        self.nMaxIterations = nMaxIterations
+
+    def sumOfSquares(self, aX):
+        self.nEvaluations += 1
+        aResidual = self.pObjective.residuals(aX)
+        with np.errstate(over="ignore", invalid="ignore"):
+            fSum = float(np.dot(aResidual, aResidual))
+        if math.isnan(fSum):
+            return math.inf, aResidual
+        return fSum, aResidual
+
+    def minimize(self, lstStart = None):
+        """Minimize from the starting point, returning the number of
+        iterations, a SimpleVertex holding the best point and the objective
+        value there, and the reason for stopping."""
+        if lstStart:
+            self.setStarts(lstStart)
+
+        aX = np.array(self.lstStarts, dtype=float)
+        if self.lstLower is not None:
+            aX = np.clip(aX, self.lstLower, self.lstUpper)
+        if self.lstFree is None:
+            aFree = np.arange(self.nDimension)
+        else:
+            aFree = np.array(self.lstFree, dtype=int)
+
+        self.nEvaluations = 0
+        fSum, aResidual = self.sumOfSquares(aX)
+        self.nResiduals = len(aResidual)
+        self.lstTrace = [fSum]
+        fLambda = self.fLambda
+        aDamping = None
+        if self.tState is not None:
+            fLambda, aDamping = self.tState
+        nCount = 0
+        nReason = -1
+        while nCount < self.nMaxIterations:
+            nCount += 1
+            aJacobian = self.pObjective.jacobian(aX)[:, aFree]
+            aHessian = aJacobian.T @ aJacobian
+            aGradient = aJacobian.T @ aResidual
+            # as in MINPACK the damping scale for each axis is the largest
+            # curvature seen so far, so an axis whose influence fades away
+            # (e.g. a peak drifting off the data) cannot take huge steps
+            if aDamping is None:
+                aDamping = np.diag(aHessian).copy()
+            else:
+                aDamping = np.maximum(aDamping, np.diag(aHessian))
+            aDiagonal = np.where(aDamping > 0, aDamping, 1.0) # axis has no influence on the residuals
+
+            # axes sitting on a bound and pushed against it stay put this iteration
+            aMove = np.ones(len(aFree), dtype=bool)
+            if self.lstLower is not None:
+                aMove &= ~((aX[aFree] <= np.asarray(self.lstLower)[aFree]) & (aGradient > 0))
+                aMove &= ~((aX[aFree] >= np.asarray(self.lstUpper)[aFree]) & (aGradient < 0))
+            aSubHessian = aHessian[np.ix_(aMove, aMove)]
+
+            # increase damping until we find a step that goes downhill
+            bImproved = False
+            while fLambda < self.fMaxLambda:
+                aStep = np.zeros(len(aFree))
+                try:
+                    aStep[aMove] = np.linalg.solve(aSubHessian + fLambda*np.diag(aDiagonal[aMove]), -aGradient[aMove])
+                except np.linalg.LinAlgError:
+                    fLambda *= self.fLambdaUp
+                    continue
+                aTrial = aX.copy()
+                aTrial[aFree] += aStep
+                if self.lstLower is not None:
+                    aTrial = np.clip(aTrial, self.lstLower, self.lstUpper)
+                    aStep = aTrial[aFree]-aX[aFree]
+                fTrialSum, aTrialResidual = self.sumOfSquares(aTrial)
+                if fTrialSum < fSum:
+                    bImproved = True
+                    break
+                fLambda *= self.fLambdaUp
+
+            if not bImproved: # cannot go downhill any more
+                nReason = 3
+                break
+
+            fPreviousSum = fSum
+            fStep = np.max(np.abs(aStep)/(np.abs(aX[aFree])+self.fMinimumScale))
+            aX, fSum, aResidual = aTrial, fTrialSum, aTrialResidual
+            self.lstTrace.append(fSum)
+            fLambda = max(fLambda*self.fLambdaDown, 1E-12)
+
+            if fSum == 0:
+                nReason = 1
+                break
+            elif (fPreviousSum-fSum)/fPreviousSum <= self.fFractionalTolerance:
+                nReason = 2
+                break
+            elif fStep <= self.fMinimumScale:
+                nReason = 3
+                break
+
+        self.tState = (fLambda, aDamping)
+        lstVertex = aX.tolist()
+        return (nCount, SimpleVertex(lstVertex, self.pObjective(lstVertex), 0.0), nReason)
@@ -0,0 +1,129 @@
+"""
+Loss functions for the wave fit. Each loss is written as a sum of squared
+pseudo-residuals, sign(fit-data)*sqrt(2*loss per day), so the
+Levenberg-Marquardt backend minimizes it unchanged through residuals()
+and jacobian(), the simplex minimizes the RMS of the pseudo-residuals,
+and the gradient is the jacobian transposed times the pseudo-residuals.
+transform() works elementwise on arrays of any shape, so a loss costs a
+few more vector operations than plain least squares.
+"""
+import numpy as np
+
+lstLosses = ["squares", "poisson", "negbin", "log", "huber", "tukey"]
+
+fFloor = 0.5 # smallest fitted count the count likelihoods see, flat below
+
+def safeRatio(aNumerator, aDenominator, aLimit):
+    """aNumerator/aDenominator, or aLimit where the denominator vanishes"""
+    bSmall = np.abs(aDenominator) < 1E-8
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(bSmall, aLimit, aNumerator/np.where(bSmall, 1.0, aDenominator))
+
+def signedRoot(aFit, aData, aLoss):
+    """Pseudo-residual for a per-day loss"""
+    return np.sign(aFit-aData)*np.sqrt(np.maximum(aLoss, 0.0))
+
+class SquaredLoss:
+    """Plain least squares, the fit minus the data"""
+    strName = "squares"
+
+    def transform(self, aFit, aData):
+        """Pseudo-residuals and their derivatives with respect to the fit"""
+        return aFit-aData, np.ones_like(aFit)
+
+class PoissonLoss:
+    """Poisson deviance, which weights each day by the inverse of its count
+    so the low-count tails count as much as the large peaks"""
+    strName = "poisson"
+
+    def transform(self, aFit, aData):
+        aMean = np.maximum(aFit, fFloor)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            aLog = np.where(aData > 0, aData*np.log(aData/aMean), 0.0)
+        aResidual = signedRoot(aMean, aData, 2*(aLog-(aData-aMean)))
+        return aResidual, safeRatio(1-aData/aMean, aResidual, 1/np.sqrt(aMean))*(aFit > fFloor)
+
+class NegativeBinomialLoss:
+    """Negative binomial deviance with dispersion fShape, between Poisson
+    (large fShape) and relative errors (small fShape), for overdispersed
+    counts"""
+    strName = "negbin"
+
+    def __init__(self, fShape=50.0):
+        self.fShape = fShape
+
+    def transform(self, aFit, aData):
+        aMean = np.maximum(aFit, fFloor)
+        fShape = self.fShape
+        with np.errstate(divide="ignore", invalid="ignore"):
+            aLog = np.where(aData > 0, aData*np.log(aData/aMean), 0.0)
+        aDeviance = 2*(aLog-(aData+fShape)*np.log((aData+fShape)/(aMean+fShape)))
+        aResidual = signedRoot(aMean, aData, aDeviance)
+        return aResidual, safeRatio(fShape*(aMean-aData)/(aMean*(aMean+fShape)), aResidual, 1/np.sqrt(aMean*(1+aMean/fShape)))*(aFit > fFloor)
+
+class LogLoss:
+    """Least squares on log(count+fOffset), i.e. relative errors"""
+    strName = "log"
+
+    def __init__(self, fOffset=1.0):
+        self.fOffset = fOffset
+
+    def transform(self, aFit, aData):
+        aShifted = np.maximum(aFit+self.fOffset, fFloor)
+        return np.log(aShifted)-np.log(aData+self.fOffset), (aFit+self.fOffset > fFloor)/aShifted
+
+class HuberLoss:
+    """Squares for residuals up to fDelta patients and linear beyond, so
+    reporting spikes pull on the fit with bounded force"""
+    strName = "huber"
+
+    def __init__(self, fDelta=150.0):
+        self.fDelta = fDelta
+
+    def transform(self, aFit, aData):
+        aError = aFit-aData
+        aSize = np.abs(aError)
+        bInside = aSize <= self.fDelta
+        aResidual = np.where(bInside, aError, signedRoot(aFit, aData, self.fDelta*(2*aSize-self.fDelta)))
+        return aResidual, np.where(bInside, 1.0, safeRatio(self.fDelta*np.sign(aError), aResidual, 1.0))
+
+class TukeyLoss:
+    """Tukey biweight, which ignores residuals beyond fScale patients
+    entirely. Not convex, so it is best started from a least-squares fit."""
+    strName = "tukey"
+
+    def __init__(self, fScale=500.0):
+        self.fScale = fScale
+
+    def transform(self, aFit, aData):
+        aError = aFit-aData
+        aRatio = np.minimum((aError/self.fScale)**2, 1.0)
+        aResidual = signedRoot(aFit, aData, self.fScale**2/3*(1-(1-aRatio)**3))
+        aSlope = aError*(1-aRatio)**2 # derivative of the loss per day
+        return aResidual, safeRatio(aSlope, aResidual, 1.0)
+
+mapLosses = {"squares": SquaredLoss, "poisson": PoissonLoss, "negbin": NegativeBinomialLoss,
+             "log": LogLoss, "huber": HuberLoss, "tukey": TukeyLoss}
+
+def makeLoss(strSpec):
+    """Loss from name[:parameter], e.g. huber:200, or None for plain least
+    squares, which PeaksObjective evaluates directly"""
+    strName, strColon, strParameter = strSpec.partition(":")
+    if strName not in mapLosses:
+        raise ValueError("Unknown loss: "+strName+", expected one of "+", ".join(lstLosses))
+    if strName == "squares":
+        return None
+    return mapLosses[strName](float(strParameter)) if strParameter else mapLosses[strName]()
+
+def loadWeights(strWeights, aSeries):
+    """Per-day weights for a series: "inverse" for 1/count, or a file of
+    day/weight rows with days that are not listed weighted 1"""
+    aWeights = np.ones(len(aSeries))
+    if strWeights == "inverse":
+        with np.errstate(invalid="ignore"):
+            return 1/np.maximum(np.where(np.isfinite(aSeries), aSeries, 1.0), 1.0)
+    aRows = np.loadtxt(strWeights, ndmin=2, comments="#")
+    aDays = aRows[:, 0].astype(int)
+    aInside = (aDays >= 0) & (aDays < len(aSeries))
+    aWeights[aDays[aInside]] = aRows[aInside, 1]
+    return aWeights
@@ -0,0 +1,109 @@
+"""
+Split the Health Canada data into one series per region and run the
+find, fit, SEIRS-align and plot chain for every region in parallel on a
+process pool. Each region gets its own directory under the output
+directory, with a log of the fit, and a summary table of the fitted
+wave parameters across all regions is written at the end.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout
+import os
+import re
+import sys
+import traceback
+
+from download_covid_data import download_data
+from extract_hospitalized import extractHospitalized, findRegions
+from peak_finder import scaledThreshold
+from peak_fitter import fitPeaks, lstBackends
+from seirs_model_objective import fitSeirsModel
+from plot_fit import plotFit
+from plot_parameters import plotParameters
+from generate_montage import generateMontage
+from time_series import loadSeries
+
+strURL = "https://health-infobase.canada.ca/src/data/covidLive/covid19-epiSummary-hospVentICU.csv"
+
+def regionDirectory(strRegion):
+    """Filesystem-safe directory name for a region"""
+    return re.sub(r"[^a-z0-9]+", "_", strRegion.lower()).strip("_")
+
+def readParameters(strParameterFile):
+    """Rows of Peak Date Day SDev Area from a _parameters.csv file"""
+    lstRows = []
+    with open(strParameterFile) as inFile:
+        for strLine in inFile:
+            if strLine.strip().startswith("#"): continue
+            lstRows.append(strLine.split())
+    return lstRows
+
+def fitRegion(strRegion, strSource, strOutputDir, strBackend, strModelFile):
+    """Run the full chain for one region, logging to fit.log in the region
+    directory. Returns the region, its fitted parameter rows and an error
+    message that is empty on success. The peak finder's threshold is
+    scaled to the region's size."""
+    strDir = os.path.join(strOutputDir, regionDirectory(strRegion))
+    os.makedirs(strDir, exist_ok=True)
+    strFilename = os.path.join(strDir, "can_hosp_patients.csv")
+    with open(os.path.join(strDir, "fit.log"), "w") as logFile, redirect_stdout(logFile):
+        try:
+            extractHospitalized(strSource, strFilename, strRegion)
+            fSlopeThreshold = scaledThreshold(loadSeries(strFilename).aValues)
+            print("Peak finder slope threshold:", fSlopeThreshold)
+            fitPeaks(strFilename, strBackend=strBackend, fSlopeThreshold=fSlopeThreshold)
+            fitSeirsModel(strFilename, strModelFile=strModelFile)
+            lstImages = [plotFit(strFilename, strRegion)]
+            lstImages.extend(plotParameters(strFilename.replace(".csv", "_parameters.csv"), strRegion=strRegion))
+            generateMontage(lstImages, os.path.join(strDir, "combined.png"))
+        except Exception:
+            traceback.print_exc(file=logFile)
+            return strRegion, [], traceback.format_exc().strip().split("\n")[-1]
+    return strRegion, readParameters(strFilename.replace(".csv", "_parameters.csv")), ""
+
+def fitRegions(strSource, strOutputDir="regions", nWorkers=None, strBackend="simplex", lstRegions=None, strModelFile="seirs_model.csv"):
+    """Fit every region (or those in lstRegions) across a process pool and
+    write summary.csv to the output directory. Returns a map from region to
+    its parameter rows for the regions that succeeded."""
+    if not lstRegions:
+        lstRegions = findRegions(strSource)
+    if not lstRegions:
+        print("No regions found in:", strSource)
+        return {}
+    strModelFile = os.path.abspath(strModelFile)
+    os.makedirs(strOutputDir, exist_ok=True)
+
+    mapResults = {}
+    print("Fitting", len(lstRegions), "regions with", nWorkers or os.cpu_count(), "workers")
+    with ProcessPoolExecutor(max_workers=nWorkers) as pPool:
+        lstFutures = [pPool.submit(fitRegion, strRegion, strSource, strOutputDir, strBackend, strModelFile) for strRegion in lstRegions]
+        for pFuture in as_completed(lstFutures):
+            strRegion, lstRows, strError = pFuture.result()
+            if strError:
+                print("FAILED:", strRegion, "-", strError)
+            else:
+                print("Done:", strRegion, "with", len(lstRows), "waves")
+                mapResults[strRegion] = lstRows
+
+    strSummary = os.path.join(strOutputDir, "summary.csv")
+    print("Writing summary to:", strSummary)
+    with open(strSummary, "w") as outFile:
+        outFile.write("# Region Peak Date Day SDev Area\n")
+        for strRegion in lstRegions:
+            for lstRow in mapResults.get(strRegion, []):
+                outFile.write(" ".join([regionDirectory(strRegion)]+lstRow)+"\n")
+    return mapResults
+
+if __name__ == "__main__":
+    pParser = argparse.ArgumentParser(prog="python3 multi_region.py", description="Fit every region in the Health Canada data in parallel")
+    pParser.add_argument("filename", help="Health Canada data file", nargs="?", default="canada-covid-data.csv")
+    pParser.add_argument("--download", "-d", action="store_true", help="Download the data first if it is more than 12 hours old")
+    pParser.add_argument("--output", "-o", help="Directory for per-region output, default is regions", default="regions")
+    pParser.add_argument("--workers", "-w", help="Number of worker processes, default is one per core", default=None, type=int)
+    pParser.add_argument("--backend", "-b", help="Fitting backend for the wave fit", default="simplex", choices=lstBackends)
+    pParser.add_argument("--region", "-r", help="Region to fit (may be repeated), default is all", action="append")
+    pArgs = pParser.parse_args(sys.argv[1:])
+
+    if pArgs.download:
+        download_data(strURL, pArgs.filename)
+    fitRegions(pArgs.filename, pArgs.output, pArgs.workers, pArgs.backend, pArgs.region)
@@ -0,0 +1,154 @@
+"""
+Multi-start search for the Gaussian decomposition. Many perturbed copies
+of the peak finder's starting vertex are fitted in parallel by successive
+halving: every start gets a small iteration budget, the worse half of the
+unconverged starts is dropped, and the survivors continue with double the
+budget until only a few remain, which are run to convergence. With the
+lm backend each start keeps its damping from round to round, so a round
+continues the last one's minimization; the simplex keeps no state and
+restarts from the peak finder scales every round. Converged solutions
+that are the same minimum are merged, and the best one is written out
+as by fitPeaks along with how many starts reached it.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+from peak_fitter import findStarts, minimizePeaks, writePeakFiles, lstBackends
+from peaks_objective import PeaksObjective
+from peak_finder import PeakFinder
+
+# objectives are built once per worker process and reused every round
+mapObjectives = {}
+
+def objectiveFor(strFilename, nMaxDay):
+    tKey = (strFilename, nMaxDay)
+    if tKey not in mapObjectives:
+        mapObjectives[tKey] = PeaksObjective(strFilename, nMaxDay)
+    return mapObjectives[tKey]
+
+def perturbStarts(lstStarts, nStarts, pRandom, fPositionSDev=14.0, fHeightSDev=0.3, lstSDevRange=(10.0, 45.0)):
+    """nStarts starting vertices, the first being lstStarts itself. The
+    others have each wave's position jittered by fPositionSDev days, its
+    height scaled by a log-normal factor and its SDev drawn log-uniformly
+    from lstSDevRange."""
+    aStarts = np.tile(np.asarray(lstStarts, dtype=float), (nStarts, 1))
+    nPeaks = (len(lstStarts)-1)//3
+    nOthers = nStarts-1
+    aStarts[1:, 1::3] *= np.exp(pRandom.normal(0, fHeightSDev, (nOthers, nPeaks)))
+    aStarts[1:, 2::3] += pRandom.normal(0, fPositionSDev, (nOthers, nPeaks))
+    aSDev = np.exp(pRandom.uniform(*np.log(lstSDevRange), (nOthers, nPeaks)))
+    aStarts[1:, 3::3] = 2*aSDev**2
+    return aStarts
+
+def advanceStarts(strFilename, nMaxDay, aVertices, lstStates, lstScales, strBackend, nIterations):
+    """Continue fitting each vertex for up to nIterations (None for the
+    minimizer's own limit) from its minimizer state (see minimizePeaks),
+    returning (vertex, value, converged, state) tuples"""
+    pObjective = objectiveFor(strFilename, nMaxDay)
+    lstResults = []
+    for aVertex, mapState in zip(aVertices, lstStates):
+        nCount, pResult, nReason, fSeconds = minimizePeaks(pObjective, list(aVertex), lstScales, strBackend, nMaxIterations=nIterations, mapState=mapState)
+        lstResults.append((pResult.getVertex(), pResult.getValue(), nReason != -1, mapState))
+    return lstResults
+
+def sameMinimum(lstFirst, fFirst, lstSecond, fSecond, fDayTolerance=1.0, fRelativeTolerance=1E-3):
+    """Whether two fits are the same minimum: equal error and the same
+    wave positions, whatever order the waves ended up in"""
+    if abs(fFirst-fSecond) > fRelativeTolerance*max(fFirst, fSecond):
+        return False
+    aFirst = np.sort(np.asarray(lstFirst[2::3]))
+    aSecond = np.sort(np.asarray(lstSecond[2::3]))
+    return bool(np.all(np.abs(aFirst-aSecond) <= fDayTolerance))
+
+def distinctMinima(lstResults):
+    """Group (vertex, value) results into distinct minima, best first, as
+    [vertex, value, count] lists"""
+    lstMinima = []
+    for lstVertex, fValue in sorted(lstResults, key=lambda tResult: tResult[1]):
+        for lstMinimum in lstMinima:
+            if sameMinimum(lstMinimum[0], lstMinimum[1], lstVertex, fValue):
+                lstMinimum[2] += 1
+                break
+        else:
+            lstMinima.append([lstVertex, fValue, 1])
+    return lstMinima
+
+def multiStart(strFilename, nStarts=48, nMaxDay=-1, nWorkers=None, strBackend="lm", nSeed=None, nFirstBudget=8, nKeep=4):
+    """Fit nStarts perturbed starts by successive halving, write the fit
+    files for the best minimum and return the list of distinct minima"""
+
+    lstPeaks, bExtrapolated = PeakFinder(strFilename, nMaxDay).findPeaks()
+    nFittedPeaks = len(lstPeaks)
+    if bExtrapolated:
+        nFittedPeaks -= 1 # do not fit extrapolated last peak (fits badly)
+    lstStarts, lstScales = findStarts(lstPeaks, nFittedPeaks, False)
+    aActive = perturbStarts(lstStarts, nStarts, np.random.default_rng(nSeed))
+    lstStates = [{} for nI in range(nStarts)]
+
+    nWorkers = nWorkers or os.cpu_count()
+    print("Multi-start fit of", nFittedPeaks, "waves from", nStarts, "starts with", nWorkers, "workers")
+    fStart = time.perf_counter()
+    lstFinished = []
+    nIterations = nFirstBudget
+    nRound = 1
+    with ProcessPoolExecutor(max_workers=nWorkers) as pPool:
+        while len(aActive):
+            bLast = len(aActive) <= nKeep
+            nBudget = None if bLast else nIterations
+            nChunks = min(nWorkers, len(aActive))
+            lstChunks = np.array_split(aActive, nChunks)
+            lstStateChunks = [lstStates[aIndices[0]:aIndices[-1]+1] for aIndices in np.array_split(np.arange(len(aActive)), nChunks)]
+            lstResults = []
+            for lstChunk in pPool.map(advanceStarts, [strFilename]*nChunks, [nMaxDay]*nChunks, lstChunks, lstStateChunks,
+                                      [lstScales]*nChunks, [strBackend]*nChunks, [nBudget]*nChunks):
+                lstResults.extend(lstChunk)
+
+            lstRunning = []
+            for lstVertex, fValue, bConverged, mapState in lstResults:
+                if bConverged or bLast:
+                    lstFinished.append((lstVertex, fValue))
+                else:
+                    lstRunning.append((lstVertex, fValue, mapState))
+            fBest = min(tResult[1] for tResult in lstResults)
+            print("Round", nRound, "budget", nBudget or "unlimited", "starts", len(aActive), "converged", len(lstResults)-len(lstRunning), "best RMS", fBest)
+
+            # the better half of the unconverged starts go on with twice the budget
+            lstRunning.sort(key=lambda tResult: tResult[1])
+            lstRunning = lstRunning[:max(nKeep, math.ceil(len(lstRunning)/2))]
+            aActive = np.array([lstVertex for lstVertex, fValue, mapState in lstRunning])
+            lstStates = [mapState for lstVertex, fValue, mapState in lstRunning]
+            nIterations *= 2
+            nRound += 1
+    print("Wall time (s):", time.perf_counter()-fStart)
+
+    lstMinima = distinctMinima(lstFinished)
+    lstBest, fBest, nCount = lstMinima[0]
+    print("Distinct minima: (RMS, starts)")
+    for lstVertex, fValue, nReached in lstMinima:
+        print(fValue, nReached)
+    print("Best RMS", fBest, "reached by", nCount, "of", nStarts, "starts")
+    writePeakFiles(strFilename, objectiveFor(strFilename, nMaxDay), lstBest)
+    return lstMinima
+
+if __name__ == "__main__":
+    pParser = argparse.ArgumentParser(prog="python3 multi_start.py", description="Fit waves from many perturbed starts, dropping losing starts early, and keep the best")
+    pParser.add_argument("filename", help="File to process (must end in .csv)")
+    pParser.add_argument("--starts", "-s", help="Number of starts, default is 48", default=48, type=int)
+    pParser.add_argument("--maxday", "-m", help="Maximum day number to process, default is all", default=-1, type=int)
+    pParser.add_argument("--workers", "-w", help="Number of worker processes, default is one per core", default=None, type=int)
+    pParser.add_argument("--backend", "-b", help="Fitting backend, default is lm", default="lm", choices=lstBackends)
+    pParser.add_argument("--seed", help="Random seed, for repeatable starts", default=None, type=int)
+    pParser.add_argument("--budget", help="Iterations per start in the first round, doubled each round, default is 8", default=8, type=int)
+    pArgs = pParser.parse_args(sys.argv[1:])
+
+    if not pArgs.filename.endswith(".csv"):
+        print("BAD FILENAME: MUST END IN .csv:", pArgs.filename)
+        sys.exit(-1)
+
+    multiStart(pArgs.filename, pArgs.starts, pArgs.maxday, pArgs.workers, pArgs.backend, pArgs.seed, pArgs.budget)
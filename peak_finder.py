@@ -1,82 +1,184 @@
 import argparse
+import math
 import sys
 
-class PeakFinder:
+import numpy as np
+
+from time_series import loadSeries
+
+class IncrementalPeakFinder:
     """
-    Dumb peak finder that looks for a peak, then a drop week-by-week
+    Peak finder that takes the data a day at a time. Days are summed into
+    weeks, and a week whose slope drops below -fSlopeThreshold after one
+    that rose above it marks a peak (and the reverse a dip). Only the
+    current week's sum and the last week's value and slope are kept, so
+    adding a day is O(1), and the peaks and dips so far are available at
+    any time. Peaks closer than nMergeDays are merged as noisy tops.
     """
-    def __init__(self, strFilename, nMaxDay):
-        """Read two-column space-separated data file: day data,
-        and sum the data into weeks"""
-        
-        self.lstPeaks = []
-        
-        self.lstData = []
-        self.strStartDate = ""
-        lstWeek = []
-        nCount = 0
-        with open(strFilename) as inFile:
-            for strLine in inFile:
-                if strLine.strip().startswith("#"):
-                    self.strStartDate = strLine.strip().split()[1]
-                    continue
-                lstWeek.append(float(strLine.strip().split()[1]))
-                if len(lstWeek) == 7:
-                    self.lstData.append(sum(lstWeek))
-                    lstWeek = []
-                nCount += 1
-                if nMaxDay >= 0 and nCount > nMaxDay:
-                    break
-        
-    def findPeaks(self):
-        """Find peaks. The sensitivity is the fractional drop required 
-        for the max to be a peak. Default is 0.9, so 10% drop required."""
+    def __init__(self, fSlopeThreshold=115, nMergeDays=37):
+        self.fSlopeThreshold = fSlopeThreshold
+        self.nMergeDays = nMergeDays
+
+        self.nDays = 0              # days summed into weeks so far
+        self.fWeekSum = 0.0         # sum of the current partial week
+        self.nWeeks = 0
+        self.fPreviousValue = 0.0   # last complete week's sum
+        self.fPreviousSlope = 0.0
+        self.fLastValue = math.nan  # last day with data, for filling gaps
+        self.nPending = 0           # days without data waiting for the next value
+
+        self.lstRawPeaks = []
+        self.lstDips = []
+
+    @staticmethod
+    def fromSeries(aValues, fSlopeThreshold=115, nMergeDays=37):
+        """Finder that has been given every day of aValues, with whole weeks
+        done in one pass. Gaps (NaN) are handled as addDay would: those
+        before the last value are filled by linear interpolation and those
+        after it are held back until the next value arrives."""
+        pFinder = IncrementalPeakFinder(fSlopeThreshold, nMergeDays)
+        aValues = np.asarray(aValues, dtype=float)
+        aValid = np.isfinite(aValues)
+        nEnd = int(np.nonzero(aValid)[0][-1])+1 if aValid.any() else 0
+        aPending = aValues[nEnd:]
+        aValues = aValues[:nEnd]
+        if not aValid[:nEnd].all():
+            aDays = np.arange(nEnd, dtype=float)
+            aValues = np.interp(aDays, aDays[aValid[:nEnd]], aValues[aValid[:nEnd]])
+        nWeeks = len(aValues)//7
+        if nWeeks == 0:
+            pFinder.addDays(aValues)
+            pFinder.addDays(aPending)
+            return pFinder
+
+        aWeeks = aValues[:7*nWeeks].reshape(nWeeks, 7).sum(axis=1)
+        aPrevious = np.concatenate(([0.0], aWeeks[:-1]))
+        aSlopes = aWeeks-aPrevious
+        aPreviousSlopes = np.concatenate(([0.0], aSlopes[:-1]))
+        aPositions = 7*np.arange(nWeeks)-3.5
+        aPeaks = (aSlopes < -fSlopeThreshold) & (aPreviousSlopes > fSlopeThreshold)
+        aDips = (aPreviousSlopes < -fSlopeThreshold) & (aSlopes > fSlopeThreshold)
+        pFinder.lstRawPeaks = list(zip(aPositions[aPeaks].tolist(), (aPrevious[aPeaks]/7).tolist()))
+        pFinder.lstDips = list(zip(aPositions[aDips].tolist(), (aPrevious[aDips]/7).tolist()))
+
+        pFinder.nDays = 7*nWeeks
+        pFinder.nWeeks = nWeeks
+        pFinder.fPreviousValue = float(aWeeks[-1])
+        pFinder.fPreviousSlope = float(aSlopes[-1])
+        pFinder.fLastValue = float(aValues[7*nWeeks-1])
+        pFinder.addDays(aValues[7*nWeeks:])
+        pFinder.addDays(aPending)
+        return pFinder
+
+    def addDay(self, fValue):
+        """Add the next day. Days without data (NaN) are held back until
+        the next value arrives and then filled by linear interpolation."""
+        if not math.isfinite(fValue):
+            self.nPending += 1
+            return
+        fLast = fValue if math.isnan(self.fLastValue) else self.fLastValue
+        for nI in range(1, self.nPending+1):
+            self.addFilledDay(fLast+(fValue-fLast)*nI/(self.nPending+1))
+        self.nPending = 0
+        self.fLastValue = fValue
+        self.addFilledDay(fValue)
+
+    def addDays(self, aValues):
+        for fValue in aValues:
+            self.addDay(float(fValue))
+
+    def addFilledDay(self, fValue):
+        self.fWeekSum += fValue
+        self.nDays += 1
+        if self.nDays % 7 == 0:
+            self.addWeek(self.fWeekSum)
+            self.fWeekSum = 0.0
+
+    def addWeek(self, fValue):
+        fSlope = fValue-self.fPreviousValue
+        fPosition = 7*self.nWeeks-3.5
+        if fSlope < -self.fSlopeThreshold and self.fPreviousSlope > self.fSlopeThreshold:
+            self.lstRawPeaks.append((fPosition, self.fPreviousValue/7))
+        if self.fPreviousSlope < -self.fSlopeThreshold and fSlope > self.fSlopeThreshold:
+            self.lstDips.append((fPosition, self.fPreviousValue/7))
+        self.fPreviousValue = fValue
+        self.fPreviousSlope = fSlope
+        self.nWeeks += 1
 
+    def dips(self):
+        return list(self.lstDips)
+
+    def peaks(self):
+        """Current (position, height) peaks and whether the last one is
+        extrapolated because the data has come out of the last dip. There
+        are no peaks until a complete one has been seen."""
+
+        lstPeaks = list(self.lstRawPeaks)
         bExtrapolated = False # flag to tell if we are extrapolating a new peak
-        fPreviousSlope = 0
-        fPreviousValue = 0
-        lstDips = []
-        for nWeek, fValue in enumerate(self.lstData):
-            fSlope = fValue-fPreviousValue
-            if fSlope < -115 and fPreviousSlope > 115:
-#                print("Peak: ", 7*nWeek-3.5, fSlope, fPreviousSlope)
-                self.lstPeaks.append((7*nWeek-3.5, fPreviousValue/7))
-            if fPreviousSlope < -115 and fSlope > 115:
-#                print("Dip: ", 7*nWeek-3.5, fSlope, fPreviousSlope)
-                lstDips.append((7*nWeek-3.5, fPreviousValue/7))
-            fPreviousValue = fValue
-            fPreviousSlope = fSlope
-
-        if lstDips[-1][0] > self.lstPeaks[-1][0]:   # out of the last dip so project a new peak
+        if lstPeaks and self.lstDips and self.lstDips[-1][0] > lstPeaks[-1][0]:   # out of the last dip so project a new peak
             bExtrapolated = True # flag that we are extrapolating a peak
-            if len(self.lstPeaks) > 2: # use previous inter-peak spacing added to last peak position
-                fDelta = self.lstPeaks[-1][0]-self.lstPeaks[-2][0]
-                self.lstPeaks.append((self.lstPeaks[-1][0]+fDelta, self.lstPeaks[-1][1]))
+            if len(lstPeaks) > 2: # use previous inter-peak spacing added to last peak position
+                fDelta = lstPeaks[-1][0]-lstPeaks[-2][0]
+                lstPeaks.append((lstPeaks[-1][0]+fDelta, lstPeaks[-1][1]))
             else:   # use distance from last peak to dip, added to dip position
-                fDelta = lstDips[-1][0]-self.lstPeaks[-1][0]
-                self.lstPeaks.append((lstDips[-1][0]+fDelta, self.lstPeaks[-1][1]))
-        
-        # deal with noisy peak-tops by merging any peaks within 30 days of each other
-        lstMergedPeaks = [self.lstPeaks[0]]
-        for fDay, fPeak in self.lstPeaks[1:]:
-            if fDay-lstMergedPeaks[-1][0] < 37:
+                fDelta = self.lstDips[-1][0]-lstPeaks[-1][0]
+                lstPeaks.append((self.lstDips[-1][0]+fDelta, lstPeaks[-1][1]))
+
+        # deal with noisy peak-tops by merging any peaks within nMergeDays of each other
+        lstMergedPeaks = lstPeaks[:1]
+        for fDay, fPeak in lstPeaks[1:]:
+            if fDay-lstMergedPeaks[-1][0] < self.nMergeDays:
                 lstMergedPeaks[-1] = ((fDay+lstMergedPeaks[-1][0])/2, (fPeak+lstMergedPeaks[-1][1])/2)
             else:
                 lstMergedPeaks.append((fDay, fPeak))
 
-        self.lstPeaks = lstMergedPeaks
-        
+        return lstMergedPeaks, bExtrapolated
+
+def scaledThreshold(aValues, fSlopeThreshold=115, fReferencePeak=10474):
+    """fSlopeThreshold, which suits the national series whose largest day
+    is fReferencePeak, scaled to the largest day of aValues, so a region a
+    hundredth the size finds the same waves. It is kept to at least a
+    weekly slope of one a day so counts of a few do not make peaks."""
+    fPeak = float(np.nanmax(aValues)) if np.any(np.isfinite(aValues)) else 0.0
+    return max(fSlopeThreshold*fPeak/fReferencePeak, 7.0)
+
+class PeakFinder:
+    """
+    Dumb peak finder that looks for a peak, then a drop week-by-week
+    """
+    def __init__(self, strFilename, nMaxDay, fSlopeThreshold=115, nMergeDays=37):
+        """Read two-column space-separated data file: day data,
+        and sum the data into weeks"""
+
+        self.lstPeaks = []
+
+        pSeries = loadSeries(strFilename, nMaxDay)
+        self.strStartDate = pSeries.strStartDate
+        aData = pSeries.filled() # weekly sums need every day
+        nWeeks = len(aData)//7
+        self.lstData = aData[:7*nWeeks].reshape(nWeeks, 7).sum(axis=1).tolist()
+        self.pFinder = IncrementalPeakFinder.fromSeries(aData, fSlopeThreshold, nMergeDays)
+
+    def findPeaks(self):
+        """Find peaks, returning (position, height) pairs and whether the
+        last one is extrapolated. The list is empty if there is no
+        complete peak in the data yet."""
+        self.lstPeaks, bExtrapolated = self.pFinder.peaks()
         return self.lstPeaks, bExtrapolated
 
 if __name__ == "__main__":
-    
-    pParser = argparse.ArgumentParser(prog="python3 peak_finder2.py", description="Find peaks in covid data extracted by extract_column.py")
+
+    pParser = argparse.ArgumentParser(prog="python3 peak_finder.py", description="Find peaks in covid data extracted by extract_column.py")
     pParser.add_argument("filename", help="File to process")
     pParser.add_argument("--maxday", "-m", help="Maximum day number to process (counts from Jan 23, 2020), default is all", default=-1, type=int)
+    pParser.add_argument("--threshold", "-t", help="Weekly slope either side of a peak or dip, default is 115", default=115, type=float)
+    pParser.add_argument("--merge", help="Merge peaks closer than this many days, default is 37", default=37, type=int)
 
     pArgs = pParser.parse_args(sys.argv[1:])
 
-    pPeakFinder = PeakFinder(pArgs.filename, pArgs.maxday)
-    lstPeaks = pPeakFinder.findPeaks()
+    pPeakFinder = PeakFinder(pArgs.filename, pArgs.maxday, pArgs.threshold, pArgs.merge)
+    lstPeaks, bExtrapolated = pPeakFinder.findPeaks()
     for (nDay, fPeak) in lstPeaks:
         print(nDay, fPeak)
+    if bExtrapolated:
+        print("Last peak is extrapolated")
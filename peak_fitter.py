@@ -2,62 +2,110 @@ import argparse
 from datetime import datetime, timedelta
 import math
 import sys
+import time
+
+import numpy as np
 
 import simple_minimizer as sm
+from fit_cache import FitCache, affectedAxes, cacheDirectory, hashSeries
+from levenberg_marquardt import LevenbergMarquardt
+from losses import lstLosses, loadWeights, makeLoss
 from peaks_objective import PeaksObjective
 from peak_finder import PeakFinder
+from run_history import recordPeaks
+from time_series import loadSeries
 
-mapConvergenceReasons = {-1: "Exceeded iteration limit", 1: "Closest points indistinguishable", 
+mapConvergenceReasons = {-1: "Exceeded iteration limit", 1: "Closest points indistinguishable",
                                                  2: "Met fractional tolerance", 3:"Minimum scale achieved"}
 
-def fitPeaks(strFilename, nMaxDay=-1):
-    # find peaks
-    pPeakFinder = PeakFinder(strFilename, nMaxDay)
-    lstPeaks, bExtrapolated = pPeakFinder.findPeaks()
-
-    # set up minimizer
-    nFittedPeaks = len(lstPeaks)
-    if bExtrapolated:
-        nParameters = 1 + 3*(len(lstPeaks)-1) # do not included extrapolated peak (fits badly)
-        nFittedPeaks -= 1 # do not fit last peak
-    else:
-        nParameters = 1 + 3*len(lstPeaks) # linear ramp plus width/area/position of each peak
-    pMinimizer = sm.SimpleMinimizer(nParameters)
-    pObjective = PeaksObjective(strFilename, nMaxDay)
-    pMinimizer.setObjective(pObjective)
-    pMinimizer.setMinimumScale(1E-6) # the minimum is pretty well defined
-
-    nYear, nMonth, nDay = map(int, pObjective.strStartDate.split("-"))
-    pStartDate = datetime(nYear, nMonth, nDay)
+lstBackends = ["simplex", "lm"]
 
+def findStarts(lstPeaks, nFittedPeaks, bVerbose=True):
+    """Starting vertex and simplex scales from the peak finder guesses"""
     lstStarts = [0.1]
     lstScales = [0.01]
     nPeak = 1
-    print("Starting parameters: (Position, Size Width)")
+    if bVerbose:
+        print("Starting parameters: (Position, Size Width)")
     for fPosition, fSize in lstPeaks[0:nFittedPeaks]:
-        print(nPeak, fPosition, fSize, math.sqrt(1800))
+        if bVerbose:
+            print(nPeak, fPosition, fSize, math.sqrt(1800))
         nPeak += 1
         lstStarts.append(fSize)
         lstStarts.append(fPosition)
         lstStarts.append(1800) # all peaks about 30 days sdev => w = 2*sdev**2 = 1800
         lstScales.extend([10, 1000, 10]) # reasonable default for scales
+    return lstStarts, lstScales
 
+def peakBounds(nParameters, nDays):
+    """Bounds that keep each peak's position near the data and its width
+    positive, so a peak that stops contributing cannot wander off"""
+    lstLower = [-math.inf]
+    lstUpper = [math.inf]
+    for nPeak in range(1, nParameters, 3):
+        lstLower.extend([-math.inf, -nDays, 2.0]) # sdev of at least one day
+        lstUpper.extend([math.inf, 2*nDays, 2.0*nDays**2])
+    return lstLower, lstUpper
+
+def minimizePeaks(pObjective, lstStarts, lstScales, strBackend="simplex", lstFree=None, nMaxIterations=None, mapState=None):
+    """Run the selected minimizer, returning iterations, result vertex,
+    convergence reason and wall time in seconds. If lstFree is given only
+    those axes are minimized and the rest keep their starting values, and
+    nMaxIterations overrides the minimizer's iteration limit. mapState, if
+    given, carries the lm backend's damping from one call to the next: it
+    is read before and updated after minimizing. The simplex has no state
+    to carry and always starts from lstScales."""
+    nParameters = len(lstStarts)
+    if strBackend == "lm": # analytic jacobian, does not need scales
+        pMinimizer = LevenbergMarquardt(nParameters)
+        pMinimizer.setBounds(*peakBounds(nParameters, len(pObjective.lstData)))
+        if mapState:
+            pMinimizer.setState(mapState["damping"])
+    elif strBackend == "simplex":
+        pMinimizer = sm.SimpleMinimizer(nParameters)
+        pMinimizer.setScales(lstScales)
+        pMinimizer.setMinimumScale(1E-6) # the minimum is pretty well defined
+    else:
+        raise ValueError("Unknown fitting backend: "+strBackend)
+    if lstFree is not None:
+        if strBackend == "lm":
+            pMinimizer.setFree(lstFree)
+        else:
+            pMinimizer.setOrder(lstFree)
+    if nMaxIterations is not None:
+        pMinimizer.setMaxIterations(nMaxIterations)
+    pMinimizer.setObjective(pObjective)
     pMinimizer.setStarts(lstStarts)
-    pMinimizer.setScales(lstScales)
 
-    print("Fitting... this may take a minute or two...")
+    fStart = time.perf_counter()
     nCount, pResult, nReason = pMinimizer.minimize()
-    lstVertex = pResult.getVertex()
+    fSeconds = time.perf_counter()-fStart
+    if mapState is not None and strBackend == "lm":
+        mapState["damping"] = pMinimizer.getState()
+    return nCount, pResult, nReason, fSeconds
 
-    print("Iterations:", nCount)
-    print("Reason for termination:", mapConvergenceReasons[nReason])
-    print("Residual RMS Error: ",pResult.getValue())
-    print("Peak Position Size Width")
-    for nI in range(0, len(lstVertex[1:]), 3):
-        pDate = pStartDate+timedelta(days=lstVertex[nI+2])
-        print(int(nI/3)+1, pDate, lstVertex[nI+2], lstVertex[nI+1], math.sqrt(lstVertex[nI+3]))
+def warmStart(lstStarts, lstPrevious, nPreviousDays):
+    """Copy the fit of the first nPreviousDays days into the starting
+    vertex and return the axes to refit: the waves that can reach the new
+    days, or None (all axes) if a new wave has appeared, which can reshape
+    its neighbours"""
+    nFittedPeaks = (len(lstStarts)-1)//3
+    lstStarts[0:len(lstPrevious)] = lstPrevious
+    if len(lstPrevious) < len(lstStarts):
+        print("Warm start from fit of", nPreviousDays, "days, refitting all waves as a new wave has appeared")
+        return None
+    lstFree = affectedAxes(lstPrevious, nPreviousDays, len(lstStarts))
+    print("Warm start from fit of", nPreviousDays, "days, refitting", (len(lstFree)-1)//3, "of", nFittedPeaks, "waves")
+    return lstFree
+
+def writePeakFiles(strFilename, pObjective, lstVertex, nHorizon=99, fMinimum=10.0):
+    """Write the _parameters.csv, _fit.csv and _diff.csv files for a fitted
+    vertex. The fit and its components are evaluated on every day at once
+    and continue up to nHorizon days beyond the data, stopping before the
+    first day the forecast drops below fMinimum (None for no cutoff)."""
+    nYear, nMonth, nDay = map(int, pObjective.strStartDate.split("-"))
+    pStartDate = datetime(nYear, nMonth, nDay)
 
-    print("")
     strOutputFile = strFilename.replace(".csv", "_fit.csv")
     strDiffFile = strFilename.replace(".csv", "_diff.csv")
     strParameterFile = strFilename.replace(".csv", "_parameters.csv")
@@ -65,39 +113,142 @@ def fitPeaks(strFilename, nMaxDay=-1):
         outFile.write("# slope: "+str(lstVertex[0])+"\n")
         outFile.write("# Peak Date Day SDev Area\n")
         nCount = 1
-        for nPeak in range(1, nParameters, 3): # 1, 17, 3 for 6 peaks
-        #    print(lstVertex[nPeak:nPeak+3])
+        for nPeak in range(1, len(lstVertex), 3): # 1, 17, 3 for 6 peaks
             fSDev = math.sqrt(lstVertex[nPeak+2]/2)
             fArea = lstVertex[nPeak]*math.sqrt(2*math.pi)*fSDev
             pDate = pStartDate+timedelta(days=lstVertex[nPeak+1])
             outFile.write(" ".join(map(str, (nCount, pDate.date(), lstVertex[nPeak+1], fSDev, fArea)))+"\n")
             nCount += 1
 
+    # ramp and waves on the data days and the forecast horizon together
+    nDays = len(pObjective.lstData)
+    aDays = np.arange(nDays+max(nHorizon, 0), dtype=float)
+    aComponents = np.vstack([lstVertex[0]*aDays, pObjective.gaussians(aDays, lstVertex[1:])])
+    aFit = aComponents.sum(axis=0)
+    nEnd = len(aDays)
+    if fMinimum is not None:
+        aBelow = np.nonzero(aFit[nDays:] < fMinimum)[0] # has not happened yet in the data
+        if len(aBelow):
+            nEnd = nDays+aBelow[0]
+
     print("Writing fit and components to: ", strOutputFile)
-    with open(strOutputFile, "w") as outFile:
-        outFile.write("# "+" ".join(map(str, lstVertex))+"\n")
-        outFile.write("# "+pObjective.strStartDate+"\n")
-        for nDay in range(len(pObjective.lstData)):
-            fFit = pObjective.fit(nDay, lstVertex)
-            lstComponents = pObjective.components(nDay, lstVertex)
-            outFile.write(" ".join(map(str, [nDay, fFit]+lstComponents))+"\n")
-            
-        for nI in range(nDay+1, nDay+100):
-            fFit = pObjective.fit(nI, lstVertex)
-            if fFit < 10: break # has not happened yet in the data
-            lstComponents = pObjective.components(nI, lstVertex)
-            outFile.write(" ".join(map(str, [nI, fFit]+lstComponents))+"\n")
-
-    print("Writing diff to: ", strDiffFile)    
-    with open(strDiffFile, "w") as outFile:
-        for nDay, fValue  in enumerate(pObjective.lstData):
-            fFit = pObjective.fit(nDay, lstVertex)
-            outFile.write(" ".join(map(str, (nDay, 2*(fValue-fFit)/(fValue+fFit))))+"\n")
+    aRows = np.column_stack([aDays, aFit, aComponents.T])[:nEnd]
+    np.savetxt(strOutputFile, aRows, fmt=["%d"]+["%.17g"]*(aRows.shape[1]-1), comments="# ",
+               header=" ".join(map(str, lstVertex))+"\n"+pObjective.strStartDate)
+
+    print("Writing diff to: ", strDiffFile)
+    aData = np.asarray(pObjective.lstData, dtype=float)
+    aValid = np.isfinite(aData) # days without data have no diff
+    aSum = aData[aValid]+aFit[:nDays][aValid]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        aDiff = np.where(aSum != 0, 2*(aData[aValid]-aFit[:nDays][aValid])/aSum, 0.0) # no data and no fit
+    np.savetxt(strDiffFile, np.column_stack([aDays[:nDays][aValid], aDiff]), fmt=["%d", "%.17g"])
+
+def reportError(strFilename, nMaxDay, pObjective, lstVertex, fValue):
+    """Print the residual RMS error of a fit, and the value of the loss it
+    minimized if that is not least squares, and return the RMS error"""
+    if pObjective.pLoss is None and pObjective.aRootWeights is None:
+        fRMS = fValue
+    else:
+        print("Loss value (RMS of the pseudo-residuals): ", fValue)
+        fRMS = PeaksObjective(strFilename, nMaxDay)(lstVertex)
+    print("Residual RMS Error: ", fRMS)
+    return fRMS
+
+def fitConfig(strBackend, strLoss="squares", aWeights=None, fSlopeThreshold=115):
+    """Configuration of a fitPeaks fit, keying the fit cache and the run
+    history"""
+    mapConfig = {"backend": strBackend}
+    if strLoss != "squares":
+        mapConfig["loss"] = strLoss
+    if aWeights is not None:
+        mapConfig["weights"] = hashSeries(aWeights)
+    if fSlopeThreshold != 115:
+        mapConfig["threshold"] = fSlopeThreshold
+    return mapConfig
+
+def fitPeaks(strFilename, nMaxDay=-1, strBackend="simplex", bCache=True, nHorizon=99, fMinimum=10.0, strLoss="squares", strWeights="", fSlopeThreshold=115):
+    """Find and fit the waves, write the fit files (forecasting as in
+    writePeakFiles) and return the vertex. strLoss is a loss from
+    losses.py as name[:parameter] and strWeights "inverse" or a file of
+    day/weight rows (see losses.loadWeights). fSlopeThreshold is the peak
+    finder's, see peak_finder.scaledThreshold for series smaller than the
+    national one."""
+    aWeights = loadWeights(strWeights, loadSeries(strFilename, nMaxDay).aValues) if strWeights else None
+    pObjective = PeaksObjective(strFilename, nMaxDay, pLoss=makeLoss(strLoss), aWeights=aWeights)
+
+    nYear, nMonth, nDay = map(int, pObjective.strStartDate.split("-"))
+    pStartDate = datetime(nYear, nMonth, nDay)
+
+    # an unchanged input reuses its cached fit
+    pCache = FitCache(cacheDirectory(strFilename)) if bCache else None
+    mapConfig = fitConfig(strBackend, strLoss, aWeights, fSlopeThreshold)
+    if pCache:
+        mapEntry = pCache.lookup(pObjective.aSeries, mapConfig)
+        if mapEntry:
+            print("Input unchanged, using cached fit from:", pCache.strDirectory)
+            reportError(strFilename, nMaxDay, pObjective, mapEntry["vertex"], mapEntry["value"])
+            writePeakFiles(strFilename, pObjective, mapEntry["vertex"], nHorizon, fMinimum)
+            return mapEntry["vertex"]
+
+    # find peaks
+    pPeakFinder = PeakFinder(strFilename, nMaxDay, fSlopeThreshold)
+    lstPeaks, bExtrapolated = pPeakFinder.findPeaks()
+
+    # set up minimizer
+    nFittedPeaks = len(lstPeaks)
+    if bExtrapolated:
+        nFittedPeaks -= 1 # do not fit extrapolated last peak (fits badly)
+
+    # linear ramp plus width/area/position of each peak
+    lstStarts, lstScales = findStarts(lstPeaks, nFittedPeaks)
+
+    # if only days have been appended warm-start from the cached fit and
+    # only refit the waves that can reach the new days, unless a new wave
+    # has appeared, which can reshape its neighbours
+    lstFree = None
+    mapEntry = pCache.lookupPrefix(pObjective.aSeries, mapConfig) if pCache else None
+    if mapEntry and len(mapEntry["vertex"]) <= len(lstStarts):
+        lstFree = warmStart(lstStarts, mapEntry["vertex"], mapEntry["days"])
+    elif pObjective.pLoss is not None or aWeights is not None:
+        # the other losses have poorer minima near the peak finder guesses,
+        # so start them from a quick least-squares fit
+        print("Starting from a least-squares fit")
+        lstStarts = minimizePeaks(PeaksObjective(strFilename, nMaxDay), lstStarts, lstScales, "lm")[1].getVertex()
+
+    if strBackend == "simplex" and mapEntry is None:
+        print("Fitting... this may take a minute or two...")
+    else:
+        print("Fitting with backend:", strBackend)
+    nCount, pResult, nReason, fSeconds = minimizePeaks(pObjective, lstStarts, lstScales, strBackend, lstFree)
+    lstVertex = pResult.getVertex()
+    if pCache:
+        pCache.store(pObjective.aSeries, mapConfig, lstVertex, pResult.getValue())
+
+    print("Iterations:", nCount)
+    print("Wall time (s):", fSeconds)
+    print("Reason for termination:", mapConvergenceReasons[nReason])
+    fRMS = reportError(strFilename, nMaxDay, pObjective, lstVertex, pResult.getValue())
+    print("Peak Position Size Width")
+    for nI in range(0, len(lstVertex[1:]), 3):
+        pDate = pStartDate+timedelta(days=lstVertex[nI+2])
+        print(int(nI/3)+1, pDate, lstVertex[nI+2], lstVertex[nI+1], math.sqrt(lstVertex[nI+3]))
+
+    print("")
+    writePeakFiles(strFilename, pObjective, lstVertex, nHorizon, fMinimum)
+    recordPeaks(strFilename, lstVertex, fRMS, mapConfig, nMaxDay)
+    return lstVertex
 
 if __name__ == "__main__":
     pParser = argparse.ArgumentParser(prog="python3 peak_fitter.py", description="Find and fit peaks in covid data extracted by extract_column.py")
     pParser.add_argument("filename", help="File to process (must end in .csv)")
     pParser.add_argument("--maxday", "-m", help="Maximum day number to process (day number 0 is Jan 23, 2020), default is all", default=-1, type=int)
+    pParser.add_argument("--backend", "-b", help="Fitting backend: simplex (derivative-free, default) or lm (Levenberg-Marquardt with analytic jacobian)", default="simplex", choices=lstBackends)
+    pParser.add_argument("--nocache", "-n", action="store_true", help="Always refit from scratch, ignoring and not updating the fit cache")
+    pParser.add_argument("--horizon", help="Days to forecast beyond the data in _fit.csv, default is 99", default=99, type=int)
+    pParser.add_argument("--minimum", help="Stop the forecast where it drops below this, default is 10 (negative for no cutoff)", default=10.0, type=float)
+    pParser.add_argument("--loss", "-l", help="Loss to fit with, one of "+", ".join(lstLosses)+", with an optional parameter as name:value (e.g. huber:200), default is squares", default="squares")
+    pParser.add_argument("--weights", "-w", help="Per-day weights: inverse (1/count) or a file of day/weight rows, default is none", default="")
     pArgs = pParser.parse_args(sys.argv[1:])
 
     if not pArgs.filename.endswith(".csv"):
@@ -106,4 +257,5 @@ if __name__ == "__main__":
         pArgs.print_help()
         sys.exit(-1)
 
-    fitPeaks(pArgs.filename, pArgs.maxday)
+    fitPeaks(pArgs.filename, pArgs.maxday, pArgs.backend, not pArgs.nocache, pArgs.horizon, pArgs.minimum if pArgs.minimum >= 0 else None,
+             pArgs.loss, pArgs.weights)
@@ -1,44 +1,133 @@
 import math
 
+import numpy as np
+
+from time_series import loadSeries
+
+# value returned for vertices where the fit overflows (e.g. negative widths),
+# finite so the simplex's parabolic steps stay finite
+fBadValue = 1E100
+
 class PeaksObjective:
-    
-    def __init__(self, strFilename, nMaxDay, nMInDay = 0):
-        
-        self.lstData = []
-        self.strStartDate = ""
-        with open(strFilename) as inFile:
-            nCount = 0
-            for strLine in inFile:
-                if strLine.strip().startswith("#"):
-                    self.strStartDate = strLine.strip().split()[1]
-                    continue
-                nCount += 1
-                if nCount < nMInDay:
-                    continue
-                self.lstData.append(float(strLine.strip().split()[1]))
-                if nMaxDay >= 0 and len(self.lstData) > nMaxDay:
-                    break
+
+    def __init__(self, strFilename, nMaxDay, nMInDay = 0, pLoss=None, aWeights=None):
+        """pLoss is a loss from losses.py, None for plain least squares,
+        and aWeights optional weights for every day of the series"""
+
+        pSeries = loadSeries(strFilename, nMaxDay)
+        self.strStartDate = pSeries.strStartDate
+        self.aSeries = np.asarray(pSeries.aValues[max(nMInDay-1, 0):]) # one row per day, NaN for gaps
+        self.lstData = self.aSeries.tolist()
+
+        # days with data, so every day is evaluated in one operation
+        aValid = np.isfinite(self.aSeries)
+        self.aDays = np.arange(len(self.aSeries), dtype=float)[aValid]
+        self.aData = self.aSeries[aValid]
+
+        self.pLoss = pLoss
+        self.aRootWeights = None # pseudo-residuals are scaled by the root of the weight
+        if aWeights is not None:
+            self.aRootWeights = np.sqrt(np.asarray(aWeights, dtype=float)[max(nMInDay-1, 0):][:len(self.aSeries)][aValid])
 
     def __call__(self, lstX):
-        
+
         # lstX has structure slope, area1, pos1, width1, area2, ...
-        
-        fError = 0.0
-        for nDay, fValue in enumerate(self.lstData):
-            fError += (self.fit(nDay, lstX)-fValue)**2
-        return math.sqrt(fError/nDay)
+
+        aResidual = self.residuals(lstX)
+        with np.errstate(over="ignore", invalid="ignore"):
+            fError = math.sqrt(np.dot(aResidual, aResidual)/(len(self.aData)-1))
+        if not math.isfinite(fError): # e.g. zero or negative width
+            return fBadValue
+        return fError
+
+    def batch(self, aVertices, nChunk=64):
+        """Evaluate the objective for a stack of vertices, one per row,
+        returning an array of RMS errors. Rows are processed nChunk at
+        a time to bound the size of the (vertex, peak, day) array."""
+
+        aVertices = np.atleast_2d(np.asarray(aVertices, dtype=float))
+        aErrors = np.empty(len(aVertices))
+        for nStart in range(0, len(aVertices), nChunk):
+            aChunk = aVertices[nStart:nStart+nChunk]
+            aFit = aChunk[:, 0, None]*self.aDays
+            aFit += self.gaussians(self.aDays, aChunk[:, 1:]).sum(axis=1)
+            aResidual = self.transform(aFit)[0]
+            with np.errstate(over="ignore", invalid="ignore"):
+                aErrors[nStart:nStart+nChunk] = np.sqrt(np.einsum("ij,ij->i", aResidual, aResidual)/(len(self.aData)-1))
+        aErrors[~np.isfinite(aErrors)] = fBadValue
+        return aErrors
+
+    def transform(self, aFit):
+        """Residuals of fits (of any shape ending in days) under the loss
+        and weights, and their derivatives with respect to the fit (None
+        for plain least squares)"""
+        if self.pLoss is None and self.aRootWeights is None:
+            return aFit-self.aData, None
+        with np.errstate(over="ignore", divide="ignore", invalid="ignore"):
+            if self.pLoss is None:
+                aResidual, aDerivative = aFit-self.aData, np.ones_like(aFit)
+            else:
+                aResidual, aDerivative = self.pLoss.transform(aFit, self.aData)
+            if self.aRootWeights is not None:
+                aResidual = aResidual*self.aRootWeights
+                aDerivative = aDerivative*self.aRootWeights
+        return aResidual, aDerivative
+
+    def residuals(self, lstX):
+        """Fit minus data for every day (or the loss's pseudo-residuals),
+        for least-squares minimizers"""
+        return self.transform(self.evaluate(self.aDays, lstX))[0]
+
+    def gradient(self, lstX):
+        """Gradient of half the sum of squared residuals"""
+        return self.jacobian(lstX).T @ self.residuals(lstX)
+
+    def jacobian(self, lstX):
+        """Analytic derivatives of the residuals on each day with respect
+        to slope and each peak's area, position and width"""
+
+        aX = np.asarray(lstX, dtype=float)
+        aPeaks = aX[1:].reshape(-1, 3)
+        aWidth = aPeaks[:, 2, None]
+        aDelta = self.aDays-aPeaks[:, 1, None]
+        with np.errstate(over="ignore", divide="ignore", invalid="ignore"):
+            aExp = np.exp(-aDelta**2/aWidth)
+            aScaled = aPeaks[:, 0, None]*aExp/aWidth
+
+        aJacobian = np.empty((len(self.aDays), len(aX)))
+        aJacobian[:, 0] = self.aDays
+        aJacobian[:, 1::3] = aExp.T
+        aJacobian[:, 2::3] = (2*aDelta*aScaled).T
+        aJacobian[:, 3::3] = (aDelta**2*aScaled/aWidth).T
+        if self.pLoss is not None or self.aRootWeights is not None: # chain rule through the loss
+            aJacobian *= self.transform(self.evaluate(self.aDays, aX))[1][:, None]
+        return aJacobian
+
+    def gaussians(self, aDays, aPeaks):
+        """Evaluate every peak on every day. aPeaks has the flattened
+        area/position/width triples as its last axis, and the result has
+        shape aPeaks.shape[:-1]+(nPeaks, nDays)."""
+
+        aPeaks = np.asarray(aPeaks, dtype=float)
+        aPeaks = aPeaks.reshape(aPeaks.shape[:-1]+(-1, 3))
+        aArea = aPeaks[..., 0, None]
+        aPosition = aPeaks[..., 1, None]
+        aWidth = aPeaks[..., 2, None]
+        with np.errstate(over="ignore", divide="ignore", invalid="ignore"):
+            return aArea*np.exp(-(aDays-aPosition)**2/aWidth)
+
+    def evaluate(self, aDays, lstX):
+        """Fit for an array of days"""
+        aComponents = self.gaussians(aDays, lstX[1:])
+        return lstX[0]*aDays + aComponents.sum(axis=0)
 
     def fit(self, nDay, lstX):
-        fFit = lstX[0]*nDay # start with slope
-        for nPeak in range(1, len(lstX), 3): # add peaks
-            fFit += self.peak(nDay, lstX[nPeak:nPeak+3])
-        return fFit
+        return float(self.evaluate(np.array([nDay], dtype=float), lstX)[0])
 
     def components(self, nDay, lstX):
         lstComponents = [lstX[0]*nDay] # start with slope
-        for nPeak in range(1, len(lstX), 3): # add peaks
-            lstComponents.append(self.peak(nDay, lstX[nPeak:nPeak+3]))
+        lstComponents.extend(self.gaussians(np.array([nDay], dtype=float), lstX[1:])[:, 0].tolist())
         return lstComponents
-        
+
     def peak(self, nDay, lstPeak):
         return lstPeak[0]*math.exp(-(nDay-lstPeak[1])**2/lstPeak[2])
@@ -0,0 +1,153 @@
+"""
+Make-style pipeline runner. Each stage declares the files it reads, the
+files it writes and the source modules that implement it. A stage is
+re-run only if an output is missing or the hash of its inputs, sources
+or parameters differs from the last successful run, which is recorded
+in a small state file. Stage return values are kept in memory and passed
+to later stages in the same run.
+"""
+import hashlib
+import json
+import os
+import tempfile
+
+strStateFile = ".pipeline_state.json"
+
+def hashFile(strFilename):
+    """SHA-256 of a file's contents, or None if it does not exist"""
+    if not os.path.exists(strFilename):
+        return None
+    pHash = hashlib.sha256()
+    with open(strFilename, "rb") as inFile:
+        for pChunk in iter(lambda: inFile.read(1 << 16), b""):
+            pHash.update(pChunk)
+    return pHash.hexdigest()
+
+class Stage:
+
+    def __init__(self, strName, fnRun, lstInputs=None, lstOutputs=None, lstSources=None, mapParameters=None, bAlways=False):
+        """fnRun is called with the map of results from earlier stages and
+        its return value is stored under strName. Stages with bAlways set
+        (e.g. the download, which does its own freshness check) run every
+        time."""
+        self.strName = strName
+        self.fnRun = fnRun
+        self.lstInputs = lstInputs or []
+        self.lstOutputs = lstOutputs or []
+        self.lstSources = lstSources or []
+        self.mapParameters = mapParameters or {}
+        self.bAlways = bAlways
+
+    def signature(self):
+        """Hash of everything that determines this stage's outputs"""
+        mapSignature = {"inputs": {strFile: hashFile(strFile) for strFile in self.lstInputs},
+                        "sources": {strFile: hashFile(strFile) for strFile in self.lstSources},
+                        "parameters": self.mapParameters}
+        return hashlib.sha256(json.dumps(mapSignature, sort_keys=True).encode()).hexdigest()
+
+    def stateEntry(self):
+        """What the state file records for a successful run"""
+        return {"signature": self.signature(), "outputs": {strFile: hashFile(strFile) for strFile in self.lstOutputs}}
+
+class Pipeline:
+
+    def __init__(self, strState=strStateFile):
+        self.strState = strState
+        self.lstStages = []
+
+    def add(self, pStage):
+        self.lstStages.append(pStage)
+        return pStage
+
+    def names(self):
+        return [pStage.strName for pStage in self.lstStages]
+
+    def readState(self):
+        try:
+            with open(self.strState) as inFile:
+                return json.load(inFile)
+        except (OSError, ValueError):
+            return {}
+
+    def writeState(self, mapState):
+        nHandle, strTemp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.strState)), suffix=".tmp")
+        with os.fdopen(nHandle, "w") as outFile:
+            json.dump(mapState, outFile, indent=1)
+        os.replace(strTemp, self.strState)
+
+    def staleReason(self, pStage, mapState, setPending):
+        """Why the stage needs to run, or an empty string if it is up to date.
+        setPending holds outputs of earlier stages that will be rewritten."""
+        if pStage.bAlways:
+            return "always runs"
+        lstMissing = [strFile for strFile in pStage.lstOutputs if not os.path.exists(strFile)]
+        if lstMissing:
+            return "missing "+", ".join(lstMissing)
+        lstPending = [strFile for strFile in pStage.lstInputs if strFile in setPending]
+        if lstPending:
+            return "upstream changes "+", ".join(lstPending)
+        mapRecord = mapState.get(pStage.strName)
+        if mapRecord is None:
+            return "never run"
+        if mapRecord["signature"] != pStage.signature():
+            return "inputs, sources or parameters changed"
+        return ""
+
+    def select(self, lstOnly=None, strFrom=None):
+        """Names of the stages that are forced to run by --only/--from"""
+        lstNames = self.names()
+        for strName in (lstOnly or [])+([strFrom] if strFrom else []):
+            if strName not in lstNames:
+                raise ValueError("Unknown stage: "+strName+" (stages are: "+", ".join(lstNames)+")")
+        if lstOnly:
+            return set(lstOnly)
+        if strFrom:
+            return set(lstNames[lstNames.index(strFrom):])
+        return set()
+
+    def record(self, lstNames):
+        """Mark stages as up to date after their outputs have been written
+        outside the pipeline (e.g. by a long-running process)"""
+        mapState = self.readState()
+        for pStage in self.lstStages:
+            if pStage.strName in lstNames:
+                mapState[pStage.strName] = pStage.stateEntry()
+        self.writeState(mapState)
+
+    def run(self, lstOnly=None, strFrom=None, bDryRun=False, bForce=False, pInstrumentation=None):
+        """Run stale stages in order. With lstOnly only those stages run,
+        and with strFrom that stage and everything after it runs, in both
+        cases whether stale or not. With bDryRun just list what would run.
+        Each stage that runs is timed by pInstrumentation if given (see
+        instrumentation.py). Returns the map of stage results."""
+        setForced = self.select(lstOnly, strFrom)
+        mapState = self.readState()
+        mapResults = {}
+        setPending = set()
+        for pStage in self.lstStages:
+            if lstOnly and pStage.strName not in setForced:
+                strReason = ""
+            elif bForce or pStage.strName in setForced:
+                strReason = "selected"
+            else:
+                strReason = self.staleReason(pStage, mapState, setPending if bDryRun else set())
+
+            if not strReason:
+                print("[skip]", pStage.strName)
+                if pInstrumentation is not None:
+                    pInstrumentation.skipped(pStage.strName)
+                continue
+            print("[run] ", pStage.strName, "-", strReason)
+            if bDryRun:
+                if not pStage.bAlways: # can't tell whether it will change anything
+                    setPending.update(pStage.lstOutputs)
+                continue
+
+            if pInstrumentation is None:
+                mapResults[pStage.strName] = pStage.fnRun(mapResults)
+            else:
+                with pInstrumentation.stage(pStage.strName):
+                    mapResults[pStage.strName] = pStage.fnRun(mapResults)
+            mapState[pStage.strName] = pStage.stateEntry()
+            self.writeState(mapState)
+        return mapResults
@@ -2,14 +2,16 @@
 import argparse
 from datetime import datetime, timedelta
 import math
+import os.path
 import sys
 
 import numpy as np
 
-import matplotlib
-import matplotlib.dates as mdates
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
+from figures import finishFigure
+from fit_cache import hashSeries
+from forecast import forecastNextWave, readFitVertex
+from run_history import recordPrediction
+from time_series import loadSeries
 
 strEnd = ".csv"
 
@@ -28,38 +30,60 @@ def weeklyAvg(lstDays, lstData):
 def peak(nDay, fArea, fPosition, fWidth):
     return fArea*math.exp(-(nDay-fPosition)**2/fWidth)
 
-def plotFit(strFilename):
+def predictNextPeak(lstPositions, lstWidths, lstHeights, nLookback=4):
+    """Predict the next peak from the averages of the last nLookback waves.
+    Widths are w = 2*sdev**2 and heights are peak heights, as in the fit
+    vertex. Returns a map holding the recent spacings and the predicted
+    spacing, position, sdev, area, height and width, with the standard
+    deviations of spacing, sdev and area."""
+    lstDiff = []
+    lstRealWidth = []
+    lstTotalArea = []
+    for nI in range(1, 1+nLookback):
+        lstDiff.append(lstPositions[-nI]-lstPositions[-nI-1])
+        lstRealWidth.append(math.sqrt(lstWidths[-nI]/2))
+        lstTotalArea.append(lstHeights[-nI]*math.sqrt(2*math.pi)*lstRealWidth[-1])
+
+    fAverageDiff = sum(lstDiff)/len(lstDiff)
+    fAverageArea = sum(lstTotalArea[-nLookback:])/nLookback
+    fAverageWidth = sum(lstRealWidth[-nLookback:])/nLookback
+    mapPrediction = {"spacings": lstDiff, "spacing": fAverageDiff, "position": lstPositions[-1]+fAverageDiff,
+        "sdev": fAverageWidth, "area": fAverageArea,
+        "height": sum(lstHeights[-nLookback:])/nLookback, "width": sum(lstWidths[-nLookback:])/nLookback}
+    mapPrediction["spacing_sdev"] = math.sqrt(sum([(fAverageDiff-fDiff)**2 for fDiff in lstDiff])/(nLookback-1))
+    mapPrediction["sdev_sdev"] = math.sqrt(sum([(fAverageWidth-fWidth)**2 for fWidth in lstRealWidth])/(nLookback-1))
+    mapPrediction["area_sdev"] = math.sqrt(sum([(fAverageArea-fArea)**2 for fArea in lstTotalArea])/(nLookback-1))
+    return mapPrediction
+
+def plotFit(strFilename, strRegion="Canada", bSave=True, bImage=False, nForecastSamples=20000, nLookback=4):
+    """Plot data, fit, SEIRS model and next-peak prediction with Monte Carlo
+    forecast bands from nForecastSamples samples (none if 0), returning
+    the image filename (see finishFigure for bSave and bImage). The
+    prediction averages the last nLookback waves and is left out if there
+    are not more waves than that."""
+    # imported here so callers that only want e.g. predictNextPeak don't load matplotlib
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.dates as mdates
+    import matplotlib.pyplot as plt
+
+    pSeries = loadSeries(strFilename)
+    pBaseDate = pSeries.pStartDate
+    lstDays = pSeries.days().astype(int).tolist()
+    lstPatients = np.asarray(pSeries.aValues).tolist()
 
-    lstPatients = []
-    lstDays = []
-    pBaseDate = None
-    with open(strFilename) as inFile:
-        for strLine in inFile:
-            if strLine.strip().startswith("#"):
-                nYear, nMonth, nDay = map(int, strLine.strip().split()[1].split("-"))
-                pBaseDate = datetime(nYear, nMonth, nDay)
-                continue
-                
-            nDay, fPatients = map(float, strLine.strip().split())
-            lstDays.append(int(nDay))
-            lstPatients.append(fPatients)
-
-    lstFit = []
-    lstFitDays = []
     strFitFile = strFilename.replace(".csv", "_fit.csv")
     with open(strFitFile) as inFile:
         for strLine in inFile:
-            if strLine.strip().startswith("#"):
-                if len(strLine) < 100:
-                    nYear, nMonth, nDay = map(int, strLine.strip().split()[1].split("-"))
-                    if pBaseDate != datetime(nYear, nMonth, nDay):
-                        print("Date mismatch in fit/data files")
-                        sys.exit(-1)
-                continue
-                
-            nDay, fFit = list(map(float, strLine.strip().split()))[0:2]
-            lstFit.append(fFit)
-            lstFitDays.append(int(nDay))
+            if not strLine.strip().startswith("#"): break
+            if len(strLine) < 100:
+                nYear, nMonth, nDay = map(int, strLine.strip().split()[1].split("-"))
+                if pBaseDate != datetime(nYear, nMonth, nDay):
+                    print("Date mismatch in fit/data files")
+                    sys.exit(-1)
+    aFit = np.loadtxt(strFitFile, usecols=(0, 1), ndmin=2)
+    lstFitDays = aFit[:, 0].astype(int).tolist()
+    lstFit = aFit[:, 1].tolist()
 
     lstDays, lstPatients = weeklyAvg(lstDays, lstPatients)
 
@@ -97,7 +121,7 @@ def plotFit(strFilename):
     pFigure, pPlot = plt.subplots()
     pPlot.xaxis.set_major_locator(pLocator)
     pPlot.xaxis.set_major_formatter(pFormatter)
-    pPlot.set_title("Canada Hospitalized Covid Patients")
+    pPlot.set_title(strRegion+" Hospitalized Covid Patients")
 
     # plot    
     pPlot.grid(True, linewidth=0.2)
@@ -114,59 +138,66 @@ def plotFit(strFilename):
     lstFitDates = [pBaseDate+timedelta(days=x) for x in lstFitDays]
     pPlot.plot(lstFitDates, lstFit, color="xkcd:red", label="Fit")
 
-    # find next peak
-    nLookback = 4
-    lstDiff = []
-    lstRealWidth = []
-    lstTotalArea = []
-    for nI in range(1, 1+nLookback):
-        lstDiff.append(lstPositions[-nI]-lstPositions[-nI-1])
-        lstRealWidth.append(math.sqrt(lstWidths[-nI]/2))
-        lstTotalArea.append(lstAreas[-nI]*math.sqrt(2*math.pi)*lstRealWidth[-1])
-
-    fAverageDiff = sum(lstDiff)/len(lstDiff)
-    fNextPosition = lstPositions[-1]+fAverageDiff
-    fAverageArea = sum(lstTotalArea[-nLookback:])/nLookback
-    fAverageWidth = sum(lstRealWidth[-nLookback:])/nLookback
-    fDiffSDev = math.sqrt(sum([(fAverageDiff-fDiff)**2 for fDiff in lstDiff])/(nLookback-1))
-    fWidthSDev = math.sqrt(sum([(fAverageWidth-fWidth)**2 for fWidth in lstRealWidth])/(nLookback-1))
-    fAreaSDev = math.sqrt(sum([(fAverageArea-fArea)**2 for fArea in lstTotalArea])/(nLookback-1))
-    print("Spacing: ", lstDiff[-4:])
-    print("Average spacing: ",fAverageDiff,"+/-", fDiffSDev)
-
     # plot model fit
-    lstModel = []
-    lstModelDates = []
-    with open(strFilename.replace(".csv", "_model.csv")) as inFile:
-        for strLine in inFile:
-            nDay, fPatients = map(float, strLine.strip().split())
-            pDate = pBaseDate+timedelta(days=nDay)
-            if pDate > datetime(2023,12,31): break
-            lstModelDates.append(pDate)
-            lstModel.append(fPatients)
-    nDayMax = int(nDay)
+    aModel = np.loadtxt(strFilename.replace(".csv", "_model.csv"), ndmin=2)
+    nLast = (datetime(2023,12,31)-pBaseDate).days
+    aBeyond = np.nonzero(aModel[:, 0] > nLast)[0]
+    nRows = aBeyond[0] if len(aBeyond) else len(aModel) # stop at the end date
+    lstModelDates = [pBaseDate+timedelta(days=fDay) for fDay in aModel[:nRows, 0]]
+    lstModel = aModel[:nRows, 1].tolist()
+    nDayMax = int(aModel[min(nRows, len(aModel)-1), 0])
     pPlot.plot(lstModelDates, lstModel, color="firebrick", linewidth="0.3", label="SEIRS Model")
 
-    # plot next peak
-    fNextSdev = math.sqrt(fAverageWidth/2)
-    fStart = fNextPosition-3*fAverageWidth
-    lstNextDays = [fStart+nI for nI in range(int(6*fAverageWidth))]
-    lstNextDates = [pBaseDate+timedelta(days=x) for x in lstNextDays]
-
-    fAverageA = sum(lstAreas[-nLookback:])/nLookback    # parameter averages
-    fAverageW = sum(lstWidths[-nLookback:])/nLookback
-
-    lstNextPeak = [peak(nDay, fAverageA, fNextPosition, fAverageW) for nDay in lstNextDays]
-    fNextHeight = max(lstNextPeak)
-    pPlot.plot(lstNextDates, lstNextPeak, color="xkcd:black", label="Prediction")
-    pNextDate = lstNextDates[len(lstNextDates)//2]
-    fSDev = math.sqrt(fAverageWidth/2)
-    fRealArea = fAverageArea*math.sqrt(2*math.pi)*fSDev
-    print("PREDICTED:")
-    print("Date:", pNextDate.date(), "+/-", fDiffSDev)
-    print("Width:", fAverageWidth, fWidthSDev)
-    print("Area:", fAverageArea, fAreaSDev)
-    strNextDate = "         "+str(pNextDate.date())
+    # find and plot the next peak, which needs nLookback spacings
+    if len(lstPositions) > nLookback:
+        mapPrediction = predictNextPeak(lstPositions, lstWidths, lstAreas, nLookback)
+        recordPrediction(strFilename, mapPrediction, {"lookback": nLookback, "waves": hashSeries(lstPositions+lstWidths+lstAreas)})
+        lstDiff = mapPrediction["spacings"]
+        fAverageDiff = mapPrediction["spacing"]
+        fNextPosition = mapPrediction["position"]
+        fAverageArea = mapPrediction["area"]
+        fAverageWidth = mapPrediction["sdev"]
+        fDiffSDev = mapPrediction["spacing_sdev"]
+        fWidthSDev = mapPrediction["sdev_sdev"]
+        fAreaSDev = mapPrediction["area_sdev"]
+        print("Spacing: ", lstDiff[-nLookback:])
+        print("Average spacing: ",fAverageDiff,"+/-", fDiffSDev)
+
+        # plot next peak
+        fNextSdev = math.sqrt(fAverageWidth/2)
+        fStart = fNextPosition-3*fAverageWidth
+        lstNextDays = [fStart+nI for nI in range(int(6*fAverageWidth))]
+        lstNextDates = [pBaseDate+timedelta(days=x) for x in lstNextDays]
+
+        fAverageA = mapPrediction["height"]    # parameter averages
+        fAverageW = mapPrediction["width"]
+
+        lstNextPeak = [peak(nDay, fAverageA, fNextPosition, fAverageW) for nDay in lstNextDays]
+        fNextHeight = max(lstNextPeak)
+        pPlot.plot(lstNextDates, lstNextPeak, color="xkcd:black", label="Prediction")
+
+        # occupancy bands, seeded so the figure only changes when the fit does
+        if nForecastSamples > 0:
+            mapForecast = forecastNextWave(readFitVertex(strFilename)[0], len(pSeries), nSamples=nForecastSamples, nLookback=nLookback, nSeed=0)
+            lstForecastDates = [pBaseDate+timedelta(days=x) for x in mapForecast["days"]]
+            lstPercentiles = mapForecast["percentiles"]
+            aBands = mapForecast["bands"]
+            for nLow, nHigh, fAlpha in [(5, 95, 0.15), (25, 75, 0.3)]:
+                pPlot.fill_between(lstForecastDates, aBands[lstPercentiles.index(nLow)], aBands[lstPercentiles.index(nHigh)],
+                                   color="xkcd:black", alpha=fAlpha, lw=0, label="Forecast "+str(nLow)+"-"+str(nHigh)+"%")
+        pNextDate = lstNextDates[len(lstNextDates)//2]
+        fSDev = math.sqrt(fAverageWidth/2)
+        fRealArea = fAverageArea*math.sqrt(2*math.pi)*fSDev
+        print("PREDICTED:")
+        print("Date:", pNextDate.date(), "+/-", fDiffSDev)
+        print("Width:", fAverageWidth, fWidthSDev)
+        print("Area:", fAverageArea, fAreaSDev)
+        strNextDate = "         "+str(pNextDate.date())
+        nVShift = 500
+        pPlot.annotate(strNextDate, xy=(pNextDate, fNextHeight+nVShift), horizontalalignment="center", verticalalignment="top", fontsize=8)
+    else:
+        print("Too few waves to predict the next peak:", len(lstPositions), "(need "+str(nLookback+1)+")")
+
     # annotate
     for nI, pDate in enumerate(lstPeakDays):
         strAnnotation = "#"+str(nI+1)
@@ -175,8 +206,6 @@ def plotFit(strFilename):
             strAnnotation = lstAnnotations[nI]
             nVShift = lstVShift[nI]
         pPlot.annotate(strAnnotation, xy=(pDate, lstPeakHeights[nI]+nVShift), horizontalalignment="center", verticalalignment="top", fontsize=10)
-    nVShift = 500
-    pPlot.annotate(strNextDate, xy=(pNextDate, fNextHeight+nVShift), horizontalalignment="center", verticalalignment="top", fontsize=8)
 
     # set the lower end to be strictly 0
     pPlot.set_ybound(lower=0)
@@ -198,8 +227,9 @@ def plotFit(strFilename):
     pPlot.legend(loc="upper left")
 
     pFigure.autofmt_xdate()
-    strFigFile = strDate+"_"+strFilename.replace(strEnd, ".png")
-    pFigure.savefig(strFigFile)
+    strDirectory, strBase = os.path.split(strFilename)
+    strFigFile = os.path.join(strDirectory, strDate+"_"+strBase.replace(strEnd, ".png"))
+    return finishFigure(pFigure, strFigFile, bSave, bImage)
 
 if __name__ == "__main__":
     pParser = argparse.ArgumentParser(prog="python3 plot_fit.py", description="Plot fit from .csv file (must end in .csv)")
@@ -2,14 +2,12 @@
 import argparse
 from datetime import datetime, timedelta
 import math
+import os.path
 import sys
 
 import numpy as np
 
-import matplotlib
-import matplotlib.dates as mdates
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
+from figures import finishFigure
 
 lstAnnotations = ["Wave 1",
 "Fall 2020",
@@ -26,7 +24,12 @@ def findError(lstData):
     fMean = sum(lstData)/len(lstData)
     return math.sqrt(sum([(fX-fMean)**2 for fX in lstData])/(len(lstData)-1))
 
-def makePlot(strFilename, lstNumber, lstData, strYLabel, strType, bErrorBars, bCut):
+def makePlot(strFilename, lstNumber, lstData, strYLabel, strType, bErrorBars, bCut, strRegion="Canada", bSave=True, bImage=False):
+    # imported here so callers that only want the fit parameters don't load matplotlib
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
     # generate error for pre-omicon and omicron
     nCut = 4 # separate the first four points from omicron-era
     if strType == "Spacing":
@@ -37,7 +40,7 @@ def makePlot(strFilename, lstNumber, lstData, strYLabel, strType, bErrorBars, bC
     lstError.extend([fOmicronError for nI in range(len(lstData)-nCut)])
 
     pFigure, pPlot = plt.subplots()
-    pPlot.set_title("Canada Hospitalization Wave "+strType)
+    pPlot.set_title(strRegion+" Hospitalization Wave "+strType)
         
     pPlot.grid(linewidth=0.2)
     pPlot.set_xlabel("Wave Number")
@@ -121,11 +124,14 @@ def makePlot(strFilename, lstNumber, lstData, strYLabel, strType, bErrorBars, bC
     pFigure.subplots_adjust(right=0.95)
     pFigure.subplots_adjust(top=0.92)
 
-    strFigFile = strDate+"_"+strFilename.replace(strParam, "_wave_"+strType.lower()+strTailExtension)
+    strDirectory, strBase = os.path.split(strFilename)
+    strFigFile = os.path.join(strDirectory, strDate+"_"+strBase.replace(strParam, "_wave_"+strType.lower()+strTailExtension))
     print("Plotting:", strFigFile)
-    pFigure.savefig(strFigFile)
+    return finishFigure(pFigure, strFigFile, bSave, bImage)
 
-def plotParameters(strFilename, bCut=True, bErrorBars=True, bArea=False, bWidth=False, bSpacing=False):
+def plotParameters(strFilename, bCut=True, bErrorBars=True, bArea=False, bWidth=False, bSpacing=False, strRegion="Canada", bSave=True, bImage=False):
+    """Plot area, width and spacing of the fitted waves, returning the image
+    filenames (or filename/image pairs with bImage, see finishFigure)"""
 
     bPlotAll = True # plot everything if no selection is given
     if bArea or bWidth or bSpacing:
@@ -155,13 +161,15 @@ def plotParameters(strFilename, bCut=True, bErrorBars=True, bArea=False, bWidth=
             lstNumber.append(nPeak)
             nPeak += 1
 
+    lstFigFiles = []
     if bPlotAll or bArea:
-        makePlot(strFilename, lstNumber, lstArea, "Person-Days Hospitalized", "Area", bErrorBars, bCut)
+        lstFigFiles.append(makePlot(strFilename, lstNumber, lstArea, "Person-Days Hospitalized", "Area", bErrorBars, bCut, strRegion, bSave, bImage))
     if bPlotAll or bWidth:
-        makePlot(strFilename, lstNumber, lstWidth, "Wave Width (days)", "Width", bErrorBars, bCut)
+        lstFigFiles.append(makePlot(strFilename, lstNumber, lstWidth, "Wave Width (days)", "Width", bErrorBars, bCut, strRegion, bSave, bImage))
     if bPlotAll or bSpacing:
         lstDiff = [lstPeak[nI]-lstPeak[nI-1] for nI in range(1, len(lstPeak))]
-        makePlot(strFilename, lstNumber[1:], lstDiff, "Wave Interval (days)", "Spacing", bErrorBars, bCut)
+        lstFigFiles.append(makePlot(strFilename, lstNumber[1:], lstDiff, "Wave Interval (days)", "Spacing", bErrorBars, bCut, strRegion, bSave, bImage))
+    return lstFigFiles
 
 if __name__ == "__main__":
     pParser = argparse.ArgumentParser(prog="python3 plot_parameters.py", description="Plot parameters from fit (must end with _parameters.csv)")
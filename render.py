@@ -0,0 +1,69 @@
+"""
+Render the fit plot and the area, width and spacing plots concurrently,
+one figure per worker process. matplotlib is only imported inside the
+plotting functions, so it is loaded by the workers and never by callers
+that only fit. The workers can hand back the RGBA pixels of each figure
+so the montage is composed in memory rather than from re-read PNGs.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import os
+import sys
+
+from generate_montage import composeMontage
+from plot_fit import plotFit
+from plot_parameters import plotParameters
+
+lstParameterPlots = ["area", "width", "spacing"]
+lstMontageOrder = ["fit", "area", "spacing", "width"]
+
+def plotParameter(strParameters, strPlot, strRegion="Canada", bSave=True, bImage=False):
+    """Render one of the parameter plots"""
+    mapSelection = {"b"+strName.capitalize(): strName == strPlot for strName in lstParameterPlots}
+    return plotParameters(strParameters, strRegion=strRegion, bSave=bSave, bImage=bImage, **mapSelection)[0]
+
+def renderAll(strFilename, strRegion="Canada", nWorkers=None, bSave=True, bImage=False, pPool=None):
+    """Render all four figures for an extracted data file, returning a map
+    from fit, area, width and spacing to the image filenames, or to
+    filename/RGBA array pairs with bImage. With bSave false no PNGs are
+    written. With nWorkers of 1 the figures are rendered in this process,
+    e.g. from inside another pool's worker. A long-lived caller can pass
+    its own pPool so the workers (and their matplotlib) are reused."""
+
+    strParameters = strFilename.replace(".csv", "_parameters.csv")
+    if nWorkers == 1:
+        mapFigures = {"fit": plotFit(strFilename, strRegion, bSave, bImage)}
+        for strPlot in lstParameterPlots:
+            mapFigures[strPlot] = plotParameter(strParameters, strPlot, strRegion, bSave, bImage)
+        return mapFigures
+
+    if pPool is not None:
+        return submitAll(pPool, strFilename, strParameters, strRegion, bSave, bImage)
+    with ProcessPoolExecutor(max_workers=nWorkers or min(1+len(lstParameterPlots), os.cpu_count())) as pPool:
+        return submitAll(pPool, strFilename, strParameters, strRegion, bSave, bImage)
+
+def submitAll(pPool, strFilename, strParameters, strRegion, bSave, bImage):
+    mapFutures = {"fit": pPool.submit(plotFit, strFilename, strRegion, bSave, bImage)}
+    for strPlot in lstParameterPlots:
+        mapFutures[strPlot] = pPool.submit(plotParameter, strParameters, strPlot, strRegion, bSave, bImage)
+    return {strPlot: pFuture.result() for strPlot, pFuture in mapFutures.items()}
+
+def renderMontage(strFilename, strOutput, strRegion="Canada", nWorkers=None, bSave=True):
+    """Render the four figures and compose them straight from their pixels.
+    Returns the map of figure filenames."""
+    mapFigures = renderAll(strFilename, strRegion, nWorkers, bSave, bImage=True)
+    composeMontage([mapFigures[strPlot][1] for strPlot in lstMontageOrder], strOutput)
+    return {strPlot: strFigFile for strPlot, (strFigFile, aImage) in mapFigures.items()}
+
+if __name__ == "__main__":
+    pParser = argparse.ArgumentParser(prog="python3 render.py", description="Render the fit and parameter plots for an extracted data file, and optionally the montage")
+    pParser.add_argument("filename", help="Extracted data file (must end in .csv)", nargs="?", default="can_hosp_patients.csv")
+    pParser.add_argument("--montage", "-m", help="Also compose the montage into this file", default="")
+    pParser.add_argument("--nopng", "-n", action="store_true", help="With --montage, don't write the individual figures")
+    pParser.add_argument("--workers", "-w", help="Worker processes (default one per figure)", default=None, type=int)
+    pArgs = pParser.parse_args(sys.argv[1:])
+
+    if pArgs.montage:
+        renderMontage(pArgs.filename, pArgs.montage, nWorkers=pArgs.workers, bSave=not pArgs.nopng)
+    else:
+        renderAll(pArgs.filename, nWorkers=pArgs.workers)
@@ -0,0 +1,216 @@
+"""
+Append-only history of fitted wave parameters, SEIRS alignments and
+next-peak predictions, kept next to each series as _history.bin so the
+drift of the fit across runs can be followed. Every run that fits
+appends one block, unless the latest block of its kind was made from the
+same data and configuration: a fixed-size header with the kind of record, the run
+time, the number of days, the hash of the data and the hash of the fit
+configuration (backend, loss, weights and so on, as in the fit cache),
+followed by the block's value, wave and parameter columns as contiguous
+arrays. Queries can select one configuration, so fits made different
+ways are not mixed in one drift. The index of blocks is built from the
+headers alone, by seeking from one to the next, and only the columns of
+the blocks a query selects are read. Blocks written before the
+configuration was recorded have an empty configuration hash.
+"""
+import argparse
+from datetime import datetime
+import hashlib
+import json
+import math
+import os
+import struct
+import sys
+import time
+
+import numpy as np
+
+from fit_cache import hashSeries
+from time_series import loadSeries
+
+strMagic = b"RH02"
+
+# magic, kind, rows, run time (Unix seconds), days of data, data hash, config hash
+pHeader = struct.Struct("<4sB3xIdi32s16s")
+
+# headers by magic, for reading blocks written by earlier versions
+mapHeaders = {b"RH01": struct.Struct("<4sB3xIdi32s"), strMagic: pHeader}
+
+lstKinds = ["peaks", "seirs", "prediction"]
+
+# codes are positions in this list, so new names only ever go on the end
+lstParameterNames = ["slope", "rms", "height", "position", "width", "sdev", "area",
+                     "offset", "multiplier", "spacing", "spacing_sdev", "sdev_sdev", "area_sdev"]
+
+# dtypes of the columns, in file order
+lstColumns = [("value", np.float64), ("wave", np.int16), ("parameter", np.uint8)]
+
+def configHash(mapConfig):
+    """Hash of a fit configuration as stored in block headers"""
+    return hashlib.sha256(json.dumps(mapConfig, sort_keys=True).encode()).hexdigest()[:16]
+
+def historyFile(strFilename):
+    """History file kept alongside a series text file"""
+    return os.path.splitext(strFilename)[0]+"_history.bin"
+
+class RunHistory:
+
+    def __init__(self, strFilename):
+        self.strFilename = strFilename
+        self.lstIndex = []  # (column offset, kind, rows, time, days, hash, config hash) of every block read so far
+        self.nIndexed = 0   # bytes of the file covered by the index
+
+    def append(self, strKind, lstRows, strDataHash, nDays, mapConfig=None, fTime=None):
+        """Append one block of (wave, parameter name, value) rows from a fit
+        with mapConfig, unless the latest block of this kind has the same
+        data hash and configuration, e.g. a re-render of an unchanged fit.
+        The block is written with a single append so concurrent runs cannot
+        interleave their records. Returns True if the block was appended."""
+        strConfig = configHash(mapConfig or {})
+        lstBlocks = self.blocks(strKind)
+        if lstBlocks and lstBlocks[-1][5] == strDataHash[:32] and lstBlocks[-1][6] == strConfig:
+            return False
+        aWaves = np.array([tRow[0] for tRow in lstRows], dtype=np.int16)
+        aParameters = np.array([lstParameterNames.index(tRow[1]) for tRow in lstRows], dtype=np.uint8)
+        aValues = np.array([tRow[2] for tRow in lstRows], dtype=np.float64)
+        bytHeader = pHeader.pack(strMagic, lstKinds.index(strKind), len(lstRows), time.time() if fTime is None else fTime,
+                                 nDays, strDataHash[:32].encode(), strConfig.encode())
+        nHandle = os.open(self.strFilename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(nHandle, bytHeader+aValues.tobytes()+aWaves.tobytes()+aParameters.tobytes())
+        finally:
+            os.close(nHandle)
+        return True
+
+    def index(self):
+        """Headers of every block, reading only those appended since the
+        last call. A block cut short by an interrupted write is left out."""
+        if not os.path.exists(self.strFilename):
+            return self.lstIndex
+        nSize = os.path.getsize(self.strFilename)
+        with open(self.strFilename, "rb") as inFile:
+            nOffset = self.nIndexed
+            while nOffset+pHeader.size <= nSize:
+                inFile.seek(nOffset)
+                pBlockHeader = mapHeaders.get(inFile.read(4))
+                if pBlockHeader is None:
+                    raise ValueError("Corrupt run history block at byte "+str(nOffset)+" of "+self.strFilename)
+                nColumns = nOffset+pBlockHeader.size
+                if nColumns > nSize:
+                    break
+                inFile.seek(nOffset)
+                tHeader = pBlockHeader.unpack(inFile.read(pBlockHeader.size))
+                bytMagic, nKind, nRows, fTime, nDays, bytHash = tHeader[:6]
+                strConfig = tHeader[6].decode() if len(tHeader) > 6 else ""
+                nEnd = nColumns+nRows*sum(np.dtype(pType).itemsize for strName, pType in lstColumns)
+                if nEnd > nSize: # still being written or interrupted
+                    break
+                self.lstIndex.append((nColumns, lstKinds[nKind], nRows, fTime, nDays, bytHash.decode(), strConfig))
+                nOffset = nEnd
+            self.nIndexed = nOffset
+        return self.lstIndex
+
+    def blocks(self, strKind, strDataHash=None, pSince=None, pUntil=None, mapConfig=None):
+        """Index entries of one kind, optionally for one data hash (or its
+        prefix), between two run datetimes and from one fit configuration"""
+        fSince = -np.inf if pSince is None else pSince.timestamp()
+        fUntil = np.inf if pUntil is None else pUntil.timestamp()
+        return [tBlock for tBlock in self.index() if tBlock[1] == strKind and fSince <= tBlock[3] <= fUntil
+                and (strDataHash is None or tBlock[5].startswith(strDataHash[:32]))
+                and (mapConfig is None or tBlock[6] == configHash(mapConfig))]
+
+    def readColumns(self, inFile, tBlock):
+        """The value, wave and parameter columns of one block"""
+        nOffset, strKind, nRows = tBlock[:3]
+        inFile.seek(nOffset)
+        return [np.frombuffer(inFile.read(nRows*np.dtype(pType).itemsize), dtype=pType) for strName, pType in lstColumns]
+
+    def query(self, strKind, strParameter, nWave=0, strDataHash=None, pSince=None, pUntil=None, mapConfig=None):
+        """Run times (UTC datetime64[s]), days of data and values of one
+        parameter of one wave (0 for whole-fit values such as the slope or
+        RMS) in every matching run that recorded it"""
+        nParameter = lstParameterNames.index(strParameter)
+        lstTimes, lstDays, lstValues = [], [], []
+        lstBlocks = self.blocks(strKind, strDataHash, pSince, pUntil, mapConfig)
+        if not lstBlocks:
+            return np.array([], dtype="datetime64[s]"), np.array([], dtype=int), np.array([])
+        with open(self.strFilename, "rb") as inFile:
+            for tBlock in lstBlocks:
+                aValues, aWaves, aParameters = self.readColumns(inFile, tBlock)
+                aMatch = np.nonzero((aParameters == nParameter) & (aWaves == nWave))[0]
+                if len(aMatch):
+                    lstTimes.append(tBlock[3])
+                    lstDays.append(tBlock[4])
+                    lstValues.append(aValues[aMatch[0]])
+        return np.array(lstTimes).astype(np.int64).astype("datetime64[s]"), np.array(lstDays), np.array(lstValues)
+
+    def latest(self, strKind, mapConfig=None):
+        """(wave, parameter name, value) rows of the most recent run of a
+        kind, optionally from one fit configuration"""
+        lstBlocks = self.blocks(strKind, mapConfig=mapConfig)
+        if not lstBlocks:
+            return []
+        with open(self.strFilename, "rb") as inFile:
+            aValues, aWaves, aParameters = self.readColumns(inFile, lstBlocks[-1])
+        return [(int(nWave), lstParameterNames[nParameter], float(fValue)) for fValue, nWave, nParameter in zip(aValues, aWaves, aParameters)]
+
+def seriesHash(strFilename, nMaxDay=-1):
+    """Days and hash of the series a run was made on"""
+    aValues = loadSeries(strFilename, nMaxDay).aValues
+    return len(aValues), hashSeries(aValues)
+
+def recordPeaks(strFilename, lstVertex, fError, mapConfig, nMaxDay=-1):
+    """Append a vertex fitted with mapConfig and its RMS error"""
+    lstRows = [(0, "slope", lstVertex[0]), (0, "rms", fError)]
+    for nPeak in range(1, len(lstVertex), 3):
+        nWave = (nPeak+2)//3
+        fSDev = math.sqrt(abs(lstVertex[nPeak+2])/2)
+        lstRows.extend([(nWave, "height", lstVertex[nPeak]), (nWave, "position", lstVertex[nPeak+1]), (nWave, "width", lstVertex[nPeak+2]),
+                        (nWave, "sdev", fSDev), (nWave, "area", lstVertex[nPeak]*math.sqrt(2*math.pi)*fSDev)])
+    nDays, strHash = seriesHash(strFilename, nMaxDay)
+    RunHistory(historyFile(strFilename)).append("peaks", lstRows, strHash, nDays, mapConfig)
+
+def recordSeirs(strFilename, fOffset, fMultiplier, fError, mapConfig):
+    """Append a SEIRS model alignment made with mapConfig"""
+    nDays, strHash = seriesHash(strFilename)
+    RunHistory(historyFile(strFilename)).append("seirs", [(0, "offset", fOffset), (0, "multiplier", fMultiplier), (0, "rms", fError)], strHash, nDays, mapConfig)
+
+def recordPrediction(strFilename, mapPrediction, mapConfig):
+    """Append a next-peak prediction from plot_fit.predictNextPeak, made
+    with mapConfig"""
+    lstRows = [(0, strName, mapPrediction[strName]) for strName in ["position", "spacing", "sdev", "area", "height", "width",
+                                                                   "spacing_sdev", "sdev_sdev", "area_sdev"]]
+    nDays, strHash = seriesHash(strFilename)
+    RunHistory(historyFile(strFilename)).append("prediction", lstRows, strHash, nDays, mapConfig)
+
+if __name__ == "__main__":
+    pParser = argparse.ArgumentParser(prog="python3 run_history.py", description="Show how a fitted parameter has changed across runs")
+    pParser.add_argument("filename", help="Series file whose history to read, default is can_hosp_patients.csv", nargs="?", default="can_hosp_patients.csv")
+    pParser.add_argument("--kind", "-k", help="Kind of record, default is peaks", default="peaks", choices=lstKinds)
+    pParser.add_argument("--parameter", "-p", help="Parameter to show, default is position", default="position", choices=lstParameterNames)
+    pParser.add_argument("--wave", "-w", help="Wave number from 1, or 0 for whole-fit values, default is 1", default=1, type=int)
+    pParser.add_argument("--since", "-s", help="Only runs on or after this date (YYYY-MM-DD)", default="")
+    pParser.add_argument("--backend", "-b", help="Only peaks fitted by peak_fitter.py with this backend, default is runs of any configuration", default="")
+    pParser.add_argument("--loss", "-l", help="With --backend, only peaks fitted with this loss, default is squares", default="squares")
+    pParser.add_argument("--weights", help="With --backend, only peaks fitted with these weights, default is none", default="")
+    pParser.add_argument("--threshold", help="With --backend, only peaks fitted with this peak finder threshold, default is 115", default=115, type=float)
+    pParser.add_argument("--method", help="Only SEIRS alignments made with this method (align or simplex), default is any", default="")
+    pParser.add_argument("--model", help="With --method, only alignments of this model file, default is seirs_model.csv", default="seirs_model.csv")
+    pArgs = pParser.parse_args(sys.argv[1:])
+
+    mapConfig = None
+    if pArgs.kind == "peaks" and pArgs.backend:
+        from losses import loadWeights
+        from peak_fitter import fitConfig
+        aWeights = loadWeights(pArgs.weights, loadSeries(pArgs.filename).aValues) if pArgs.weights else None
+        mapConfig = fitConfig(pArgs.backend, pArgs.loss, aWeights, pArgs.threshold)
+    elif pArgs.kind == "seirs" and pArgs.method:
+        from seirs_model_objective import SeirsModelObjective, seirsConfig
+        mapConfig = seirsConfig(pArgs.method, SeirsModelObjective(pArgs.filename, pArgs.model).aSeirsModel)
+    pSince = datetime.strptime(pArgs.since, "%Y-%m-%d") if pArgs.since else None
+    pHistory = RunHistory(historyFile(pArgs.filename))
+    print("Runs recorded:", len(pHistory.index()))
+    aTimes, aDays, aValues = pHistory.query(pArgs.kind, pArgs.parameter, pArgs.wave, pSince=pSince, mapConfig=mapConfig)
+    print("# run days", pArgs.parameter)
+    for pTime, nDays, fValue in zip(aTimes, aDays, aValues):
+        print(pTime, nDays, fValue)
@@ -0,0 +1,223 @@
+"""
+Daily-step SEIRS simulator that produces curves in the layout of
+seirs_model.csv (day, E+I, E, I, S). The model is a renewal process:
+each day's new infections are beta*S*I/N, and the days from infection to
+becoming infectious and from becoming infectious to recovery are
+discretized gamma distributions. Recovered people become susceptible
+again on a sigmoid between the wane start and end days after recovery
+(its 5% and 95% points). Every delay is a kernel applied to the history
+of past flows, so each day is a few dot products rather than a loop over
+compartments, and many parameter sets can be simulated at once.
+"""
+import argparse
+import math
+import sys
+import time
+
+import numpy as np
+
+from levenberg_marquardt import LevenbergMarquardt, mapConvergenceReasons
+
+lstParameterNames = ["beta", "incubation", "incubation_shape", "recovery", "recovery_shape", "wane_start", "wane_end"]
+
+# calibrated against the shipped seirs_model.csv
+lstDefaults = [0.16529, 3.0016, 1.2012, 15.539, 7.7028, 22.510, 50.615]
+
+lstLower = [0.01, 0.5, 1.0, 1.0, 1.0, 1.0, 2.0]
+lstUpper = [5.0, 30.0, 50.0, 60.0, 50.0, 180.0, 365.0]
+
+nSubdivisions = 10 # points per day when integrating the delay densities
+
+def delayKernel(aMean, aShape, nLength):
+    """Probability that a gamma distributed delay of the given mean and
+    shape (one per row) rounds up to 1, 2, ... nLength days"""
+    aMean = np.asarray(aMean, dtype=float).reshape(-1, 1)
+    aShape = np.asarray(aShape, dtype=float).reshape(-1, 1)
+    aTimes = (np.arange(nLength*nSubdivisions)+0.5)/nSubdivisions
+    aScale = aMean/aShape
+    with np.errstate(divide="ignore"):
+        aLogDensity = (aShape-1)*np.log(aTimes)-aTimes/aScale
+    aDensity = np.exp(aLogDensity-aLogDensity.max(axis=1, keepdims=True))
+    aKernel = aDensity.reshape(len(aMean), nLength, nSubdivisions).sum(axis=2)
+    return aKernel/aKernel.sum(axis=1, keepdims=True)
+
+def waningKernel(aStart, aEnd, nLength):
+    """Probability that immunity is lost 1, 2, ... nLength days after
+    recovery, for a logistic whose 5% and 95% points are aStart and aEnd"""
+    aStart = np.asarray(aStart, dtype=float).reshape(-1, 1)
+    aEnd = np.asarray(aEnd, dtype=float).reshape(-1, 1)
+    aScale = np.maximum(aEnd-aStart, 1E-3)/(2*math.log(19))
+    aCumulative = 1/(1+np.exp(-(np.arange(nLength+1)-(aStart+aEnd)/2)/aScale))
+    aKernel = np.diff(aCumulative, axis=1)
+    return aKernel/aKernel.sum(axis=1, keepdims=True)
+
+def delayLength(aMean, aShape):
+    """Days covering all but a negligible tail of gamma distributed delays"""
+    return int(math.ceil(np.max(np.asarray(aMean)*(1+6/np.sqrt(np.asarray(aShape))))))+1
+
+def convolveRows(aFirst, aSecond):
+    """Full convolution of each row of aFirst with the same row of aSecond"""
+    nLength = aFirst.shape[1]+aSecond.shape[1]-1
+    return np.fft.irfft(np.fft.rfft(aFirst, nLength)*np.fft.rfft(aSecond, nLength), nLength)
+
+def compartmentKernels(aParameters):
+    """Fraction of the people infected a = 1, 2, ... days ago who are
+    exposed, infectious and not susceptible, one row per parameter set.
+    Each is found from the distribution of the summed delays, so every
+    compartment is a single dot product with the history of infections."""
+    aIncubation = delayKernel(aParameters[:, 1], aParameters[:, 2], delayLength(aParameters[:, 1], aParameters[:, 2]))
+    aRecovery = delayKernel(aParameters[:, 3], aParameters[:, 4], delayLength(aParameters[:, 3], aParameters[:, 4]))
+    aWaning = waningKernel(aParameters[:, 5], aParameters[:, 6], int(math.ceil(np.max(2*aParameters[:, 6]-aParameters[:, 5])))+1)
+
+    # probabilities indexed by delay in days, the shortest delay being a day
+    def byDelay(aKernel):
+        return np.hstack([np.zeros((len(aKernel), 1)), aKernel])
+    aToInfectious = byDelay(aIncubation)
+    aToRecovered = np.clip(convolveRows(aToInfectious, byDelay(aRecovery)), 0, None)
+    aToSusceptible = np.clip(convolveRows(aToRecovered, byDelay(aWaning)), 0, None)
+    nLength = aToSusceptible.shape[1]
+
+    # cumulative probability that each stage is over by age a-1
+    def cumulative(aProbability):
+        aCumulative = np.ones((len(aProbability), nLength))
+        aCumulative[:, :aProbability.shape[1]] = np.minimum(np.cumsum(aProbability, axis=1), 1)
+        return np.hstack([np.zeros((len(aProbability), 1)), aCumulative[:, :-1]])
+    aInfectious, aRecovered, aSusceptible = map(cumulative, (aToInfectious, aToRecovered, aToSusceptible))
+    return 1-aInfectious, aInfectious-aRecovered, 1-aSusceptible
+
+def simulateSeirs(lstParameters=None, nDays=1002, nPopulation=100000, nInfected=14):
+    """Simulate nDays from nInfected exposed people in a population of
+    nPopulation. lstParameters is one set of parameters in the order of
+    lstParameterNames (default lstDefaults), giving a (days, 5) array in
+    the layout of seirs_model.csv, or a (sets, parameters) array, giving a
+    (sets, days, 5) array."""
+    if lstParameters is None:
+        lstParameters = lstDefaults
+    aParameters = np.asarray(lstParameters, dtype=float)
+    bSingle = aParameters.ndim == 1
+    aParameters = np.atleast_2d(aParameters)
+    nSets = len(aParameters)
+
+    # kernels are reversed so the newest day of history meets age one day
+    aExposed, aInfectious, aImmune = compartmentKernels(aParameters)
+    nLength = aExposed.shape[1]-1
+    aInfectiousKernel = aInfectious[:, :0:-1].copy()
+    aImmuneKernel = aImmune[:, :0:-1].copy()
+
+    # new infections each day with nLength days of history before day 0,
+    # the initial exposed people being infected the day before
+    aInfections = np.zeros((nSets, nLength+nDays))
+    aInfections[:, nLength-1] = nInfected
+    aModel = np.empty((nSets, nDays, 5))
+    aModel[:, :, 0] = np.arange(nDays)
+    if nSets == 1: # plain dot products are several times quicker than the batched sums
+        aHistory = aInfections[0]
+        aKernelI, aKernelR = aInfectiousKernel[0], aImmuneKernel[0]
+        fBeta = aParameters[0, 0]/nPopulation
+        for nDay in range(nDays):
+            aWindow = aHistory[nDay:nDay+nLength]
+            fI = aWindow @ aKernelI
+            fS = nPopulation-aWindow @ aKernelR
+            aModel[0, nDay, 3] = fI
+            aModel[0, nDay, 4] = fS
+            aHistory[nDay+nLength] = fBeta*fS*fI
+    else:
+        aBeta = aParameters[:, 0]/nPopulation
+        for nDay in range(nDays):
+            aWindow = aInfections[:, nDay:nDay+nLength]
+            aI = (aWindow*aInfectiousKernel).sum(axis=1)
+            aS = nPopulation-(aWindow*aImmuneKernel).sum(axis=1)
+            aModel[:, nDay, 3] = aI
+            aModel[:, nDay, 4] = aS
+            aInfections[:, nDay+nLength] = aBeta*aS*aI
+
+    # the exposed follow from the whole history at once
+    aModel[:, :, 2] = convolveRows(aInfections, aExposed[:, 1:])[:, nLength-1:nLength-1+nDays]
+    aModel[:, :, 1] = aModel[:, :, 2]+aModel[:, :, 3]
+    return aModel[0] if bSingle else aModel
+
+def writeSeirsModel(strFilename, aModel):
+    """Write a simulated curve as whole people, like seirs_model.csv"""
+    np.savetxt(strFilename, np.rint(aModel), fmt="%d")
+    print("SEIRS model written to:", strFilename)
+
+class SeirsCalibration:
+    """
+    Least squares objective for fitting the simulator's parameters to a
+    model curve file, with residuals over the E, I and S columns. The
+    jacobian is by forward differences, all simulated in one batch.
+    """
+    def __init__(self, strModelFile, fStep=1E-4):
+        self.aTarget = np.loadtxt(strModelFile, ndmin=2)[:, 2:5]
+        self.nDays = len(self.aTarget)
+        self.nPopulation = int(round(self.aTarget[0].sum()))
+        self.nInfected = int(round(self.aTarget[0, 0]+self.aTarget[0, 1]))
+        self.fStep = fStep
+
+    def simulate(self, aParameters):
+        return simulateSeirs(aParameters, self.nDays, self.nPopulation, self.nInfected)
+
+    def residuals(self, lstX):
+        return (self.simulate(np.asarray(lstX, dtype=float))[:, 2:5]-self.aTarget).ravel()
+
+    def jacobian(self, lstX):
+        aX = np.asarray(lstX, dtype=float)
+        aSteps = self.fStep*np.maximum(np.abs(aX), 1E-2)
+        aPoints = np.vstack([aX, aX+np.diag(aSteps)])
+        aResiduals = (self.simulate(aPoints)[:, :, 2:5]-self.aTarget).reshape(len(aPoints), -1)
+        return ((aResiduals[1:]-aResiduals[0])/aSteps[:, None]).T
+
+    def __call__(self, lstX):
+        aResidual = self.residuals(lstX)
+        return math.sqrt(np.dot(aResidual, aResidual)/len(aResidual))
+
+def calibrate(strModelFile, lstStarts=None):
+    """Fit the simulator's parameters to a model curve file, returning the
+    parameters and the RMS error over the E, I and S columns"""
+    pObjective = SeirsCalibration(strModelFile)
+    pMinimizer = LevenbergMarquardt(len(lstParameterNames))
+    pMinimizer.setObjective(pObjective)
+    pMinimizer.setStarts(lstStarts or lstDefaults)
+    pMinimizer.setBounds(lstLower, lstUpper)
+    pMinimizer.setFractionalTolerance(1E-8)
+
+    print("Calibrating to", strModelFile, "...")
+    fStart = time.perf_counter()
+    nCount, pResult, nReason = pMinimizer.minimize()
+    print("Wall time (s):", time.perf_counter()-fStart)
+    print("Iterations:", nCount)
+    print("Reason for termination:", mapConvergenceReasons[nReason])
+    print("Residual RMS Error: ", pResult.getValue())
+    for strName, fValue in zip(lstParameterNames, pResult.getVertex()):
+        print(strName, fValue)
+    return pResult.getVertex(), pResult.getValue()
+
+def compareModel(strModelFile, lstParameters=None):
+    """RMS and largest difference between the simulated E+I column and a
+    model curve file"""
+    aTarget = np.loadtxt(strModelFile, usecols=1, ndmin=1)
+    aModel = simulateSeirs(lstParameters, len(aTarget))
+    aDifference = np.rint(aModel[:, 1])-aTarget
+    return math.sqrt(np.mean(aDifference**2)), float(np.max(np.abs(aDifference)))
+
+if __name__ == "__main__":
+    pParser = argparse.ArgumentParser(prog="python3 seirs_model.py", description="Simulate the SEIRS model curve used by seirs_model_objective.py")
+    pParser.add_argument("--output", "-o", help="Model file to write, default is seirs_model_sim.csv", default="seirs_model_sim.csv")
+    pParser.add_argument("--days", "-d", help="Days to simulate, default is 1002", default=1002, type=int)
+    for strName, fDefault in zip(lstParameterNames, lstDefaults):
+        pParser.add_argument("--"+strName.replace("_", "-"), help="Default is "+str(fDefault), default=fDefault, type=float)
+    pParser.add_argument("--calibrate", "-c", help="Fit the parameters to this model file first", default="")
+    pParser.add_argument("--compare", help="Report the difference from this model file, default is seirs_model.csv", default="seirs_model.csv")
+    pArgs = pParser.parse_args(sys.argv[1:])
+
+    lstParameters = [getattr(pArgs, strName) for strName in lstParameterNames]
+    if pArgs.calibrate:
+        lstParameters, fError = calibrate(pArgs.calibrate, lstParameters)
+
+    fStart = time.perf_counter()
+    aModel = simulateSeirs(lstParameters, pArgs.days)
+    print("Simulation time (s):", time.perf_counter()-fStart)
+    writeSeirsModel(pArgs.output, aModel)
+    if pArgs.compare:
+        fRMS, fLargest = compareModel(pArgs.compare, lstParameters)
+        print("E+I difference from", pArgs.compare, "RMS:", fRMS, "largest:", fLargest)
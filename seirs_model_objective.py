@@ -2,42 +2,45 @@ import argparse
 from datetime import datetime, timedelta
 import math
 import sys
+import time
 
+import numpy as np
+
+from fit_cache import hashSeries
+from run_history import recordSeirs
+from seirs_model import simulateSeirs
 import simple_minimizer as sm
+from time_series import loadSeries
 
 mapConvergenceReasons = {-1: "Exceeded iteration limit", 1: "Closest points indistinguishable", 
                                                  2: "Met fractional tolerance", 3:"Minimum scale achieved"}
 
+pFitStart = datetime(2021, 12, 10) # low point between delta and omicron
+
+def fitData(strDataFile):
+    """The first day after pFitStart and the data from that day on, NaN
+    for days with no data"""
+    pSeries = loadSeries(strDataFile)
+    nStart = max(pSeries.dayOf(pFitStart)+1, 0)
+    return nStart, np.asarray(pSeries.aValues[nStart:])
+
 class SeirsModelObjective:
     
-    def __init__(self, strDataFile, strModelFile):
-        
-        self.pFitStart = datetime(2021, 12, 10) # low point between delta and omicron
+    def __init__(self, strDataFile, strModelFile, lstParameters=None):
+        """The model curve is the E+I column of strModelFile, or if that is
+        None the curve simulated with lstParameters (see seirs_model.py)"""
+
+        self.pFitStart = pFitStart
         
-        self.lstData = []
-        self.pDate = None
-        nCount = 0
-        self.nStart = -1
-        with open(strDataFile) as inFile:
-            for strLine in inFile:
-                if self.pDate is None:
-                    if strLine.strip().startswith("#"):
-                        self.pDate = datetime.strptime(strLine.strip().split()[1], "%Y-%m-%d")
-                        continue
-                else:
-                    if self.pDate > self.pFitStart:
-                        if self.nStart < 0:
-                            self.nStart = nCount
-                            print("Starting point: ", self.nStart)
-                        self.lstData.append(float(strLine.strip().split()[1]))
-                    self.pDate += timedelta(days=1)
-                    nCount += 1
-                
-        self.lstSeirsModel = []
-        with open(strModelFile) as inFile:
-            for strLine in inFile:
-                lstLine = strLine.strip().split()
-                self.lstSeirsModel.append(int(lstLine[1]))
+        self.nStart, self.aData = fitData(strDataFile)
+        print("Starting point: ", self.nStart)
+        self.lstData = self.aData.tolist()
+
+        if strModelFile is None:
+            self.aSeirsModel = np.rint(simulateSeirs(lstParameters)[:, 1])
+        else:
+            self.aSeirsModel = np.loadtxt(strModelFile, usecols=1, ndmin=1)
+        self.lstSeirsModel = self.aSeirsModel.astype(int).tolist()
 
     def __call__(self, lstX):
         
@@ -48,35 +51,152 @@ class SeirsModelObjective:
         nCount = 0
         for nDay, fValue in enumerate(self.lstData):
             nMatchDay = int(nDay + fOffset)
-            if nMatchDay >= 0 and nMatchDay < len(self.lstSeirsModel):
+            if nMatchDay >= 0 and nMatchDay < len(self.lstSeirsModel) and not math.isnan(fValue):
                 fError += (fValue-fMultiplier*self.lstSeirsModel[nMatchDay])**2
                 nCount += 1
         return math.sqrt(fError/nCount)
 
-def fitSeirsModel(strFilename):
-
-    nParameters = 2
-    pMinimizer = sm.SimpleMinimizer(nParameters)
-    pObjective = SeirsModelObjective(strFilename, "seirs_model.csv")
-    pMinimizer.setObjective(pObjective)
-    pMinimizer.setStarts([0, 0.3])
-    pMinimizer.setScales([25, 0.05])
-    pMinimizer.setMinimumScale(1E-6) # the minimum is pretty well defined
-
-    print("Fitting... this may take a minute or two...")
-    nCount, pResult, nReason = pMinimizer.minimize()
-    lstVertex = pResult.getVertex()
-
-    print("Iterations:", nCount)
-    print("Reason for termination:", mapConvergenceReasons[nReason])
-    print("Residual RMS Error: ",pResult.getValue())
-    print("Offset, multiplier: ", lstVertex[0], lstVertex[1])
-    nOffset = int(lstVertex[0])
-    fMultiplier = lstVertex[1]
-    lstModel = pObjective.lstSeirsModel
+def alignmentError(aData, aModel, fOffset):
+    """RMS error and closed-form multiplier for a (possibly fractional)
+    offset, with the model linearly interpolated between days"""
+    aMatch = np.arange(len(aData))+fOffset
+    aMask = (aMatch >= 0) & (aMatch <= len(aModel)-1) & np.isfinite(aData)
+    if not aMask.any():
+        return math.inf, 0.0
+    aValues = aData[aMask]
+    aShifted = np.interp(aMatch[aMask], np.arange(len(aModel)), aModel)
+    fModelSquared = np.dot(aShifted, aShifted)
+    if fModelSquared == 0:
+        return math.inf, 0.0
+    fMultiplier = np.dot(aValues, aShifted)/fModelSquared
+    aResidual = aValues-fMultiplier*aShifted
+    return math.sqrt(np.dot(aResidual, aResidual)/len(aValues)), fMultiplier
+
+def alignSeirsModel(aData, aModel, fMinOverlap=0.9):
+    """
+    Find the offset and multiplier that best align the model with the
+    data, where data day n is matched with model day n+offset. For any
+    fixed offset the multiplier is a 1-D linear least squares problem, so
+    it is solved in closed form, and every integer offset is scored at
+    once using an FFT cross-correlation and running sums over the overlap.
+    Offsets where less than fMinOverlap of the shorter series overlap are
+    not considered, as a handful of days can always be fit well. The best
+    integer offset is then refined to a fractional one by golden section
+    search on the interpolated model. Returns offset, multiplier and RMS.
+    """
+    aData = np.asarray(aData, dtype=float)
+    aModel = np.asarray(aModel, dtype=float)
+    nData = len(aData)
+    nModel = len(aModel)
+
+    # days with no data are NaN and take no part in any of the sums
+    aRaw = aData
+    aValid = np.isfinite(aData).astype(float)
+    aData = np.where(aValid > 0, aData, 0.0)
+
+    # correlations sum_n f[n]*g[n+k] for every k, negative k wraps around
+    nLength = nData+nModel-1
+    aOffsets = np.arange(-(nData-1), nModel)
+    def correlate(aFirst, aSecond):
+        aCorrelation = np.fft.irfft(np.conj(np.fft.rfft(aFirst, nLength))*np.fft.rfft(aSecond, nLength), nLength)
+        return aCorrelation[aOffsets % nLength]
+    aProducts = correlate(aData, aModel)
+    aModelSquared = correlate(aValid, aModel**2)
+
+    # sum of squares of the data and number of valid days over the overlap
+    aDataSum = np.concatenate(([0.0], np.cumsum(aData**2)))
+    aCountSum = np.concatenate(([0.0], np.cumsum(aValid)))
+    aDataLow = np.maximum(0, -aOffsets)
+    aDataHigh = np.minimum(nData, nModel-aOffsets)
+    aDataSquared = aDataSum[aDataHigh]-aDataSum[aDataLow]
+    aOverlap = np.rint(aCountSum[aDataHigh]-aCountSum[aDataLow])
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        aMultipliers = aProducts/aModelSquared
+        aErrors = np.sqrt(np.maximum(aDataSquared-aProducts*aMultipliers, 0)/aOverlap)
+    aErrors[(aOverlap < fMinOverlap*min(aValid.sum(), nModel)) | ~(aModelSquared > 1E-9) | ~np.isfinite(aErrors)] = math.inf
+    nBest = int(np.argmin(aErrors))
+    if math.isinf(aErrors[nBest]):
+        raise ValueError("No offset gives enough overlap between data and model")
+
+    # golden section refinement between the neighbouring integer offsets
+    fGolden = (math.sqrt(5)-1)/2
+    fLow = aOffsets[nBest]-1.0
+    fHigh = aOffsets[nBest]+1.0
+    fLeft = fHigh-fGolden*(fHigh-fLow)
+    fRight = fLow+fGolden*(fHigh-fLow)
+    fLeftError = alignmentError(aRaw, aModel, fLeft)[0]
+    fRightError = alignmentError(aRaw, aModel, fRight)[0]
+    while fHigh-fLow > 1E-3:
+        if fLeftError < fRightError:
+            fHigh, fRight, fRightError = fRight, fLeft, fLeftError
+            fLeft = fHigh-fGolden*(fHigh-fLow)
+            fLeftError = alignmentError(aRaw, aModel, fLeft)[0]
+        else:
+            fLow, fLeft, fLeftError = fLeft, fRight, fRightError
+            fRight = fLow+fGolden*(fHigh-fLow)
+            fRightError = alignmentError(aRaw, aModel, fRight)[0]
+    fOffset = (fLow+fHigh)/2
+    fError, fMultiplier = alignmentError(aRaw, aModel, fOffset)
+    if fError > aErrors[nBest]: # interpolation did not help, keep the integer offset
+        return float(aOffsets[nBest]), float(aMultipliers[nBest]), float(aErrors[nBest])
+    return fOffset, float(fMultiplier), fError
+
+def writeModelFile(strFilename, pObjective, fOffset, fMultiplier):
+    """Write the shifted and scaled model to _model.csv"""
     with open(strFilename.replace(".csv", "_model.csv"), "w") as outFile:
-        for nI, fValue in enumerate(lstModel):
-            outFile.write(str(nI+pObjective.nStart-nOffset)+" "+str(fMultiplier*fValue)+"\n")
+        for nI, fValue in enumerate(pObjective.lstSeirsModel):
+            outFile.write(str(nI+pObjective.nStart-fOffset)+" "+str(fMultiplier*fValue)+"\n")
+
+def seirsConfig(strMethod, aSeirsModel):
+    """Run history configuration of an alignment of the model curve
+    aSeirsModel by strMethod"""
+    return {"method": strMethod, "model": hashSeries(aSeirsModel)}
+
+def fitSeirsModel(strFilename, strMethod="align", strModelFile="seirs_model.csv", lstParameters=None):
+    """Fit the scaled and shifted SEIRS model to the omicron-era data,
+    either by the closed-form alignment (default) or the simplex. With no
+    strModelFile the model is simulated with lstParameters."""
+
+    pObjective = SeirsModelObjective(strFilename, strModelFile, lstParameters)
+    if strMethod == "align":
+        print("Aligning model over all offsets...")
+        fStart = time.perf_counter()
+        fOffset, fMultiplier, fError = alignSeirsModel(pObjective.aData, pObjective.aSeirsModel)
+        print("Wall time (s):", time.perf_counter()-fStart)
+        print("Residual RMS Error: ", fError)
+        print("Offset, multiplier: ", fOffset, fMultiplier)
+    elif strMethod == "simplex":
+        nParameters = 2
+        pMinimizer = sm.SimpleMinimizer(nParameters)
+        pMinimizer.setObjective(pObjective)
+        pMinimizer.setStarts([0, 0.3])
+        pMinimizer.setScales([25, 0.05])
+        pMinimizer.setMinimumScale(1E-6) # the minimum is pretty well defined
+
+        print("Fitting... this may take a minute or two...")
+        nCount, pResult, nReason = pMinimizer.minimize()
+        lstVertex = pResult.getVertex()
+
+        print("Iterations:", nCount)
+        print("Reason for termination:", mapConvergenceReasons[nReason])
+        print("Residual RMS Error: ",pResult.getValue())
+        print("Offset, multiplier: ", lstVertex[0], lstVertex[1])
+        fOffset = int(lstVertex[0])
+        fMultiplier = lstVertex[1]
+        fError = pResult.getValue()
+    else:
+        raise ValueError("Unknown SEIRS fit method: "+strMethod)
+
+    writeModelFile(strFilename, pObjective, fOffset, fMultiplier)
+    recordSeirs(strFilename, fOffset, fMultiplier, fError, seirsConfig(strMethod, pObjective.aSeirsModel))
+    return fOffset, fMultiplier
 
 if __name__ == "__main__":
-    fitSeirsModel("can_hosp_patients.csv")
+    pParser = argparse.ArgumentParser(prog="python3 seirs_model_objective.py", description="Fit the scaled and shifted SEIRS model to omicron-era data")
+    pParser.add_argument("filename", help="File to process (must end in .csv)", nargs="?", default="can_hosp_patients.csv")
+    pParser.add_argument("--method", "-m", help="align (closed-form multiplier over every offset, default) or simplex", default="align", choices=["align", "simplex"])
+    pParser.add_argument("--simulate", "-s", action="store_true", help="Simulate the model with the default parameters of seirs_model.py instead of reading seirs_model.csv")
+    pArgs = pParser.parse_args(sys.argv[1:])
+
+    fitSeirsModel(pArgs.filename, pArgs.method, None if pArgs.simulate else "seirs_model.csv")
@@ -0,0 +1,265 @@
+"""
+Sweep of the SEIRS simulator's parameters against the omicron-era data.
+Candidates come from a grid over the varied parameters (the others are
+held at their defaults), optionally refined round by round on finer grids
+around the best candidates. Each candidate's E+I curve is aligned with the
+data by the closed-form offset and multiplier of alignSeirsModel and the
+candidates are ranked by the alignment RMS. Simulated curves are cached
+by parameter tuple, in memory with LRU eviction and on disk, so later
+rounds and later sweeps that revisit grid points do not simulate them
+again. Missing curves are simulated in batches on a pool of workers.
+"""
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from seirs_model import lstDefaults, lstLower, lstParameterNames, lstUpper, simulateSeirs, writeSeirsModel
+from seirs_model_objective import alignSeirsModel, fitData
+
+strCacheDir = ".seirs_cache"
+
+nCacheVersion = 1 # bump when the simulator changes
+
+nSignificant = 6 # parameters are rounded to this many digits in cache keys
+
+def parameterKey(lstParameters, nDays):
+    """Cache key of a simulation, with the parameters rounded so the same
+    grid point reached by different arithmetic is the same key"""
+    return (nCacheVersion, nDays)+tuple(float(f"{fValue:.{nSignificant}g}") for fValue in lstParameters)
+
+class SimulationCache:
+    """
+    E+I curves by parameter tuple. Up to nMaxMemory curves are kept in
+    memory, dropping the least recently used, and every curve is also
+    written to strDirectory, where the least recently used files beyond
+    nMaxFiles are removed.
+    """
+    def __init__(self, strDirectory=strCacheDir, nMaxMemory=1024, nMaxFiles=20000):
+        self.strDirectory = strDirectory
+        self.nMaxMemory = nMaxMemory
+        self.nMaxFiles = nMaxFiles
+        self.mapCurves = OrderedDict()
+        self.mapCounts = {"memory": 0, "disk": 0, "simulated": 0}
+
+    def curveFile(self, tKey):
+        return os.path.join(self.strDirectory, hashlib.sha256(json.dumps(tKey).encode()).hexdigest()+".npy")
+
+    def remember(self, tKey, aCurve):
+        self.mapCurves[tKey] = aCurve
+        self.mapCurves.move_to_end(tKey)
+        while len(self.mapCurves) > self.nMaxMemory:
+            self.mapCurves.popitem(last=False)
+
+    def lookup(self, tKey):
+        """Cached curve or None"""
+        if tKey in self.mapCurves:
+            self.mapCurves.move_to_end(tKey)
+            self.mapCounts["memory"] += 1
+            return self.mapCurves[tKey]
+        strFilename = self.curveFile(tKey)
+        try:
+            aCurve = np.load(strFilename)
+            os.utime(strFilename) # recently used, for pruning
+        except (OSError, ValueError): # missing or half-written file
+            return None
+        self.mapCounts["disk"] += 1
+        self.remember(tKey, aCurve)
+        return aCurve
+
+    def store(self, tKey, aCurve):
+        """Keep a new curve, written atomically so concurrent sweeps never
+        read a partial file"""
+        self.mapCounts["simulated"] += 1
+        self.remember(tKey, aCurve)
+        os.makedirs(self.strDirectory, exist_ok=True)
+        nHandle, strTemp = tempfile.mkstemp(dir=self.strDirectory, suffix=".tmp")
+        with os.fdopen(nHandle, "wb") as outFile:
+            np.save(outFile, aCurve)
+        os.replace(strTemp, self.curveFile(tKey))
+
+    def prune(self):
+        """Drop the least recently used files beyond the maximum"""
+        if not os.path.isdir(self.strDirectory):
+            return
+        lstFiles = [os.path.join(self.strDirectory, strName) for strName in os.listdir(self.strDirectory) if strName.endswith(".npy")]
+        if len(lstFiles) <= self.nMaxFiles:
+            return
+        lstFiles.sort(key=os.path.getmtime)
+        for strFilename in lstFiles[:len(lstFiles)-self.nMaxFiles]:
+            try:
+                os.remove(strFilename)
+            except OSError:
+                pass
+
+def scoreCurve(aData, aCurve):
+    """Offset, multiplier and RMS of the best alignment of a curve with the
+    data (infinite RMS if the curve cannot be aligned)"""
+    try:
+        return alignSeirsModel(aData, aCurve)
+    except ValueError:
+        return math.nan, math.nan, math.inf
+
+def evaluateChunk(aData, aParameters, lstCurves, nDays):
+    """Score a chunk of candidates, simulating in one batch those whose
+    curve is None. Returns the new curves and the scores."""
+    lstMissing = [nI for nI, aCurve in enumerate(lstCurves) if aCurve is None]
+    lstNew = []
+    if lstMissing:
+        aModels = simulateSeirs(aParameters[lstMissing], nDays)
+        lstNew = list(np.rint(aModels[:, :, 1]))
+        lstCurves = list(lstCurves)
+        for nI, aCurve in zip(lstMissing, lstNew):
+            lstCurves[nI] = aCurve
+    return lstNew, [scoreCurve(aData, aCurve) for aCurve in lstCurves]
+
+def gridCandidates(mapAxes, lstBase=None):
+    """Every combination of the values in mapAxes (parameter name to list
+    of values), the other parameters taken from lstBase. Candidates
+    whose waning ends before it starts are dropped."""
+    aBase = np.array(lstBase or lstDefaults, dtype=float)
+    lstNames = list(mapAxes)
+    lstGrids = np.meshgrid(*[np.asarray(mapAxes[strName], dtype=float) for strName in lstNames], indexing="ij")
+    aCandidates = np.tile(aBase, (lstGrids[0].size if lstGrids else 1, 1))
+    for strName, aGrid in zip(lstNames, lstGrids):
+        aCandidates[:, lstParameterNames.index(strName)] = aGrid.ravel()
+    aCandidates = np.clip(aCandidates, lstLower, lstUpper)
+    nStart, nEnd = lstParameterNames.index("wane_start"), lstParameterNames.index("wane_end")
+    return aCandidates[aCandidates[:, nStart] < aCandidates[:, nEnd]]
+
+def refineCandidates(aBest, mapSteps, nPoints=3):
+    """Finer grids of nPoints per axis around each of the best candidates"""
+    lstCandidates = []
+    for aCentre in aBest:
+        mapAxes = {strName: aCentre[lstParameterNames.index(strName)]+fStep*np.linspace(-1, 1, nPoints)
+                   for strName, fStep in mapSteps.items()}
+        lstCandidates.append(gridCandidates(mapAxes, list(aCentre)))
+    # neighbouring grids share points, which only need scoring once
+    mapUnique = OrderedDict()
+    for aCandidate in np.concatenate(lstCandidates):
+        mapUnique.setdefault(parameterKey(aCandidate, 0), aCandidate)
+    return np.array(list(mapUnique.values()))
+
+class SeirsSweep:
+
+    def __init__(self, strFilename, nDays=1002, nWorkers=None, pCache=None, nChunk=16):
+        self.aData = fitData(strFilename)[1]
+        self.nDays = nDays
+        self.nWorkers = nWorkers or os.cpu_count()
+        self.pCache = pCache or SimulationCache()
+        self.nChunk = nChunk
+        self.lstResults = [] # (parameters, offset, multiplier, rms) of every candidate scored
+        self.setScored = set()
+
+    def evaluate(self, aCandidates, pPool):
+        """Score the candidates not scored before, returning their
+        (offset, multiplier, rms) rows"""
+        lstKeys = [parameterKey(aCandidate, self.nDays) for aCandidate in aCandidates]
+        aNew = np.array([tKey not in self.setScored for tKey in lstKeys], dtype=bool)
+        aCandidates = aCandidates[aNew]
+        lstKeys = [tKey for tKey, bNew in zip(lstKeys, aNew) if bNew]
+        if not len(aCandidates):
+            return np.empty((0, 3))
+        self.setScored.update(lstKeys)
+        lstCurves = [self.pCache.lookup(tKey) for tKey in lstKeys]
+        nChunks = max(min(self.nWorkers, len(aCandidates)), math.ceil(sum(aCurve is None for aCurve in lstCurves)/self.nChunk))
+        lstIndices = np.array_split(np.arange(len(aCandidates)), nChunks)
+        lstFutures = [pPool.submit(evaluateChunk, self.aData, aCandidates[aIndices], [lstCurves[nI] for nI in aIndices], self.nDays)
+                      for aIndices in lstIndices]
+        aScores = np.empty((len(aCandidates), 3))
+        for aIndices, pFuture in zip(lstIndices, lstFutures):
+            lstNew, lstScores = pFuture.result()
+            for nI, aCurve in zip([nI for nI in aIndices if lstCurves[nI] is None], lstNew):
+                self.pCache.store(lstKeys[nI], aCurve)
+            aScores[aIndices] = lstScores
+        for aCandidate, aScore in zip(aCandidates, aScores):
+            self.lstResults.append((aCandidate, *aScore))
+        return aScores
+
+    def run(self, mapAxes, nRounds=0, nKeep=4):
+        """Score the grid mapAxes, then for nRounds score grids of half the
+        spacing around the nKeep best candidates so far. Returns the
+        results sorted best first, empty if the grid has no candidates."""
+        mapSteps = {strName: (max(lstValues)-min(lstValues))/max(len(lstValues)-1, 1)/2 for strName, lstValues in mapAxes.items()}
+        aCandidates = gridCandidates(mapAxes)
+        if not len(aCandidates):
+            print("No candidates to sweep: every grid point has wane_start at or after wane_end")
+            return self.ranked()
+        fStart = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=self.nWorkers) as pPool:
+            for nRound in range(nRounds+1):
+                mapBefore = dict(self.pCache.mapCounts)
+                aScores = self.evaluate(aCandidates, pPool)
+                mapCounts = {strKey: self.pCache.mapCounts[strKey]-mapBefore[strKey] for strKey in mapBefore}
+                print("Round", nRound, "candidates", len(aScores), "simulated", mapCounts["simulated"],
+                      "cached", mapCounts["memory"]+mapCounts["disk"], "best RMS", self.best()[3])
+                if nRound == nRounds:
+                    break
+                aBest = np.array([tResult[0] for tResult in self.ranked()[:nKeep]])
+                aCandidates = refineCandidates(aBest, mapSteps)
+                mapSteps = {strName: fStep/2 for strName, fStep in mapSteps.items()}
+        self.pCache.prune()
+        print("Wall time (s):", time.perf_counter()-fStart)
+        return self.ranked()
+
+    def ranked(self):
+        self.lstResults.sort(key=lambda tResult: tResult[3])
+        return self.lstResults
+
+    def best(self):
+        return min(self.lstResults, key=lambda tResult: tResult[3])
+
+    def writeResults(self, strFilename):
+        """Every candidate scored, best first, one row each"""
+        with open(strFilename, "w") as outFile:
+            outFile.write("# "+" ".join(lstParameterNames)+" offset multiplier rms\n")
+            for aCandidate, fOffset, fMultiplier, fError in self.lstResults:
+                outFile.write(" ".join(map(str, list(aCandidate)+[fOffset, fMultiplier, fError]))+"\n")
+        print("Sweep results written to:", strFilename)
+
+def parseAxis(strAxis):
+    """name=low:high:count to (name, values)"""
+    strName, strRange = strAxis.split("=")
+    if strName.replace("-", "_") not in lstParameterNames:
+        raise ValueError("Unknown SEIRS parameter: "+strName)
+    fLow, fHigh, strCount = strRange.split(":")
+    return strName.replace("-", "_"), np.linspace(float(fLow), float(fHigh), int(strCount)).tolist()
+
+lstDefaultAxes = ["beta=0.12:0.22:6", "wane_start=10:35:6", "wane_end=40:80:5"]
+
+if __name__ == "__main__":
+    pParser = argparse.ArgumentParser(prog="python3 seirs_sweep.py", description="Sweep the SEIRS simulator parameters against the omicron-era data")
+    pParser.add_argument("filename", help="File to process (must end in .csv)", nargs="?", default="can_hosp_patients.csv")
+    pParser.add_argument("--vary", "-v", action="append", help="Parameter grid as name=low:high:count, may be repeated, default is "+" ".join(lstDefaultAxes))
+    pParser.add_argument("--rounds", "-r", help="Rounds of refinement around the best candidates, default is 0 (grid only)", default=0, type=int)
+    pParser.add_argument("--keep", "-k", help="Candidates refined each round, default is 4", default=4, type=int)
+    pParser.add_argument("--workers", "-w", help="Number of worker processes, default is one per core", default=None, type=int)
+    pParser.add_argument("--cache", help="Simulation cache directory, default is "+strCacheDir, default=strCacheDir)
+    pParser.add_argument("--model", "-o", help="Also write the best candidate's simulated model to this file", default="")
+    pArgs = pParser.parse_args(sys.argv[1:])
+
+    if not pArgs.filename.endswith(".csv"):
+        print("BAD FILENAME: MUST END IN .csv:", pArgs.filename)
+        sys.exit(-1)
+
+    mapAxes = dict(parseAxis(strAxis) for strAxis in (pArgs.vary or lstDefaultAxes))
+    pSweep = SeirsSweep(pArgs.filename, nWorkers=pArgs.workers, pCache=SimulationCache(pArgs.cache))
+    lstResults = pSweep.run(mapAxes, pArgs.rounds, pArgs.keep)
+    if not lstResults:
+        sys.exit(-1)
+    pSweep.writeResults(pArgs.filename.replace(".csv", "_sweep.csv"))
+
+    aBest, fOffset, fMultiplier, fError = lstResults[0]
+    print("Best RMS", fError, "offset", fOffset, "multiplier", fMultiplier)
+    for strName, fValue in zip(lstParameterNames, aBest):
+        print(strName, fValue)
+    if pArgs.model:
+        writeSeirsModel(pArgs.model, simulateSeirs(aBest))
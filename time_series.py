@@ -0,0 +1,123 @@
+"""
+Dense daily time series with a start date, backed by a NumPy array. A
+series is stored next to its two-column text file as a .npy array, which
+is memory-mapped on load so every stage can share it without parsing,
+and a small .json header with the start date and column names. Days with
+no data are NaN rather than being dropped, so row number is always the
+day number.
+"""
+from datetime import datetime, timedelta
+import json
+import os
+import tempfile
+
+import numpy as np
+
+class TimeSeries:
+
+    def __init__(self, pStartDate, aValues, lstColumns=None):
+        self.pStartDate = pStartDate
+        self.aValues = aValues
+        if lstColumns is None:
+            lstColumns = ["value"] if aValues.ndim == 1 else ["value"+str(nI) for nI in range(aValues.shape[1])]
+        self.lstColumns = lstColumns
+
+    def __len__(self):
+        return len(self.aValues)
+
+    @property
+    def strStartDate(self):
+        return str(self.pStartDate.date())
+
+    def days(self):
+        """Day numbers of every row"""
+        return np.arange(len(self.aValues), dtype=float)
+
+    def valid(self):
+        """Mask of the days that have data"""
+        aValid = np.isfinite(self.aValues)
+        return aValid if aValid.ndim == 1 else aValid.all(axis=1)
+
+    def date(self, fDay):
+        return self.pStartDate+timedelta(days=float(fDay))
+
+    def dayOf(self, pDate):
+        return (pDate-self.pStartDate).days
+
+    def truncate(self, nMaxDay):
+        """Series up to and including nMaxDay (no copy)"""
+        if nMaxDay < 0:
+            return self
+        return TimeSeries(self.pStartDate, self.aValues[:nMaxDay+1], self.lstColumns)
+
+    def filled(self):
+        """Values with gaps filled by linear interpolation, for stages that
+        need a continuous series (e.g. weekly sums)"""
+        aValid = self.valid()
+        if aValid.all() or not aValid.any():
+            return np.asarray(self.aValues)
+        aDays = self.days()
+        return np.interp(aDays, aDays[aValid], self.aValues[aValid])
+
+    def save(self, strFilename):
+        """Write strFilename (.npy) and its .json header. Each is written
+        to a temporary file and moved into place, so a reader that has the
+        old array memory-mapped keeps it and no reader sees a partial file.
+        The header goes second, so a new header never describes an old
+        array."""
+        strBase = os.path.splitext(strFilename)[0]
+        strDirectory = os.path.dirname(os.path.abspath(strBase))
+        nHandle, strTemp = tempfile.mkstemp(dir=strDirectory, suffix=".npy.tmp")
+        os.chmod(strTemp, 0o644) # mkstemp's files are private
+        with os.fdopen(nHandle, "wb") as outFile:
+            np.save(outFile, np.ascontiguousarray(self.aValues, dtype=np.float64))
+        os.replace(strTemp, strBase+".npy")
+        nHandle, strTemp = tempfile.mkstemp(dir=strDirectory, suffix=".json.tmp")
+        os.chmod(strTemp, 0o644)
+        with os.fdopen(nHandle, "w") as outFile:
+            json.dump({"start": self.strStartDate, "columns": self.lstColumns, "days": len(self.aValues)}, outFile)
+        os.replace(strTemp, strBase+".json")
+
+    @staticmethod
+    def load(strFilename, bMemoryMap=True):
+        """Read a series saved by save(), memory-mapped by default"""
+        strBase = os.path.splitext(strFilename)[0]
+        with open(strBase+".json") as inFile:
+            mapHeader = json.load(inFile)
+        aValues = np.load(strBase+".npy", mmap_mode="r" if bMemoryMap else None)
+        return TimeSeries(datetime.strptime(mapHeader["start"], "%Y-%m-%d"), aValues, mapHeader["columns"])
+
+    @staticmethod
+    def fromText(strFilename):
+        """Parse a "## start-date" header followed by day/value rows, placing
+        each value at its day number"""
+        pStartDate = None
+        lstDays = []
+        lstValues = []
+        with open(strFilename) as inFile:
+            for strLine in inFile:
+                if strLine.strip().startswith("#"):
+                    pStartDate = datetime.strptime(strLine.strip().split()[1], "%Y-%m-%d")
+                    continue
+                lstLine = strLine.strip().split()
+                if len(lstLine) < 2:
+                    continue
+                lstDays.append(int(float(lstLine[0])))
+                lstValues.append(float(lstLine[1]))
+        aValues = np.full(max(lstDays)+1 if lstDays else 0, np.nan)
+        aValues[lstDays] = lstValues
+        return TimeSeries(pStartDate, aValues)
+
+def seriesFile(strFilename):
+    """Name of the binary series stored alongside a text file"""
+    return os.path.splitext(strFilename)[0]+".npy"
+
+def loadSeries(strFilename, nMaxDay=-1):
+    """Load the series for a day/value text file, using the binary copy if
+    it is at least as new as the text and parsing the text otherwise"""
+    strSeries = seriesFile(strFilename)
+    if os.path.exists(strSeries) and (not os.path.exists(strFilename) or os.path.getmtime(strSeries) >= os.path.getmtime(strFilename)):
+        pSeries = TimeSeries.load(strSeries)
+    else:
+        pSeries = TimeSeries.fromText(strFilename)
+    return pSeries.truncate(nMaxDay)
@@ -0,0 +1,206 @@
+"""
+Long-running mode of the decompose pipeline. The daemon watches the data
+file for changes (or polls the download with conditional requests) and
+keeps the series, peak finder, fitted vertex and SEIRS alignment in
+memory. When data changes only the new days are fed to the peak finder,
+the fit is warm-started from the previous vertex with only the waves that
+reach the new days freed, and the figures are re-rendered by the pipeline
+on a pool of workers kept alive between updates. The latest state is
+written atomically to a JSON file and optionally served on a local port.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+import json
+import math
+import os
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+import numpy as np
+
+from decompose_can_covid_hosp_data import buildPipeline, strDataFile, strModelFile, strOutputFile, strURL
+from download_covid_data import download_data
+from extract_hospitalized import extractHospitalized
+from fit_cache import FitCache, cacheDirectory
+from peak_finder import IncrementalPeakFinder
+from peak_fitter import findStarts, fitConfig, fitPeaks, minimizePeaks, warmStart, writePeakFiles, lstBackends
+from peaks_objective import PeaksObjective
+from plot_fit import predictNextPeak
+from render import lstParameterPlots
+from run_history import recordPeaks, recordSeirs
+from seirs_model_objective import SeirsModelObjective, alignSeirsModel, seirsConfig, writeModelFile
+from time_series import loadSeries
+
+strStateFile = "daemon_state.json"
+
+def firstChangedDay(aOld, aNew):
+    """First day at which two series differ (NaN equal to NaN), or None if
+    they are the same"""
+    if aOld is None:
+        return 0
+    nCommon = min(len(aOld), len(aNew))
+    aDiffer = ~((aOld[:nCommon] == aNew[:nCommon]) | (np.isnan(aOld[:nCommon]) & np.isnan(aNew[:nCommon])))
+    if aDiffer.any():
+        return int(np.argmax(aDiffer))
+    if len(aOld) == len(aNew):
+        return None
+    return nCommon
+
+class StateHandler(socketserver.StreamRequestHandler):
+    """Replies to every connection with the current state as one JSON line"""
+    def handle(self):
+        self.wfile.write(json.dumps(self.server.pDaemon.mapState, default=str).encode()+b"\n")
+
+class WatchDaemon:
+
+    def __init__(self, strBackend="lm", fInterval=60.0, bDownload=False, strState=strStateFile, nPort=None):
+        self.strBackend = strBackend
+        self.fInterval = fInterval
+        self.bDownload = bDownload
+        self.strState = strState
+        self.nPort = nPort
+
+        self.tSignature = None  # mtime and size of the data file when last read
+        self.aValues = None     # the series as of the last update
+        self.pFinder = None
+        self.lstVertex = None
+        self.fError = math.nan
+        self.pSeirs = None      # holds the model curve, loaded once
+        self.tAlignment = None  # offset, multiplier and RMS of the SEIRS model
+        self.mapState = {}
+        self.pPool = None
+
+    def changed(self):
+        """Whether the data file has changed since it was last read"""
+        if self.bDownload: # conditional request on every poll
+            download_data(strURL, strDataFile, nMaxAgeHours=0)
+        pStat = os.stat(strDataFile)
+        tSignature = (pStat.st_mtime_ns, pStat.st_size)
+        bChanged = tSignature != self.tSignature
+        self.tSignature = tSignature
+        return bChanged
+
+    def update(self):
+        """Bring the fit, model and figures up to date with the data file.
+        Returns False if the series had not changed."""
+        fStart = time.perf_counter()
+        pLastDate = extractHospitalized(strDataFile, strOutputFile)
+        pSeries = loadSeries(strOutputFile)
+        aValues = np.array(pSeries.aValues) # a copy, the file is replaced on the next update
+        nFirstNew = firstChangedDay(self.aValues, aValues)
+        if nFirstNew is None:
+            print("Series unchanged")
+            return False
+        print("Series changed from day", nFirstNew, "with", len(aValues), "days to", pLastDate.date())
+
+        # only new days go to the peak finder, unless old days were revised
+        if self.pFinder is None or nFirstNew < len(self.aValues):
+            self.pFinder = IncrementalPeakFinder.fromSeries(aValues)
+        else:
+            self.pFinder.addDays(aValues[len(self.aValues):])
+        self.aValues = aValues
+
+        pObjective = PeaksObjective(strOutputFile, -1)
+        if self.lstVertex is None: # first update, the fit cache may have it
+            self.lstVertex = fitPeaks(strOutputFile, strBackend=self.strBackend)
+        else:
+            lstPeaks, bExtrapolated = self.pFinder.peaks()
+            nFittedPeaks = len(lstPeaks)
+            if bExtrapolated:
+                nFittedPeaks -= 1 # do not fit extrapolated last peak (fits badly)
+            lstStarts, lstScales = findStarts(lstPeaks, nFittedPeaks, False)
+            lstFree = None
+            if len(self.lstVertex) <= len(lstStarts):
+                lstFree = warmStart(lstStarts, self.lstVertex, nFirstNew)
+            nCount, pResult, nReason, fSeconds = minimizePeaks(pObjective, lstStarts, lstScales, self.strBackend, lstFree)
+            self.lstVertex = pResult.getVertex()
+            mapConfig = fitConfig(self.strBackend)
+            FitCache(cacheDirectory(strOutputFile)).store(pObjective.aSeries, mapConfig, self.lstVertex, pResult.getValue())
+            writePeakFiles(strOutputFile, pObjective, self.lstVertex)
+            recordPeaks(strOutputFile, self.lstVertex, pResult.getValue(), mapConfig)
+        self.fError = pObjective(self.lstVertex)
+        print("Residual RMS Error: ", self.fError)
+
+        if self.pSeirs is None:
+            self.pSeirs = SeirsModelObjective(strOutputFile, strModelFile)
+        else:
+            self.pSeirs.aData = aValues[self.pSeirs.nStart:]
+        self.tAlignment = alignSeirsModel(self.pSeirs.aData, self.pSeirs.aSeirsModel)
+        writeModelFile(strOutputFile, self.pSeirs, self.tAlignment[0], self.tAlignment[1])
+        recordSeirs(strOutputFile, *self.tAlignment, seirsConfig("align", self.pSeirs.aSeirsModel))
+
+        # the stages above are done, so the pipeline only re-renders what changed
+        pPipeline = buildPipeline(self.strBackend, bDownload=False, pPool=self.pPool)
+        pPipeline.record(["extract", "fit", "seirs"])
+        pPipeline.run()
+
+        self.writeState(pSeries.pStartDate, pLastDate)
+        print("Update took (s):", time.perf_counter()-fStart)
+        return True
+
+    def writeState(self, pStartDate, pLastDate):
+        """Replace the state file with the latest fit, alignment and prediction"""
+        lstWaves = []
+        for nPeak in range(1, len(self.lstVertex), 3):
+            fSDev = math.sqrt(self.lstVertex[nPeak+2]/2)
+            lstWaves.append({"date": str((pStartDate+timedelta(days=self.lstVertex[nPeak+1])).date()), "day": self.lstVertex[nPeak+1],
+                             "sdev": fSDev, "area": self.lstVertex[nPeak]*math.sqrt(2*math.pi)*fSDev})
+        mapState = {"updated": datetime.now().isoformat(timespec="seconds"), "last_date": str(pLastDate.date()),
+                    "days": len(self.aValues), "rms": self.fError, "vertex": list(map(float, self.lstVertex)), "waves": lstWaves,
+                    "seirs": dict(zip(["offset", "multiplier", "rms"], map(float, self.tAlignment)))}
+        if len(lstWaves) > 4:
+            mapPrediction = predictNextPeak(self.lstVertex[2::3], self.lstVertex[3::3], self.lstVertex[1::3])
+            mapPrediction["date"] = str((pStartDate+timedelta(days=mapPrediction["position"])).date())
+            mapState["prediction"] = mapPrediction
+        self.mapState = mapState
+
+        nHandle, strTemp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.strState)), suffix=".tmp")
+        with os.fdopen(nHandle, "w") as outFile:
+            json.dump(mapState, outFile, indent=1, default=float)
+        os.replace(strTemp, self.strState)
+
+    def serve(self):
+        """Serve the state on localhost in a background thread"""
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        pServer = socketserver.ThreadingTCPServer(("127.0.0.1", self.nPort), StateHandler)
+        pServer.daemon_threads = True
+        pServer.pDaemon = self
+        threading.Thread(target=pServer.serve_forever, daemon=True).start()
+        print("Serving state on 127.0.0.1 port", self.nPort)
+        return pServer
+
+    def run(self, nMaxUpdates=None):
+        """Update whenever the data changes until interrupted (or until
+        nMaxUpdates checks have been made)"""
+        if self.nPort:
+            self.serve()
+        nChecks = 0
+        with ProcessPoolExecutor(max_workers=min(1+len(lstParameterPlots), os.cpu_count())) as self.pPool:
+            try:
+                while nMaxUpdates is None or nChecks < nMaxUpdates:
+                    nChecks += 1
+                    try:
+                        if self.changed():
+                            self.update()
+                    except Exception: # keep running, e.g. through a failed download
+                        traceback.print_exc()
+                    sys.stdout.flush()
+                    time.sleep(self.fInterval)
+            except KeyboardInterrupt:
+                print("Stopping")
+
+if __name__ == "__main__":
+    pParser = argparse.ArgumentParser(prog="python3 watch_daemon.py", description="Keep the decompose pipeline running, refitting incrementally whenever the data changes")
+    pParser.add_argument("--backend", "-b", help="Fitting backend, default is lm", default="lm", choices=lstBackends)
+    pParser.add_argument("--interval", "-i", help="Seconds between checks, default is 60", default=60.0, type=float)
+    pParser.add_argument("--download", "-d", action="store_true", help="Poll the download (conditional request) instead of only watching the data file")
+    pParser.add_argument("--state", "-s", help="State file, default is "+strStateFile, default=strStateFile)
+    pParser.add_argument("--port", "-p", help="Also serve the state as JSON on this localhost port", default=None, type=int)
+    pArgs = pParser.parse_args(sys.argv[1:])
+
+    WatchDaemon(pArgs.backend, pArgs.interval, pArgs.download, pArgs.state, pArgs.port).run()
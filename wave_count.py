@@ -0,0 +1,191 @@
+"""
+Choice of the number of waves by information criterion. The peak finder's
+wave count K is only as good as its slope threshold and merge rule, so
+K-2 to K+2 waves are fitted in parallel worker processes, each from a few
+perturbed starts, and scored with AIC and BIC on the residuals. Fewer
+waves drop the smallest of the peak finder's waves; more waves add the
+largest extra peaks a more permissive peak finder sees, and then waves in
+the widest gaps between peaks. Every fit is cached by wave count, so a
+re-run on unchanged data only rescores. If the best count is at either
+end of the range the range is widened that way and scored again, a few
+times at most, and a best count still at the end is flagged as
+unreliable. The daily residuals are correlated, so both criteria tend to
+favour extra waves; BIC, the default, penalizes them more.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+from fit_cache import FitCache, cacheDirectory
+from multi_start import objectiveFor, perturbStarts
+from peak_finder import PeakFinder
+from peak_fitter import findStarts, minimizePeaks, writePeakFiles, lstBackends
+from run_history import recordPeaks
+from time_series import loadSeries
+
+lstCriteria = ["bic", "aic"]
+
+def candidatePeaks(strFilename, nMaxDay=-1, fSlopeThreshold=30, nMergeDays=14):
+    """The peak finder's fitted (position, height) peaks and, largest
+    first, the extra peaks found with a lower threshold and shorter merge
+    that are not within nMergeDays of one of them"""
+    lstPeaks, bExtrapolated = PeakFinder(strFilename, nMaxDay).findPeaks()
+    if bExtrapolated:
+        lstPeaks = lstPeaks[:-1] # do not fit extrapolated last peak (fits badly)
+    lstAll, bExtrapolated = PeakFinder(strFilename, nMaxDay, fSlopeThreshold, nMergeDays).findPeaks()
+    if bExtrapolated:
+        lstAll = lstAll[:-1]
+    lstExtra = [tPeak for tPeak in lstAll if all(abs(tPeak[0]-fPosition) >= nMergeDays for fPosition, fHeight in lstPeaks)]
+    return lstPeaks, sorted(lstExtra, key=lambda tPeak: -tPeak[1])
+
+def peaksForCount(lstPeaks, lstExtra, nWaves, aSeries):
+    """nWaves starting (position, height) peaks in date order: the largest
+    of lstPeaks if fewer are wanted, else all of them, then lstExtra, then
+    peaks in the middle of the widest gaps between peaks (or the ends of
+    aSeries)"""
+    if nWaves <= len(lstPeaks):
+        return sorted(sorted(lstPeaks, key=lambda tPeak: -tPeak[1])[:nWaves])
+    lstChosen = sorted(lstPeaks+lstExtra[:nWaves-len(lstPeaks)])
+    while len(lstChosen) < nWaves:
+        lstEdges = [0.0]+[fPosition for fPosition, fHeight in lstChosen]+[float(len(aSeries)-1)]
+        nGap = int(np.argmax(np.diff(lstEdges)))
+        fPosition = (lstEdges[nGap]+lstEdges[nGap+1])/2
+        lstChosen = sorted(lstChosen+[(fPosition, max(float(aSeries[int(fPosition)]), 1.0))])
+    return lstChosen
+
+def fitCount(strFilename, nMaxDay, lstPeaks, strBackend, nStarts, nSeed):
+    """Fit one wave count from nStarts perturbed starts (the first
+    unperturbed), returning the best vertex and RMS error"""
+    pObjective = objectiveFor(strFilename, nMaxDay)
+    lstStarts, lstScales = findStarts(lstPeaks, len(lstPeaks), False)
+    lstBest, fBest = None, math.inf
+    for aStart in perturbStarts(lstStarts, nStarts, np.random.default_rng(nSeed)):
+        nCount, pResult, nReason, fSeconds = minimizePeaks(pObjective, list(aStart), lstScales, strBackend)
+        if pResult.getValue() < fBest:
+            lstBest, fBest = pResult.getVertex(), pResult.getValue()
+    return lstBest, fBest
+
+def informationCriteria(fRMS, nParameters, nDays):
+    """AIC and BIC of a least-squares fit with Gaussian errors, from the
+    objective's RMS error (the residual sum over nDays-1), dropping the
+    constant terms"""
+    fMinusTwoLogLikelihood = nDays*math.log(fRMS**2*(nDays-1)/nDays)
+    return fMinusTwoLogLikelihood+2*nParameters, fMinusTwoLogLikelihood+nParameters*math.log(nDays)
+
+def fitCounts(strFilename, nMaxDay, lstCounts, mapFits, lstPeaks, lstExtra, strBackend, nStarts, nWorkers, pCache, nSeed):
+    """Add the fits of the wave counts in lstCounts that are not in mapFits
+    yet, from the cache or fitted in parallel from the candidatePeaks
+    lstPeaks and lstExtra, returning the counts fitted"""
+    aSeries = loadSeries(strFilename, nMaxDay).filled()
+    pObjective = objectiveFor(strFilename, nMaxDay)
+
+    # cached counts are only rescored
+    nCached = 0
+    for nWaves in lstCounts:
+        mapEntry = pCache.lookup(pObjective.aSeries, waveConfig(nWaves, strBackend, nStarts, nSeed)) if pCache and nWaves not in mapFits else None
+        if mapEntry:
+            mapFits[nWaves] = (mapEntry["vertex"], mapEntry["value"])
+            nCached += 1
+    lstMissing = [nWaves for nWaves in lstCounts if nWaves not in mapFits]
+    print("Cached wave counts:", nCached, "fitting:", len(lstMissing))
+
+    fStart = time.perf_counter()
+    if lstMissing:
+        nWorkers = min(nWorkers or os.cpu_count(), len(lstMissing))
+        lstStartPeaks = [peaksForCount(lstPeaks, lstExtra, nWaves, aSeries) for nWaves in lstMissing]
+        with ProcessPoolExecutor(max_workers=nWorkers) as pPool:
+            for nWaves, tFit in zip(lstMissing, pPool.map(fitCount, [strFilename]*len(lstMissing), [nMaxDay]*len(lstMissing), lstStartPeaks,
+                                                          [strBackend]*len(lstMissing), [nStarts]*len(lstMissing), [nSeed]*len(lstMissing))):
+                mapFits[nWaves] = tFit
+                if pCache:
+                    pCache.store(pObjective.aSeries, waveConfig(nWaves, strBackend, nStarts, nSeed), *tFit)
+    print("Wall time (s):", time.perf_counter()-fStart)
+    return lstMissing
+
+def selectWaveCount(strFilename, nMaxDay=-1, nRange=2, strCriterion="bic", strBackend="lm", nStarts=8, nWorkers=None, bCache=True, nSeed=0, nMaxWidenings=3):
+    """Fit K-nRange to K+nRange waves, K being the peak finder's count,
+    widening the range by nRange towards the best count while it is at
+    an end of the range, up to nMaxWidenings times. Write the fit files for
+    the wave count with the lowest criterion and return (waves, vertex,
+    RMS, AIC, BIC) rows, best first."""
+    lstPeaks, lstExtra = candidatePeaks(strFilename, nMaxDay)
+    nFound = len(lstPeaks)
+    lstCounts = list(range(max(nFound-nRange, 1), nFound+nRange+1))
+    print("Peak finder found", nFound, "waves, trying", lstCounts[0], "to", lstCounts[-1])
+
+    pObjective = objectiveFor(strFilename, nMaxDay)
+    pCache = FitCache(cacheDirectory(strFilename)) if bCache else None
+    nColumn = 3+lstCriteria[::-1].index(strCriterion) # aic then bic
+    mapFits = {}
+    lstFitted = []
+    nWidenings = 0
+    while True:
+        lstFitted += fitCounts(strFilename, nMaxDay, lstCounts, mapFits, lstPeaks, lstExtra, strBackend, nStarts, nWorkers, pCache, nSeed)
+        lstRows = []
+        for nWaves in lstCounts:
+            lstVertex, fRMS = mapFits[nWaves]
+            lstRows.append((nWaves, lstVertex, fRMS)+informationCriteria(fRMS, len(lstVertex), len(pObjective.aData)))
+        lstRows.sort(key=lambda tRow: tRow[nColumn])
+        nBest = lstRows[0][0]
+        bEdge = nBest == lstCounts[-1] or (nBest == lstCounts[0] and nBest > 1)
+        if not bEdge or nWidenings == nMaxWidenings:
+            break
+        nWidenings += 1
+        if nBest == lstCounts[-1]:
+            lstCounts = lstCounts+list(range(lstCounts[-1]+1, lstCounts[-1]+nRange+1))
+        else:
+            lstCounts = list(range(max(lstCounts[0]-nRange, 1), lstCounts[0]))+lstCounts
+        print("Best count", nBest, "is at the end of the range, widening to", lstCounts[0], "to", lstCounts[-1])
+
+    fBest = lstRows[0][nColumn]
+    print("Waves RMS AIC BIC delta_"+strCriterion)
+    for nWaves, lstVertex, fRMS, fAIC, fBIC in lstRows:
+        print(nWaves, fRMS, fAIC, fBIC, (fAIC if strCriterion == "aic" else fBIC)-fBest, "(peak finder)" if nWaves == nFound else "")
+    nBest, lstVertex, fRMS = lstRows[0][:3]
+    print("Best wave count by", strCriterion.upper()+":", nBest)
+    if bEdge:
+        print("UNRELIABLE: best count", nBest, "is still at the end of the range tried after", nWidenings, "widenings:",
+              lstCounts[0], "to", str(lstCounts[-1])+"; the criterion may have no minimum here")
+    writePeakFiles(strFilename, pObjective, lstVertex)
+    if nBest in lstFitted: # a cached best count was recorded when it was fitted
+        recordPeaks(strFilename, lstVertex, fRMS, waveConfig(nBest, strBackend, nStarts, nSeed), nMaxDay)
+    writeWaveCounts(strFilename, lstRows)
+    return lstRows
+
+def waveConfig(nWaves, strBackend, nStarts, nSeed):
+    """Cache configuration of one wave count's fit"""
+    return {"backend": strBackend, "waves": nWaves, "starts": nStarts, "seed": nSeed}
+
+def writeWaveCounts(strFilename, lstRows):
+    """Write the candidate wave counts and their scores to _wave_count.csv"""
+    strCountFile = strFilename.replace(".csv", "_wave_count.csv")
+    with open(strCountFile, "w") as outFile:
+        outFile.write("# Waves RMS AIC BIC\n")
+        for nWaves, lstVertex, fRMS, fAIC, fBIC in lstRows:
+            outFile.write(str(nWaves)+" "+str(fRMS)+" "+str(fAIC)+" "+str(fBIC)+"\n")
+    print("Wave counts written to:", strCountFile)
+
+if __name__ == "__main__":
+    pParser = argparse.ArgumentParser(prog="python3 wave_count.py", description="Choose the number of waves by fitting several counts in parallel and comparing AIC/BIC")
+    pParser.add_argument("filename", help="File to process (must end in .csv)")
+    pParser.add_argument("--maxday", "-m", help="Maximum day number to process, default is all", default=-1, type=int)
+    pParser.add_argument("--range", "-r", help="Try this many waves either side of the peak finder's count, default is 2", default=2, type=int)
+    pParser.add_argument("--criterion", "-c", help="Criterion to choose by, default is bic", default="bic", choices=lstCriteria)
+    pParser.add_argument("--backend", "-b", help="Fitting backend, default is lm", default="lm", choices=lstBackends)
+    pParser.add_argument("--starts", "-s", help="Perturbed starts per wave count, default is 8", default=8, type=int)
+    pParser.add_argument("--workers", "-w", help="Number of worker processes, default is one per core", default=None, type=int)
+    pParser.add_argument("--nocache", "-n", action="store_true", help="Refit every wave count, ignoring and not updating the fit cache")
+    pParser.add_argument("--seed", help="Random seed for the perturbed starts, default is 0", default=0, type=int)
+    pParser.add_argument("--widen", help="Times to widen the range while the best count is at an end of it, default is 3", default=3, type=int)
+    pArgs = pParser.parse_args(sys.argv[1:])
+
+    if not pArgs.filename.endswith(".csv"):
+        print("BAD FILENAME: MUST END IN .csv:", pArgs.filename)
+        sys.exit(-1)
+
+    selectWaveCount(pArgs.filename, pArgs.maxday, pArgs.range, pArgs.criterion, pArgs.backend, pArgs.starts, pArgs.workers, not pArgs.nocache, pArgs.seed, pArgs.widen)